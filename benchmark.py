@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmarks against a local mock Stash
+
+Starts the mock GraphQL server from stashstuff/mock_stash.py on a synthetic
+library, then runs each script's full main() against it in a fresh child
+process (in its own temporary directory, with the script's settings
+overridden per scenario) and reports wall time, request throughput, p50/p99
+request latency and the child's peak memory. The library is regenerated from
+the same seed before every scenario, so numbers are comparable between runs:
+save them with --save and check a change against them with --compare.
+
+    python benchmark.py --scenes 5000 --latency 0.002
+    python benchmark.py --only markers markers-cache --save baseline.json
+    python benchmark.py --compare baseline.json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+from stashstuff.mock_stash import MockLibrary, MockStashServer
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# ====== CONFIGURATION ======
+# name -> (script, setting overrides). Overrides are applied like the command
+# line's (stashstuff/cli.py): module constants, or CONFIG keys.
+SCENARIOS = {
+    'dupes': ('find-phash-dupes.py', {'BATCH_SIZE': None, 'RESUME': False}),
+    'dupes-minimal': ('find-phash-dupes.py', {'BATCH_SIZE': None, 'RESUME': False,
+                                              'QUERY_PROFILE': 'scoring-minimal'}),
+    'dupes-parallel': ('find-phash-dupes.py', {'BATCH_SIZE': None, 'RESUME': False, 'MERGE_WORKERS': 4}),
+    'dupes-stream': ('find-phash-dupes.py', {'BATCH_SIZE': None, 'RESUME': False, 'STREAM_DUPLICATES': True}),
+    'primaries': ('update-dupes.py', {'UNATTENDED': True}),
+    'markers': ('cleanup_overlapping_markers.py', {'dry_run': False, 'max_scenes': None}),
+    'markers-bulk': ('cleanup_overlapping_markers.py', {'dry_run': False, 'max_scenes': None,
+                                                        'bulk_marker_scan': True}),
+    'markers-async': ('cleanup_overlapping_markers.py', {'dry_run': False, 'max_scenes': None,
+                                                         'async_mode': True}),
+    'markers-cache': ('cleanup_overlapping_markers.py', {'dry_run': False, 'max_scenes': None,
+                                                         'marker_cache_file': 'markers.sqlite'}),
+}
+
+
+def percentile(ordered: List[float], pct: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def peak_rss_mb() -> float:
+    try:
+        import resource
+    except ImportError:  # Windows
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_child(script: str, overrides: Dict) -> Dict:
+    """Run one script's main() in this process and return its measurements"""
+    sys.path.insert(0, REPO_DIR)
+    from stashstuff import client as client_module
+    from stashstuff.cli import apply_settings, load_script
+
+    samples = []
+    record = client_module.LatencyStats.record
+
+    def record_sample(stats, name, elapsed):
+        samples.append(elapsed)
+        record(stats, name, elapsed)
+
+    client_module.LatencyStats.record = record_sample
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        module = load_script(script)
+    apply_settings(module, overrides)
+
+    output = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        module.main()
+    wall = time.perf_counter() - start
+
+    ordered = sorted(samples)
+    return {
+        'wall_s': wall,
+        'requests': len(ordered),
+        'p50_ms': percentile(ordered, 50) * 1000,
+        'p99_ms': percentile(ordered, 99) * 1000,
+        'peak_mb': peak_rss_mb(),
+        'output_lines': output.getvalue().count('\n'),
+    }
+
+
+def run_scenario(name: str, server: MockStashServer, timeout: float) -> Dict:
+    script, overrides = SCENARIOS[name]
+    server.reset()
+    env = {**os.environ, 'STASH_URL': server.url, 'STASH_API_KEY': 'benchmark',
+           'PYTHONPATH': REPO_DIR + os.pathsep + os.environ.get('PYTHONPATH', '')}
+    with tempfile.TemporaryDirectory(prefix=f"bench-{name}-") as workdir:
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', script, json.dumps(overrides)],
+            cwd=workdir, env=env, capture_output=True, text=True, timeout=timeout)
+    if completed.returncode != 0:
+        raise RuntimeError(f"{name} failed:\n{completed.stderr[-2000:]}")
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+
+    stats = server.snapshot()
+    result['server_requests'] = stats.get('requests', 0)
+    result['req_per_s'] = result['server_requests'] / result['wall_s'] if result['wall_s'] else 0.0
+    result['mb_sent'] = stats.get('bytes_out', 0) / (1024 * 1024)
+    result['mutations'] = sum(count for key, count in stats.items() if key in (
+        'op:sceneMerge', 'op:sceneUpdate', 'op:sceneDestroy', 'op:deleteFiles', 'op:sceneMarkerDestroy'))
+    return result
+
+
+def print_table(results: Dict[str, Dict], baseline: Dict[str, Dict]):
+    print(f"\n{'scenario':<16} {'wall s':>8} {'requests':>9} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'MB sent':>8} {'mutations':>9} {'peak MB':>8}")
+    for name, row in results.items():
+        line = (f"{name:<16} {row['wall_s']:>8.2f} {row['server_requests']:>9} {row['req_per_s']:>8.0f} "
+                f"{row['p50_ms']:>8.1f} {row['p99_ms']:>8.1f} {row['mb_sent']:>8.1f} {row['mutations']:>9} "
+                f"{row['peak_mb']:>8.1f}")
+        before = baseline.get(name)
+        if before and before['wall_s']:
+            change = (row['wall_s'] - before['wall_s']) / before['wall_s'] * 100
+            line += f"   ({change:+.0f}% wall vs baseline {before['wall_s']:.2f}s)"
+        print(line)
+
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == '--child':
+        print(json.dumps(run_child(sys.argv[2], json.loads(sys.argv[3]))))
+        return
+
+    parser = argparse.ArgumentParser(description="Benchmark the scripts against a local mock Stash")
+    parser.add_argument('--scenes', type=int, default=2000, help="scenes in the synthetic library")
+    parser.add_argument('--markers-per-scene', type=float, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument('--jitter', type=float, default=0.0, help="random extra latency, up to this many seconds")
+    parser.add_argument('--mutation-latency', type=float, default=0.0, help="extra seconds for mutations")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered with HTTP 503")
+    parser.add_argument('--reset-rate', type=float, default=0.0, help="share of connections dropped")
+    parser.add_argument('--only', nargs='+', choices=sorted(SCENARIOS), help="scenarios to run (default: all)")
+    parser.add_argument('--timeout', type=float, default=1800, help="seconds allowed per scenario")
+    parser.add_argument('--save', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="show the change against results saved earlier with --save")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    library = MockLibrary(scenes=args.scenes, markers_per_scene=args.markers_per_scene, seed=args.seed)
+    print(f"🧪 Mock library: {len(library.scenes)} scenes, {len(library.files)} files, {len(library.markers)} markers")
+    results = {}
+    with MockStashServer(library, latency=args.latency, jitter=args.jitter, mutation_latency=args.mutation_latency,
+                         error_rate=args.error_rate, reset_rate=args.reset_rate, seed=args.seed) as server:
+        for name in args.only or SCENARIOS:
+            print(f"   ⏱️  {name}...", flush=True)
+            results[name] = run_scenario(name, server, args.timeout)
+
+    print_table(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'settings': vars(args), 'results': results}, f, indent=2)
+        print(f"\n💾 Saved results to {args.save}")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,13 +8,20 @@ and removes all but the marker with the lowest ID for each overlapping group.
 Author: Assistant
 """
 
-import requests
+import asyncio
 import json
-import time
 import os
-from collections import defaultdict
-from typing import Dict, List, Tuple, Optional
-from dotenv import load_dotenv
+from collections import defaultdict, deque
+from itertools import islice
+from typing import Callable, Deque, Dict, Iterator, List, Tuple, Optional
+
+from stashstuff.async_client import AsyncStashGraphQLClient, aiohttp_available
+from stashstuff.batching import AsyncMutationBatcher, MutationBatcher
+from stashstuff.client import StashGraphQLClient
+from stashstuff.env import load_stash_env
+from stashstuff.marker_cache import MarkerCache
+from stashstuff.metrics import RunMetrics, profile_run
+from stashstuff.overlap import find_overlap_groups
 
 # ====== CONFIGURATION ======
 CONFIG = {
@@ -22,29 +29,160 @@ CONFIG = {
     'test_mode': False,        # Set to True to process only one scene for testing
     'max_scenes': 10,          # Set to a number to limit total scenes processed (None = all)
     'dry_run': True,           # Set to False to actually delete markers
-    'rate_limit_delay': 0.1,   # Delay between API calls (seconds)
+    'max_requests_per_second': 200,  # Ceiling for the adaptive rate limiter (0 = unlimited)
+    'max_retries': 5,          # Retries for failed queries (deletions are only resent when the server never got them)
+    'timeouts': {},            # Read timeouts in seconds by GraphQL operation name, e.g. {'SceneMarkerDestroy': 60} (see stashstuff/resilience.py for defaults)
     'within_seconds': 2,       # Markers within this many seconds are considered overlapping
+    'overlap_mode': 'anchored',  # 'anchored', 'chained' (single linkage) or 'interval' (uses end_seconds)
+    'same_tag_only': False,    # Only treat markers with the same primary tag as overlapping
+    'bulk_marker_scan': False, # Page through all markers library-wide instead of one query per scene
+    'marker_page_size': 1000,  # Markers fetched per findSceneMarkers request
+    'marker_cache_file': None, # Local SQLite marker cache, e.g. 'markers.sqlite' (None = always query the server)
+    'refresh_marker_cache': False,  # Re-download every marker instead of syncing changes into the cache
+    'pool_size': 16,           # Keep-alive connections to reuse for GraphQL calls
+    'mutation_batch_size': 50, # Marker deletions packed into one GraphQL request (1 = no batching)
+    'async_mode': False,       # Process many scenes at once (requires aiohttp, runs serially without it)
+    'concurrency': 16,         # Async mode: max GraphQL requests in flight
+    'requests_per_second': None,  # Async mode: adaptive rate limiter ceiling (None = max_requests_per_second, 0 = unlimited)
+    'metrics_file': 'marker_cleanup_metrics.json',  # Phase timings, request counters and latency histograms, written after every run (plus .prom; None = off)
+    'profile': None,           # 'cprofile' (profile saved to profile_file) or 'tracemalloc' (biggest allocations printed)
+    'profile_file': 'marker_cleanup_profile.prof',  # Where 'cprofile' saves the profile (open with snakeviz or pstats)
+}
+
+SCENE_MARKERS_QUERY = """
+query GetSceneMarkers($scene_id: Int!, $page: Int!, $per_page: Int!) {
+  findSceneMarkers(
+    scene_marker_filter: {
+      scene_filter: {
+        id: {
+          value: $scene_id,
+          modifier: EQUALS
+        }
+      }
+    }
+    filter: {
+      page: $page,
+      per_page: $per_page
+    }
+  ) {
+    count
+    scene_markers {
+      id
+      seconds
+      end_seconds
+      title
+      primary_tag {
+        id
+        name
+      }
+    }
+  }
+}
+"""
+
+# Library-wide marker scan, newest scenes first. Paged by scene id (keyset) rather
+# than by offset so deleting markers mid-scan can't shift later pages.
+ALL_MARKERS_QUERY = """
+query ScanSceneMarkers($scene_filter: SceneFilterType, $per_page: Int!) {
+  findSceneMarkers(
+    scene_marker_filter: {
+      scene_filter: $scene_filter
+    }
+    filter: {
+      per_page: $per_page,
+      sort: "scene_id",
+      direction: DESC
+    }
+  ) {
+    scene_markers {
+      id
+      seconds
+      end_seconds
+      title
+      primary_tag {
+        id
+        name
+      }
+      scene {
+        id
+        title
+      }
+    }
+  }
 }
+"""
+
+SCENES_WITH_MARKERS_COUNT_QUERY = """
+query CountScenesWithMarkers {
+  findScenes(scene_filter: { has_markers: "true" }, filter: { per_page: 1 }) {
+    count
+  }
+}
+"""
+
+class SceneReport:
+    """
+    One scene's output and counts. A deletion queued in the batcher is only
+    counted once its batch confirms it, and the scene is printed when none
+    are left pending, so every result appears inside its own scene's block,
+    on the line after the marker it belongs to.
+    """
+
+    def __init__(self, index: int, scene: Dict):
+        self.index = index
+        self.scene = scene
+        self.lines: List[Optional[str]] = []
+        self.overlapping_markers = 0
+        self.deleted_markers = 0
+        self.pending = 0
+        self.closed = False
+
+    def emit(self, line: str):
+        self.lines.append(line)
+
+    def hold_line(self) -> int:
+        """Keep the next line free for a deletion result; returns its position for fill_line()"""
+        self.pending += 1
+        self.lines.append(None)
+        return len(self.lines) - 1
+
+    def fill_line(self, position: int, line: str):
+        self.pending -= 1
+        self.lines[position] = line
+
+    @property
+    def done(self) -> bool:
+        return self.closed and not self.pending
+
 
 class StashMarkerCleaner:
     def __init__(self, base_url: str, api_key: str):
         self.base_url = base_url
-        self.headers = {
-            'Content-Type': 'application/json',
-            'ApiKey': api_key
-        }
-        self.graphql_url = f"{base_url}/graphql"
+        self.api_key = api_key
+        self.client = StashGraphQLClient(base_url, api_key, pool_maxsize=CONFIG['pool_size'],
+                                         max_requests_per_second=CONFIG['max_requests_per_second'],
+                                         max_retries=CONFIG['max_retries'],
+                                         timeouts=CONFIG['timeouts'],
+                                         metrics=RunMetrics('cleanup-overlapping-markers'))
         self.dry_run = CONFIG['dry_run']
         self.test_mode = CONFIG['test_mode']
+        self.async_mode = CONFIG['async_mode']
+        if self.async_mode and not aiohttp_available():
+            print("⚠️  aiohttp is not installed, processing scenes one at a time instead (pip install aiohttp)")
+            self.async_mode = False
+        self.batcher = None
+        self.async_client = None  # Set while async mode runs, for verifying batched deletions
+        if CONFIG['mutation_batch_size'] > 1 and (CONFIG['bulk_marker_scan'] or CONFIG['marker_cache_file']
+                                                  or not self.async_mode):
+            self.batcher = MutationBatcher(self.client, max_batch_size=CONFIG['mutation_batch_size'])
+        self.failed_deletions = 0
+        self.deleted_marker_ids: List[str] = []  # Confirmed deletions, dropped from the marker cache at the end
+        self.reports: Deque[SceneReport] = deque()  # Scenes not printed yet, in order
+        self.on_report: Callable[[SceneReport], None] = lambda report: None
         
     def execute_graphql(self, query: str, variables: Optional[Dict] = None) -> Dict:
         """Execute a GraphQL query"""
-        payload = {'query': query}
-        if variables:
-            payload['variables'] = variables
-            
-        response = requests.post(self.graphql_url, json=payload, headers=self.headers)
-        result = response.json()
+        result = self.client.execute_query(query, variables)
         
         if 'errors' in result:
             print(f"GraphQL Error: {result['errors']}")
@@ -105,96 +243,151 @@ class StashMarkerCleaner:
                 break
                 
             page += 1
-            time.sleep(CONFIG['rate_limit_delay'])  # Be nice to the API
         
         print(f"Total scenes with markers: {len(all_scenes)}")
         return all_scenes
     
     def get_scene_markers(self, scene_id: str) -> List[Dict]:
         """Get all markers for a specific scene"""
-        query = """
-        query GetSceneMarkers($scene_id: Int!) {
-          findSceneMarkers(
-            scene_marker_filter: {
-              scene_filter: {
-                id: {
-                  value: $scene_id,
-                  modifier: EQUALS
-                }
-              }
-            }
-            filter: {
-              per_page: 1000  # Should be enough for any single scene
-            }
-          ) {
-            count
-            scene_markers {
-              id
-              seconds
-              end_seconds
-              title
-              primary_tag {
-                id
-                name
-              }
-            }
-          }
-        }
-        """
         
         # Convert scene_id to integer as expected by the GraphQL schema
         scene_id_int = int(scene_id)
-        result = self.execute_graphql(query, {"scene_id": scene_id_int})
+        per_page = CONFIG['marker_page_size']
+        markers = []
+        page = 1
         
-        if not result or 'data' not in result:
-            return []
+        while True:
+            result = self.execute_graphql(SCENE_MARKERS_QUERY, {"scene_id": scene_id_int, "page": page, "per_page": per_page})
+            
+            if not result or 'data' not in result:
+                return markers
             
-        return result['data']['findSceneMarkers']['scene_markers']
+            page_markers = result['data']['findSceneMarkers']['scene_markers']
+            markers.extend(page_markers)
+            if len(page_markers) < per_page:
+                return markers
+            page += 1
     
-    def find_overlapping_markers(self, scene: Dict) -> List[List[Dict]]:
-        """Find groups of markers that start within the configured time tolerance"""
-        markers = scene['markers']
-        within_seconds = CONFIG['within_seconds']
-        
-        # Sort markers by start time for easier processing
-        sorted_markers = sorted(markers, key=lambda x: x['seconds'])
+    def count_scenes_with_markers(self) -> int:
+        """Number of scenes that have at least one marker"""
+        result = self.execute_graphql(SCENES_WITH_MARKERS_COUNT_QUERY)
+        if not result or 'data' not in result:
+            return 0
+        return result['data']['findScenes']['count']
+    
+    def iter_markers_by_scene(self) -> Iterator[Tuple[Dict, List[Dict]]]:
+        """
+        Stream (scene, markers) for every scene with markers, highest scene ID first.
         
-        overlapping_groups = []
-        used_markers = set()
+        Pages through findSceneMarkers for the whole library instead of running one
+        query per scene. A scene cut off at the end of a full page is re-read from the
+        start of the next page, so each scene is yielded exactly once with all of its markers.
+        """
+        per_page = CONFIG['marker_page_size']
+        below_scene_id = None
+        page = 0
         
-        for i, marker in enumerate(sorted_markers):
-            if marker['id'] in used_markers:
+        while True:
+            page += 1
+            scene_filter = None
+            if below_scene_id is not None:
+                scene_filter = {'id': {'value': below_scene_id, 'modifier': 'LESS_THAN'}}
+            
+            print(f"Fetching markers, page {page}...")
+            result = self.execute_graphql(ALL_MARKERS_QUERY, {"scene_filter": scene_filter, "per_page": per_page})
+            if not result or 'data' not in result:
+                return
+            
+            markers = result['data']['findSceneMarkers']['scene_markers']
+            if not markers:
+                return
+            
+            last_page = len(markers) < per_page
+            last_scene_id = markers[-1]['scene']['id']
+            
+            if not last_page and markers[0]['scene']['id'] == last_scene_id:
+                # One scene has more markers than fit on a page - read it on its own
+                scene = markers[0]['scene']
+                yield {'id': scene['id'], 'title': scene['title']}, self.get_scene_markers(scene['id'])
+                below_scene_id = int(last_scene_id)
                 continue
-                
-            # Find all markers within the time tolerance
-            group = [marker]
-            used_markers.add(marker['id'])
             
-            for j, other_marker in enumerate(sorted_markers[i+1:], i+1):
-                if other_marker['id'] in used_markers:
-                    continue
-                    
-                time_diff = abs(other_marker['seconds'] - marker['seconds'])
-                if time_diff <= within_seconds:
-                    group.append(other_marker)
-                    used_markers.add(other_marker['id'])
-                else:
-                    # Since markers are sorted by time, no more overlaps possible
-                    break
+            grouped = defaultdict(list)
+            scenes = {}
+            for marker in markers:
+                scene = marker['scene']
+                if not last_page and scene['id'] == last_scene_id:
+                    continue  # possibly incomplete - picked up again on the next page
+                if scene['id'] not in scenes:
+                    scenes[scene['id']] = {'id': scene['id'], 'title': scene['title']}
+                grouped[scene['id']].append(marker)
             
-            # Only consider it an overlapping group if more than one marker
-            if len(group) > 1:
-                # Sort by ID to ensure we keep the lowest ID
-                group.sort(key=lambda x: int(x['id']))
-                overlapping_groups.append(group)
-        
-        return overlapping_groups
+            for scene_id in sorted(grouped, key=int, reverse=True):
+                yield scenes[scene_id], grouped[scene_id]
+            
+            if last_page:
+                return
+            below_scene_id = int(last_scene_id) + 1
+    
+    def load_marker_cache(self) -> MarkerCache:
+        """Open the local marker cache and sync it with the server (a full download the first time)"""
+        cache = MarkerCache(CONFIG['marker_cache_file'])
+        if CONFIG['refresh_marker_cache']:
+            cache.clear()
+        
+        if cache.watermark:
+            print(f"📂 Loaded {len(cache)} markers from {CONFIG['marker_cache_file']} (up to {cache.watermark})")
+        else:
+            print(f"📥 Downloading every marker into {CONFIG['marker_cache_file']}...")
+        changes = cache.sync(self.client, per_page=CONFIG['marker_page_size'])
+        print(f"🔁 Synced {changes['fetched']} new or updated markers, removed {changes['removed']} deleted ones")
+        print(f"   {len(cache)} markers in {cache.scene_count} scenes")
+        return cache
+    
+    def find_overlapping_markers(self, scene: Dict) -> List[List[Dict]]:
+        """Find groups of overlapping markers (see stashstuff/overlap.py for the modes)"""
+        with self.client.metrics.phase('overlap_detection'):
+            return find_overlap_groups(scene['markers'], CONFIG['within_seconds'],
+                                       mode=CONFIG['overlap_mode'], same_tag_only=CONFIG['same_tag_only'])
+    
+    def open_report(self, index: int, scene: Dict) -> SceneReport:
+        """Start collecting a scene's output; reports are printed in the order they were opened"""
+        report = SceneReport(index, scene)
+        self.reports.append(report)
+        return report
     
-    def delete_marker(self, marker_id: str) -> bool:
-        """Delete a scene marker by ID"""
+    def close_report(self, report: SceneReport):
+        """Mark a scene as processed (its queued deletions may still be pending)"""
+        report.closed = True
+        self.release_reports()
+    
+    def release_reports(self):
+        """Hand every finished report at the front of the queue to on_report"""
+        while self.reports and self.reports[0].done:
+            self.on_report(self.reports.popleft())
+    
+    def delete_marker(self, marker_id: str, report: SceneReport):
+        """Delete a scene marker by ID (queued into an aliased batch when batching is enabled)"""
         if self.dry_run:
-            print(f"    [DRY RUN] Would delete marker {marker_id}")
-            return True
+            report.emit(f"    [DRY RUN] Would delete marker {marker_id}")
+            report.deleted_markers += 1
+            return
+        
+        position = report.hold_line()
+        if self.batcher:
+            scene_id = report.scene['id']
+            if isinstance(self.batcher, AsyncMutationBatcher):
+                async def verify():
+                    return self._marker_deleted_result(marker_id, await self.async_client.execute_query(
+                        SCENE_MARKERS_QUERY, {"scene_id": int(scene_id), "page": 1, "per_page": -1}))
+            else:
+                def verify():
+                    return self._marker_deleted_result(marker_id, self.client.execute_query(
+                        SCENE_MARKERS_QUERY, {"scene_id": int(scene_id), "page": 1, "per_page": -1}))
+            self.batcher.add('sceneMarkerDestroy', {'id': ('ID!', marker_id)},
+                             callback=lambda response: self._on_marker_deleted(marker_id, report, position, response),
+                             verify=verify)
+            return
             
         mutation = """
         mutation SceneMarkerDestroy($id: ID!) {
@@ -202,28 +395,56 @@ class StashMarkerCleaner:
         }
         """
         
-        result = self.execute_graphql(mutation, {"id": marker_id})
-        
-        if result and 'data' in result:
-            print(f"    ✓ Deleted marker {marker_id}")
-            return True
+        self._on_marker_deleted(marker_id, report, position, self.client.execute_query(mutation, {"id": marker_id}))
+    
+    @staticmethod
+    def _marker_deleted_result(marker_id: str, result: Dict) -> Optional[Dict]:
+        """
+        Settle a batched deletion its batch couldn't confirm from a re-read of the
+        marker's scene: a sceneMarkerDestroy result if the marker is gone, None if
+        it is still there (the batcher then sends the deletion again)
+        """
+        if 'errors' in result:
+            return result
+        if any(marker['id'] == marker_id for marker in result['data']['findSceneMarkers']['scene_markers']):
+            return None
+        return {'data': {'sceneMarkerDestroy': True}}
+    
+    def _on_marker_deleted(self, marker_id: str, report: SceneReport, position: int, response: Dict):
+        """Record the outcome of a marker deletion in its scene's report"""
+        if 'errors' in response:
+            report.fill_line(position, f"    ✗ Failed to delete marker {marker_id}: {response['errors']}")
+            self.failed_deletions += 1
         else:
-            print(f"    ✗ Failed to delete marker {marker_id}")
-            return False
+            report.fill_line(position, f"    ✓ Deleted marker {marker_id}")
+            report.deleted_markers += 1
+            self.deleted_marker_ids.append(marker_id)
+        self.release_reports()
     
-    def process_scene_markers(self, scene: Dict) -> Tuple[int, int]:
+    def process_scene_markers(self, scene: Dict, report: SceneReport):
         """Process a single scene - get its markers and clean up overlapping ones"""
+        # Get all markers for this scene
+        markers = self.get_scene_markers(scene['id'])
+        
+        self.cleanup_scene_markers(scene, markers, report)
+    
+    def cleanup_scene_markers(self, scene: Dict, markers: List[Dict], report: SceneReport,
+                              delete_marker: Optional[Callable[[str, SceneReport], None]] = None):
+        """
+        Report the overlapping groups in one scene's markers and delete all but
+        the keeper of each. Deletions are counted in the report as they are
+        confirmed.
+        """
         scene_id = scene['id']
         scene_title = scene['title']
-        
-        # Get all markers for this scene
-        markers = self.get_scene_markers(scene_id)
+        delete_marker = delete_marker or self.delete_marker
+        emit = report.emit
         
         if not markers:
-            return 0, 0
+            return
         
-        print(f"\nScene: {scene_title} (ID: {scene_id})")
-        print(f"  Found {len(markers)} total markers")
+        emit(f"\nScene: {scene_title} (ID: {scene_id})")
+        emit(f"  Found {len(markers)} total markers")
         
         # Create scene object with markers for the existing logic
         scene_with_markers = {
@@ -235,37 +456,94 @@ class StashMarkerCleaner:
         overlapping_groups = self.find_overlapping_markers(scene_with_markers)
         
         if not overlapping_groups:
-            print(f"  No overlapping markers found")
-            return 0, 0
-        
-        print(f"  Found {len(overlapping_groups)} groups of overlapping markers")
+            emit(f"  No overlapping markers found")
+            return
         
-        total_markers = 0
-        deleted_markers = 0
+        emit(f"  Found {len(overlapping_groups)} groups of overlapping markers")
         
         for group in overlapping_groups:
             start_times = [marker['seconds'] for marker in group]
             time_range = f"{min(start_times):.1f}s-{max(start_times):.1f}s" if min(start_times) != max(start_times) else f"{min(start_times):.1f}s"
-            print(f"  Group at {time_range}: {len(group)} markers")
+            emit(f"  Group at {time_range}: {len(group)} markers")
             
             # Keep the first marker (lowest ID), delete the rest
             keeper = group[0]
             to_delete = group[1:]
             
-            print(f"    Keeping: ID {keeper['id']} - {keeper['title']} ({keeper['primary_tag']['name'] if keeper['primary_tag'] else 'No tag'})")
+            emit(f"    Keeping: ID {keeper['id']} - {keeper['title']} ({keeper['primary_tag']['name'] if keeper['primary_tag'] else 'No tag'})")
             
             for marker in to_delete:
                 tag_name = marker['primary_tag']['name'] if marker['primary_tag'] else 'No tag'
-                print(f"    Deleting: ID {marker['id']} - {marker['title']} ({tag_name})")
-                
-                if self.delete_marker(marker['id']):
-                    deleted_markers += 1
-                    
-                time.sleep(CONFIG['rate_limit_delay'])  # Rate limiting
+                emit(f"    Deleting: ID {marker['id']} - {marker['title']} ({tag_name})")
+                delete_marker(marker['id'], report)
+            
+            report.overlapping_markers += len(group)
+    
+    # ---- async mode -------------------------------------------------------
+    
+    async def _get_scene_markers_async(self, client: AsyncStashGraphQLClient, scene_id: str,
+                                       emit: Callable[[str], None]) -> List[Dict]:
+        """Async counterpart of get_scene_markers"""
+        per_page = CONFIG['marker_page_size']
+        markers = []
+        page = 1
+        
+        while True:
+            result = await client.execute_query(SCENE_MARKERS_QUERY, {"scene_id": int(scene_id), "page": page, "per_page": per_page})
+            
+            if 'errors' in result:
+                emit(f"GraphQL Error: {result['errors']}")
+                return markers
+            if 'data' not in result:
+                return markers
+            
+            page_markers = result['data']['findSceneMarkers']['scene_markers']
+            markers.extend(page_markers)
+            if len(page_markers) < per_page:
+                return markers
+            page += 1
+    
+    async def _process_scene_async(self, client: AsyncStashGraphQLClient, report: SceneReport):
+        """Fetch and clean up one scene; its report is printed in order once every scene before it is"""
+        markers = await self._get_scene_markers_async(client, report.scene['id'], report.emit)
+        # Deletions go into the shared async batcher, so batches fill up across scenes
+        self.cleanup_scene_markers(report.scene, markers, report)
+        self.close_report(report)
+    
+    def async_requests_per_second(self) -> float:
+        """Async mode's rate limiter ceiling: requests_per_second, or the shared max_requests_per_second"""
+        if CONFIG['requests_per_second'] is None:
+            return CONFIG['max_requests_per_second']
+        return CONFIG['requests_per_second']
+    
+    async def _run_scenes_async(self, scenes: List[Dict], start_scene: Callable[[int, Dict], SceneReport]):
+        """Process scenes concurrently, reporting each one in the original order"""
+        concurrency = max(1, CONFIG['concurrency'])
+        async with AsyncStashGraphQLClient(self.base_url, self.api_key, concurrency=concurrency,
+                                           requests_per_second=self.async_requests_per_second(),
+                                           max_retries=CONFIG['max_retries'],
+                                           timeouts=CONFIG['timeouts'],
+                                           breaker=self.client.breaker,
+                                           metrics=self.client.metrics) as client:
+            self.async_client = client
+            self.batcher = AsyncMutationBatcher(client, max_batch_size=CONFIG['mutation_batch_size'])
+            pending_indexes = iter(range(len(scenes)))
             
-            total_markers += len(group)
+            async def worker():
+                for index in pending_indexes:
+                    # Opened before the first await, so reports queue up in scene order
+                    report = start_scene(index, scenes[index])
+                    await self._process_scene_async(client, report)
+            
+            await asyncio.gather(*(worker() for _ in range(min(concurrency, len(scenes)))))
+            with self.client.metrics.phase('flush_deletions'):
+                await self.batcher.flush()
         
-        return total_markers, deleted_markers
+        # Fold the async calls into the run's latency report
+        for name, samples in client.stats.samples.items():
+            self.client.stats.samples[name].extend(samples)
+    
+    # ---- driver -----------------------------------------------------------
     
     def run_cleanup(self):
         """Main cleanup process"""
@@ -283,74 +561,153 @@ class StashMarkerCleaner:
             print("   Set CONFIG['test_mode']=False to process all scenes")
             print()
         
-        # Get all scenes that have markers
-        scenes = self.get_scenes_with_markers()
+        marker_cache = None
+        if CONFIG['marker_cache_file']:
+            # Analyse the local copy of every marker; only deletions go to the server
+            try:
+                with self.client.metrics.phase('marker_cache_sync'):
+                    marker_cache = self.load_marker_cache()
+            except RuntimeError as e:
+                print(f"❌ {e}")
+                return
+            scene_total = marker_cache.scene_count
+            if self.test_mode:
+                scene_total = min(scene_total, 1)
+        elif CONFIG['bulk_marker_scan']:
+            # Stream markers for the whole library instead of listing scenes first
+            with self.client.metrics.phase('list_scenes'):
+                scene_total = self.count_scenes_with_markers()
+            if self.test_mode:
+                scene_total = min(scene_total, 1)
+            print(f"Total scenes with markers: {scene_total}")
+        else:
+            # Get all scenes that have markers
+            with self.client.metrics.phase('list_scenes'):
+                scenes = self.get_scenes_with_markers()
+            scene_total = len(scenes)
         
-        if not scenes:
+        if not scene_total:
             print("No scenes with markers found.")
+            if marker_cache:
+                marker_cache.close()
             return
         
-        total_scenes_processed = 0
-        total_overlapping_markers = 0
-        total_deleted_markers = 0
-        scenes_with_overlaps = 0
+        totals = {
+            'scenes_processed': 0,
+            'overlapping_markers': 0,
+            'deleted_markers': 0,
+            'scenes_with_overlaps': 0,
+        }
         
         # Apply max_scenes limit if specified
         if CONFIG['max_scenes'] is not None:
-            scenes = scenes[:CONFIG['max_scenes']]
+            if not (marker_cache or CONFIG['bulk_marker_scan']):
+                scenes = scenes[:CONFIG['max_scenes']]
+            scene_total = min(scene_total, CONFIG['max_scenes'])
             print(f"🔢 Limiting to first {CONFIG['max_scenes']} scenes")
             print()
         
-        for i, scene in enumerate(scenes):
-            print(f"\n[{i+1}/{len(scenes)}] Processing scene: {scene['title']} (ID: {scene['id']})")
-            
-            overlapping_markers, deleted_markers = self.process_scene_markers(scene)
-            
+        def start_scene(i: int, scene: Dict) -> SceneReport:
+            report = self.open_report(i, scene)
+            report.emit(f"\n[{i+1}/{scene_total}] Processing scene: {scene['title']} (ID: {scene['id']})")
+            return report
+        
+        def record_scene(overlapping_markers: int, deleted_markers: int):
             if overlapping_markers > 0:
-                scenes_with_overlaps += 1
-                total_overlapping_markers += overlapping_markers
-                total_deleted_markers += deleted_markers
+                totals['scenes_with_overlaps'] += 1
+                totals['overlapping_markers'] += overlapping_markers
+                totals['deleted_markers'] += deleted_markers
             
-            total_scenes_processed += 1
+            totals['scenes_processed'] += 1
             
             # Progress update every 25 scenes (less frequent since we have per-scene updates now)
-            if total_scenes_processed % 25 == 0:
-                print(f"\n📊 Progress Update: {total_scenes_processed}/{len(scenes)} scenes processed")
-                print(f"   Scenes with overlaps so far: {scenes_with_overlaps}")
-                print(f"   Overlapping markers found: {total_overlapping_markers}")
+            if totals['scenes_processed'] % 25 == 0:
+                print(f"\n📊 Progress Update: {totals['scenes_processed']}/{scene_total} scenes processed")
+                print(f"   Scenes with overlaps so far: {totals['scenes_with_overlaps']}")
+                print(f"   Overlapping markers found: {totals['overlapping_markers']}")
                 if self.dry_run:
-                    print(f"   Markers that would be deleted: {total_deleted_markers}")
+                    print(f"   Markers that would be deleted: {totals['deleted_markers']}")
                 else:
-                    print(f"   Markers deleted: {total_deleted_markers}")
+                    print(f"   Markers deleted: {totals['deleted_markers']}")
+        
+        def print_report(report: SceneReport):
+            for line in report.lines:
+                print(line)
+            record_scene(report.overlapping_markers, report.deleted_markers)
+        
+        self.on_report = print_report
+        
+        if marker_cache:
+            # Deleted markers are only dropped from the cache after the loop, so reading can stream
+            for i, (scene, markers) in enumerate(islice(marker_cache.iter_scenes(), scene_total)):
+                report = start_scene(i, scene)
+                self.cleanup_scene_markers(scene, markers, report)
+                self.close_report(report)
+        elif CONFIG['bulk_marker_scan']:
+            stream = islice(self.iter_markers_by_scene(), scene_total)
+            for i, (scene, markers) in enumerate(stream):
+                report = start_scene(i, scene)
+                self.cleanup_scene_markers(scene, markers, report)
+                self.close_report(report)
+        elif self.async_mode:
+            requests_per_second = self.async_requests_per_second()
+            print(f"⚡ ASYNC MODE - up to {CONFIG['concurrency']} requests in flight"
+                  f"{'' if not requests_per_second else f', at most {requests_per_second} req/s'}")
+            with self.client.metrics.phase('async_scenes'):
+                asyncio.run(self._run_scenes_async(scenes, start_scene))
+        else:
+            for i, scene in enumerate(scenes):
+                report = start_scene(i, scene)
+                self.process_scene_markers(scene, report)
+                self.close_report(report)
+        
+        # Send any deletions still waiting in the batcher; their scenes print as they are confirmed
+        # (async mode flushes its own batcher before the event loop closes)
+        if isinstance(self.batcher, MutationBatcher):
+            with self.client.metrics.phase('flush_deletions'):
+                self.batcher.flush()
+        for name, value in totals.items():
+            self.client.metrics.count(name, value)
+        
+        if marker_cache:
+            marker_cache.remove(self.deleted_marker_ids)
+            marker_cache.close()
+        
+        total_deleted_markers = totals['deleted_markers']
         
         # Final summary
         print("\n" + "=" * 60)
         print("CLEANUP SUMMARY")
         print("=" * 60)
-        print(f"Total scenes processed: {total_scenes_processed}")
-        print(f"Scenes with overlapping markers: {scenes_with_overlaps}")
-        print(f"Total overlapping markers found: {total_overlapping_markers}")
+        print(f"Total scenes processed: {totals['scenes_processed']}")
+        print(f"Scenes with overlapping markers: {totals['scenes_with_overlaps']}")
+        print(f"Total overlapping markers found: {totals['overlapping_markers']}")
         
         if self.dry_run:
             print(f"Markers that would be deleted: {total_deleted_markers}")
         else:
             print(f"Markers successfully deleted: {total_deleted_markers}")
+            if self.failed_deletions:
+                print(f"Markers that could not be deleted: {self.failed_deletions}")
+            if self.batcher and self.batcher.requests_sent:
+                print(f"Deletion requests sent: {self.batcher.requests_sent} (for {self.batcher.mutations_sent} markers)")
         
         if total_deleted_markers > 0:
-            print(f"Space saved: {total_overlapping_markers - (scenes_with_overlaps)} markers removed")
+            print(f"Space saved: {totals['overlapping_markers'] - totals['scenes_with_overlaps']} markers removed")
 
 def main():
-    # Load credentials from stash.env file
-    load_dotenv('stash.env')
+    # Load credentials from .env (or stash.env, which this script used to read)
+    load_stash_env()
     
     BASE_URL = os.getenv('STASH_URL')
     API_KEY = os.getenv('STASH_API_KEY')
     
     if not BASE_URL or not API_KEY:
-        print("❌ Error: Could not find STASH_URL and STASH_API_KEY in stash.env file")
-        print("Please ensure your stash.env file contains:")
+        print("❌ Error: Could not find STASH_URL and STASH_API_KEY in .env or stash.env")
+        print("Please ensure your .env file contains:")
         print("STASH_URL=http://your-stash-url:port")
         print("STASH_API_KEY=your-api-key")
+        print("(or pass --url and --api-key to python -m stashstuff markers)")
         return
     
     print(f"🔗 Connecting to Stash at: {BASE_URL}")
@@ -364,7 +721,12 @@ def main():
     print("Only markers with the lowest ID will be kept for each overlap group.")
     print()
     
-    cleaner.run_cleanup()
+    try:
+        with profile_run(CONFIG['profile'], cleaner.client.metrics, CONFIG['profile_file']):
+            cleaner.run_cleanup()
+    finally:
+        cleaner.client.print_latency_report()
+        cleaner.client.write_metrics(CONFIG['metrics_file'])
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -1,11 +1,23 @@
-import requests
-import json
 import os
+import time
 from collections import defaultdict
-from dotenv import load_dotenv
 
-# Load environment variables from .env file
-load_dotenv()
+from stashstuff.batching import MutationBatcher
+from stashstuff.checkpoint import (FAILED, MERGED, SKIPPED, GroupCacheWriter, MergeJournal, load_group_cache,
+                                   save_group_cache)
+from stashstuff.client import StashGraphQLClient
+from stashstuff.env import load_stash_env
+from stashstuff.executor import ParallelMergeExecutor
+from stashstuff.metrics import RunMetrics, profile_run
+from stashstuff.phash_index import PhashIndex, UnionFind, build_phash_index, sync_phash_index
+from stashstuff.plan import add_file_deletions, iter_plan, plan_group_key, write_plan
+from stashstuff.preflight import identical_file_groups, preflight
+from stashstuff.resilience import TRANSIENT_ERRORS
+from stashstuff.scoring import ScoringEngine
+from stashstuff.streaming import StreamingResponseError
+
+# Load environment variables from .env (or stash.env)
+load_stash_env()
 
 # ============================================================================
 # CONFIGURATION - Modify these settings for your Stash setup
@@ -16,34 +28,147 @@ STASH_URL = os.getenv('STASH_URL', 'http://localhost:9999')
 API_KEY = os.getenv('STASH_API_KEY')
 
 if not API_KEY:
-    raise ValueError("STASH_API_KEY environment variable is required. Please check your .env file.")
+    raise ValueError("STASH_API_KEY environment variable is required. Please check your .env file "
+                     "(or pass --api-key to python -m stashstuff).")
 
 # Duplicate detection settings
 PHASH_DISTANCE = 8  # 0 = exact match, higher values = more tolerant of differences.  Use multiples of 4.
+USE_LOCAL_PHASH_INDEX = False  # Group duplicates from a local phash index instead of findDuplicateScenes
+PHASH_INDEX_FILE = 'phash_index.json'  # Local phash index, reused between runs
+REFRESH_PHASH_INDEX = False  # Re-download every phash instead of reusing PHASH_INDEX_FILE
+PHASH_ENGINE = 'multi-index'  # Local grouping engine: 'multi-index' or 'numpy' (requires numpy, falls back to multi-index)
+COMPARE_WITH_SERVER = False  # Also run findDuplicateScenes and report timing/agreement with the local result
+INCREMENTAL = False  # Only report groups involving scenes created/updated since the last run (local index)
 
 # Processing settings
-BATCH_SIZE = 10  # Number of duplicate groups to process per run
-DELAY_BETWEEN_MERGES = 0.5  # Seconds to wait between merges (be gentle on server)
+BATCH_SIZE = 10  # Number of duplicate groups to process per run (None = every pending group)
+MERGE_WORKERS = 1  # Merges run in parallel (groups sharing a scene never run at the same time)
+MAX_MERGE_BACKOFF = 5.0  # Longest pause between merges when server latency rises (no pause while it's healthy)
+CONNECTION_POOL_SIZE = 16  # Keep-alive connections to reuse for GraphQL calls
+MAX_REQUESTS_PER_SECOND = 200  # Ceiling for the adaptive rate limiter, which backs off on slow responses and 429/5xx (0 = unlimited)
+MAX_RETRIES = 5  # Retries for failed queries (mutations are only resent when the server never got them, or sceneMerge verifiably didn't happen)
+OPERATION_TIMEOUTS = {}  # Read timeouts in seconds by GraphQL operation name, e.g. {'SceneMerge': 900} (see stashstuff/resilience.py for defaults)
+MUTATION_BATCH_SIZE = 50  # Follow-up mutations (primary file updates) packed into one request
+MERGE_PRIMARY_IN_VALUES = True  # Set the primary file in the sceneMerge request itself (one round trip per group)
+PRIMARY_FILE_BY_SCORE = False  # Make the best-scoring file primary even if it isn't an MKV (default: only ever promote an MKV)
+QUERY_PROFILE = 'display-full'  # Scene fields to fetch: 'display-full' (preview) or 'scoring-minimal' (headless runs)
+MEASURE_QUERY_PROFILES = False  # Fetch duplicates once per profile and report payload size and parse time
+STREAM_DUPLICATES = False  # Parse findDuplicateScenes group by group and merge as groups arrive (no preview)
+SCORING_ENGINE = 'python'  # Planning engine: 'python' (group by group) or 'numpy' (all groups at once, requires numpy, falls back to python)
+PLAN_ONLY = False  # Write what every merge would do to MERGE_PLAN_FILE and exit without changing anything
+MERGE_PLAN_FILE = 'merge_plan.jsonl'  # One line per group: destination, sources, primary file, files to delete
+EXECUTE_PLAN = False  # Apply MERGE_PLAN_FILE as written (no duplicate query, no re-scoring) and exit
+DELETE_DUPLICATE_FILES = False  # Plan deletion of every non-primary file after a merge (removes them from disk!)
+PREFLIGHT_FILES = False  # Check every file exists on disk with the size Stash reports before merging (library must be mounted)
+LIBRARY_PATH_MAP = {}  # Server path prefix -> local mount point for the preflight, e.g. {'/data/': '/mnt/stash/'}
+PREFLIGHT_WORKERS = 32  # Concurrent stat/hash calls during the preflight
+SCORING_WEIGHTS = {}  # Overrides for stashstuff.scoring.DEFAULT_WEIGHTS, e.g. {'mkv': 1000, 'hevc': 500, 'marker': 10}
+
+# Checkpoint / resume settings
+DUPLICATES_FILE = 'phash_duplicates.json'  # Cached duplicate group list, written before merging starts
+MERGE_JOURNAL_FILE = 'merge_journal.jsonl'  # Append-only record of merged/skipped/failed groups
+RESUME = True  # Continue from DUPLICATES_FILE + the journal instead of re-querying while groups remain
+
+# Instrumentation
+METRICS_FILE = 'phash_dupes_metrics.json'  # Phase timings, request/byte counters and latency histograms, written after every run (plus a .prom file for Prometheus; None = off)
+PROFILE = None  # 'cprofile' (profile saved to PROFILE_FILE, slowest functions printed) or 'tracemalloc' (biggest allocations printed)
+PROFILE_FILE = 'phash_dupes_profile.prof'  # Where PROFILE = 'cprofile' saves the profile (open with snakeviz or pstats)
 
 # ============================================================================
 
-class StashAppClient:
-    def __init__(self, base_url, api_key):
-        self.base_url = base_url
-        self.headers = {
-            'Content-Type': 'application/json',
-            'ApiKey': api_key
-        }
-        self.graphql_url = f"{base_url}/graphql"
-    
-    def execute_query(self, query, variables=None):
-        payload = {'query': query}
-        if variables:
-            payload['variables'] = variables
-        
-        response = requests.post(self.graphql_url, json=payload, headers=self.headers)
-        return response.json()
-    
+# Scene fields requested for every duplicate candidate, per query profile.
+# 'display-full' has everything the interactive preview prints; 'scoring-minimal'
+# only what the scoring and merge code reads. Stash has no marker count field on
+# Scene, so the minimal profile asks for marker ids only and we count those.
+DUPLICATE_SCENE_FRAGMENTS = {
+    'display-full': """
+fragment DuplicateSceneFields on Scene {
+  id
+  title
+  paths {
+    screenshot
+    preview
+    stream
+    webp
+    vtt
+    sprite
+    funscript
+    interactive_heatmap
+    caption
+  }
+  files {
+    id
+    path
+    basename
+    size
+    duration
+    video_codec
+    width
+    height
+    frame_rate
+    bit_rate
+  }
+  studio {
+    id
+    name
+  }
+  performers {
+    id
+    name
+  }
+  scene_markers {
+    id
+    title
+    seconds
+  }
+  date
+  created_at
+  updated_at
+  resume_time
+  play_count
+  rating100
+}
+""",
+    'scoring-minimal': """
+fragment DuplicateSceneFields on Scene {
+  id
+  title
+  files {
+    id
+    path
+    basename
+    size
+    video_codec
+    bit_rate
+  }
+  studio {
+    id
+  }
+  performers {
+    id
+  }
+  scene_markers {
+    id
+  }
+  rating100
+}
+""",
+}
+
+# Built by main() from SCORING_WEIGHTS, so weights given to `python -m stashstuff dupes` apply
+scoring_engine = None
+
+class StashAppClient(StashGraphQLClient):
+    """Stash GraphQL client with the queries and mutations this script needs"""
+
+    def __init__(self, *args, query_profile='display-full', **kwargs):
+        super().__init__(*args, **kwargs)
+        self.query_profile = query_profile
+
+    @property
+    def scene_fragment(self):
+        return DUPLICATE_SCENE_FRAGMENTS[self.query_profile]
+
     def find_duplicate_scenes(self, distance=0):
         """
         Use Stash's built-in findDuplicateScenes query to find scenes with matching phash
@@ -52,56 +177,48 @@ class StashAppClient:
         query = """
         query FindDuplicateScenes($distance: Int!) {
           findDuplicateScenes(distance: $distance) {
-            id
-            title
-            paths {
-              screenshot
-              preview
-              stream
-              webp
-              vtt
-              sprite
-              funscript
-              interactive_heatmap
-              caption
-            }
-            files {
-              id
-              path
-              basename
-              size
-              duration
-              video_codec
-              width
-              height
-              frame_rate
-              bit_rate
-            }
-            studio {
-              id
-              name
-            }
-            performers {
-              id
-              name
-            }
-            scene_markers {
-              id
-              title
-              seconds
-            }
-            date
-            created_at
-            updated_at
-            resume_time
-            play_count
-            rating100
+            ...DuplicateSceneFields
           }
         }
+        """ + self.scene_fragment
+        variables = {
+            'distance': distance
+        }
+        return self.execute_query(query, variables)
+    
+    def stream_duplicate_scenes(self, distance=0):
         """
+        Like find_duplicate_scenes(), but yields one duplicate group at a time while
+        the response is still being read. Raises StreamingResponseError on errors.
+        """
+        query = """
+        query FindDuplicateScenes($distance: Int!) {
+          findDuplicateScenes(distance: $distance) {
+            ...DuplicateSceneFields
+          }
+        }
+        """ + self.scene_fragment
         variables = {
             'distance': distance
         }
+        return self.stream_array(query, variables, key='findDuplicateScenes')
+    
+    def find_scenes_by_ids(self, scene_ids):
+        """
+        Fetch full duplicate-candidate details for specific scenes
+        """
+        query = """
+        query FindScenesByIds($ids: [ID!]) {
+          findScenes(ids: $ids, filter: { per_page: -1 }) {
+            scenes {
+              ...DuplicateSceneFields
+            }
+          }
+        }
+        """ + self.scene_fragment
+        variables = {
+            'ids': scene_ids
+        }
         return self.execute_query(query, variables)
     
     def delete_scene(self, scene_id):
@@ -162,10 +279,14 @@ class StashAppClient:
         }
         return self.execute_query(mutation, variables)
 
-    def merge_scenes(self, source_scene_ids, destination_scene_id):
+    def merge_scenes(self, source_scene_ids, destination_scene_id, primary_file_id=None):
         """
         Merge multiple scenes into a destination scene using Stash's built-in sceneMerge
-        This will move all files from source scenes to the destination scene
+        This will move all files from source scenes to the destination scene.
+        If primary_file_id is given it is set through the merge's values input, which
+        Stash applies after moving the files, so no separate sceneUpdate is needed.
+        If the request fails in a way that leaves its outcome unknown (timeout,
+        dropped connection), the scenes are checked before it is sent again.
         """
         mutation = """
         mutation SceneMerge($source: [ID!]!, $destination: ID!, $values: SceneUpdateInput!) {
@@ -186,12 +307,47 @@ class StashAppClient:
           }
         }
         """
+        values = {'id': destination_scene_id}
+        if primary_file_id:
+            values['primary_file_id'] = primary_file_id
         variables = {
             'source': source_scene_ids,
             'destination': destination_scene_id,
-            'values': {'id': destination_scene_id}
+            'values': values
         }
-        return self.execute_query(mutation, variables)
+        return self.execute_query(mutation, variables,
+                                  verify=lambda: self.verify_merge(source_scene_ids, destination_scene_id))
+    
+    def verify_merge(self, source_scene_ids, destination_scene_id):
+        """
+        Check whether a sceneMerge went through. sceneMerge runs in one transaction,
+        so either every source scene is gone (merged: returns a response shaped like
+        the mutation's) or none is (not merged: returns None so it can be retried).
+        """
+        query = """
+        query VerifySceneMerge($ids: [ID!]) {
+          findScenes(ids: $ids, filter: { per_page: -1 }) {
+            scenes {
+              id
+              title
+              files {
+                id
+                path
+                basename
+                size
+                video_codec
+              }
+            }
+          }
+        }
+        """
+        result = self.execute_query(query, {'ids': [destination_scene_id] + list(source_scene_ids)})
+        if 'errors' in result:
+            return None
+        scenes = {scene['id']: scene for scene in result['data']['findScenes']['scenes']}
+        if destination_scene_id in scenes and not any(scene_id in scenes for scene_id in source_scene_ids):
+            return {'data': {'sceneMerge': scenes[destination_scene_id]}}
+        return None
 
 def group_scenes_by_similarity(scenes):
     """
@@ -207,6 +363,141 @@ def group_scenes_by_similarity(scenes):
     # Stash's findDuplicateScenes already found them to be similar
     return {"duplicates": scenes}
 
+def load_phash_index(client, path, refresh):
+    """
+    Load the local phash index and sync scenes updated since its watermark, or
+    download every scene's phash if there is no cached index (or a refresh was
+    requested). Returns (index, changed_phashes); changed_phashes is None when
+    the whole index was just built.
+    """
+    if not refresh and os.path.exists(path):
+        index = PhashIndex.load(path)
+        print(f"   📂 Loaded {len(index)} phashes from {path} (up to {index.watermark})")
+        if index.watermark:
+            changed = sync_phash_index(client, index)
+            index.save(path)
+            print(f"   🔁 Synced {len(changed)} phashes from scenes updated since the last run")
+            return index, changed
+    
+    print(f"   📥 Downloading phashes for every scene...")
+    index = build_phash_index(client)
+    index.save(path)
+    print(f"   💾 Saved {len(index)} phashes ({index.scene_count} scenes) to {path}")
+    return index, None
+
+def group_phash_index(index, distance, engine, only=None):
+    """
+    Group scene ids in the local index with the selected engine.
+    If `only` is given, just the groups involving those phashes.
+    """
+    if engine == 'numpy':
+        try:
+            from stashstuff.phash_numpy import duplicate_groups
+        except ImportError:
+            print("⚠️  numpy is not installed, grouping with the multi-index engine instead (pip install numpy)")
+        else:
+            return duplicate_groups(index, distance, only=only)
+    return index.duplicate_groups(distance, only=only)
+
+def compare_with_server(client, distance, local_groups, local_seconds):
+    """
+    Run findDuplicateScenes for the same distance and report how the local
+    grouping compares in runtime and result
+    """
+    print(f"\n   ⚖️  Comparing with findDuplicateScenes(distance: {distance})...")
+    start = time.perf_counter()
+    result = client.find_duplicate_scenes(distance)
+    server_seconds = time.perf_counter() - start
+    
+    if 'errors' in result:
+        print(f"   ❌ Server query failed: {result['errors']}")
+        return
+    
+    server_sets = {frozenset(scene['id'] for scene in group) for group in result['data']['findDuplicateScenes']}
+    local_sets = {frozenset(group) for group in local_groups}
+    
+    print(f"   Server: {len(server_sets)} groups in {server_seconds:.2f}s")
+    print(f"   Local:  {len(local_sets)} groups in {local_seconds:.2f}s"
+          f" ({server_seconds / local_seconds if local_seconds else float('inf'):.1f}x faster)")
+    print(f"   Identical groups: {len(server_sets & local_sets)} | "
+          f"only on server: {len(server_sets - local_sets)} | only local: {len(local_sets - server_sets)}")
+
+def measure_query_profiles(client, distance):
+    """
+    Run findDuplicateScenes once per query profile and report response size,
+    request time and JSON parse time, so the profiles can be compared on a real library
+    """
+    print(f"\n   📏 Measuring query profiles for findDuplicateScenes(distance: {distance})...")
+    print(f"   {'profile':<16} {'bytes':>14} {'request s':>10} {'parse s':>9}")
+    for profile in DUPLICATE_SCENE_FRAGMENTS:
+        query = """
+        query FindDuplicateScenes($distance: Int!) {
+          findDuplicateScenes(distance: $distance) {
+            ...DuplicateSceneFields
+          }
+        }
+        """ + DUPLICATE_SCENE_FRAGMENTS[profile]
+        # Measured around execute_query so rate limiting, retries and the breaker apply as usual;
+        # the bytes and parse time come from what the client recorded for this one call
+        before = client.metrics.summary()
+        start = time.perf_counter()
+        result = client.execute_query(query, {'distance': distance})
+        total_seconds = time.perf_counter() - start
+        after = client.metrics.summary()
+        if 'errors' in result:
+            print(f"   {profile:<16} ❌ {result['errors']}")
+            continue
+        received = (after['operations'].get('FindDuplicateScenes', {}).get('bytes_received', 0)
+                    - before['operations'].get('FindDuplicateScenes', {}).get('bytes_received', 0))
+        parse_seconds = (after['phases'].get('json_parse', {}).get('seconds', 0.0)
+                         - before['phases'].get('json_parse', {}).get('seconds', 0.0))
+        print(f"   {profile:<16} {received:>14,} {total_seconds - parse_seconds:>10.2f} {parse_seconds:>9.2f}")
+
+def find_duplicate_scenes_locally(client, distance, index=None):
+    """
+    Group duplicate scenes using the local phash index, then fetch details for just
+    the grouped scenes. Returns the same shape as client.find_duplicate_scenes().
+    """
+    changed = None
+    if index is None:
+        with client.metrics.phase('phash_index_sync'):
+            index, changed = load_phash_index(client, PHASH_INDEX_FILE, REFRESH_PHASH_INDEX)
+    
+    # Incremental runs only look at scenes that changed since the last run
+    only = changed if INCREMENTAL else None
+    
+    start = time.perf_counter()
+    scene_id_groups = group_phash_index(index, distance, PHASH_ENGINE, only=only)
+    local_seconds = time.perf_counter() - start
+    client.metrics.add_time('phash_grouping', local_seconds)
+    scope = f"{len(only)} changed of {len(index)}" if only is not None else f"{len(index)}"
+    print(f"   ⚡ Grouped {scope} phashes locally in {local_seconds:.2f}s ({PHASH_ENGINE})")
+    
+    if COMPARE_WITH_SERVER and only is None:
+        compare_with_server(client, distance, scene_id_groups, local_seconds)
+    
+    scenes_by_id = {}
+    grouped_ids = [scene_id for group in scene_id_groups for scene_id in group]
+    for i in range(0, len(grouped_ids), 500):
+        result = client.find_scenes_by_ids(grouped_ids[i:i + 500])
+        if 'errors' in result:
+            return result
+        for scene in result['data']['findScenes']['scenes']:
+            scenes_by_id[scene['id']] = scene
+    
+    # Scenes merged or deleted since the index was built no longer exist
+    missing = [scene_id for scene_id in grouped_ids if scene_id not in scenes_by_id]
+    if missing:
+        index.remove_scenes(missing)
+        index.save(PHASH_INDEX_FILE)
+    
+    groups = []
+    for group in scene_id_groups:
+        scenes = [scenes_by_id[scene_id] for scene_id in group if scene_id in scenes_by_id]
+        if len(scenes) > 1:
+            groups.append(scenes)
+    return {'data': {'findDuplicateScenes': groups}}
+
 def display_duplicate_scenes(duplicate_groups):
     """
     Display information about duplicate scenes found by Stash
@@ -222,7 +513,7 @@ def display_duplicate_scenes(duplicate_groups):
         total_groups = len(duplicate_groups)
         total_scenes = sum(len(group) for group in duplicate_groups)
         print(f"\nFound {total_scenes} duplicate scenes in {total_groups} groups")
-        print(f"Will process in batches of {BATCH_SIZE} groups")
+        print(f"Will process in batches of {BATCH_SIZE or 'all'} groups")
         print("=" * 80)
         
         # Show preview of first few groups
@@ -262,10 +553,10 @@ def display_single_scene(scene, index, is_in_group=False):
     print(f"{indent}   Play Count: {scene.get('play_count', 0)}")
     
     if scene.get('studio'):
-        print(f"{indent}   Studio: {scene['studio']['name']}")
+        print(f"{indent}   Studio: {scene['studio'].get('name', scene['studio']['id'])}")
     
     if scene.get('performers'):
-        performer_names = [p['name'] for p in scene['performers']]
+        performer_names = [p.get('name', p['id']) for p in scene['performers']]
         print(f"{indent}   Performers: {', '.join(performer_names)}")
     
     if scene.get('scene_markers'):
@@ -318,76 +609,28 @@ def determine_better_scene(scenes):
     if len(scenes) < 2:
         return scenes[0] if scenes else None, []
     
-    # Score scenes based on multiple factors
-    scored_scenes = []
-    
-    for scene in scenes:
-        score = 0
-        
-        # Metadata quality scoring
-        if scene.get('rating100') and scene.get('rating100') != 'None':
-            score += 100  # Has rating
-        if scene.get('title') and scene.get('title').strip():
-            score += 50   # Has title
-        if scene.get('studio'):
-            score += 25   # Has studio
-        if scene.get('performers'):
-            score += 25   # Has performers
-        if scene.get('scene_markers'):
-            marker_count = len(scene['scene_markers'])
-            score += marker_count * 10  # 10 points per scene marker
-        
-        # File quality scoring
-        best_file_size = 0
-        best_bitrate = 0
-        has_hevc = False
-        
-        for file_info in scene.get('files', []):
-            file_size = file_info.get('size', 0)
-            bitrate = file_info.get('bit_rate', 0)
-            codec = file_info.get('video_codec', '').lower()
-            
-            if file_size > best_file_size:
-                best_file_size = file_size
-            if bitrate > best_bitrate:
-                best_bitrate = bitrate
-            
-            # Check for HEVC codec
-            if codec in ['hevc', 'h265', 'h.265']:
-                has_hevc = True
-        
-        # Add file quality to score (normalized)
-        score += (best_file_size / (1024*1024)) / 10  # Size in MB / 10
-        score += best_bitrate / 1000  # Bitrate in kbps / 1000
-        
-        # HEVC preference - significant bonus for better codec
-        if has_hevc:
-            score += 500  # Large bonus for HEVC codec
-        
-        scored_scenes.append((score, scene))
-    
-    # Sort by score (highest first)
-    scored_scenes.sort(key=lambda x: x[0], reverse=True)
-    
-    best_scene = scored_scenes[0][1]
-    scenes_to_delete = [s[1] for s in scored_scenes[1:]]
-    
-    return best_scene, scenes_to_delete
+    group = scoring_engine.group(scenes)
+    best_scene = group.best_overall
+    others = sorted((s for s in group.scenes if s is not best_scene), key=lambda s: s.overall_score, reverse=True)
+    return best_scene.scene, [s.scene for s in others]
 
-def merge_duplicate_scenes(client, scenes):
+def merge_duplicate_scenes(client, scenes, batcher=None):
     """
     Merge duplicate scenes using Stash's built-in sceneMerge mutation.
     This will intelligently choose the best destination scene and merge all others into it.
+    The final primary file is chosen up front and set by the merge itself; with
+    MERGE_PRIMARY_IN_VALUES off, the MKV file is made primary afterwards instead
+    (queued on the MutationBatcher if one is given).
     """
     if len(scenes) < 2:
         print("Need at least 2 scenes to merge")
         return False
     
-    # Find the scene with the best metadata
-    best_metadata_scene = find_best_metadata_scene(scenes)
-    
-    # Find the scene with the best video file (MKV preferred)
-    best_file_scene = find_best_file_scene(scenes)
+    # Score the group once: best metadata, and best video file (MKV preferred)
+    with client.metrics.phase('scoring'):
+        group = scoring_engine.group(scenes)
+    best_metadata_scene = group.best_metadata.scene
+    best_file_scene = group.best_file.scene
     
     print(f"\n🔄 MERGING DUPLICATES:")
     print(f"   📊 Best metadata: Scene {best_metadata_scene['id']} - {best_metadata_scene.get('title', 'No title')}")
@@ -430,9 +673,14 @@ def merge_duplicate_scenes(client, scenes):
         codec = file_info.get('video_codec', 'Unknown')
         print(f"   🎯 Destination: {file_info.get('basename')} ({size_mb:.1f} MB, {codec})")
     
+    # Decide the final primary file up front so it is set by the merge request itself
+    primary_file_id = choose_primary_file(scenes, destination_scene) if MERGE_PRIMARY_IN_VALUES else None
+    if primary_file_id:
+        print(f"   🎯 File {primary_file_id} will be made primary as part of the merge")
+    
     # Perform the merge using Stash's sceneMerge mutation
     print(f"\n   🚀 Executing sceneMerge...")
-    merge_result = client.merge_scenes(source_scene_ids, destination_scene['id'])
+    merge_result = client.merge_scenes(source_scene_ids, destination_scene['id'], primary_file_id)
     
     if 'errors' in merge_result:
         print(f"   ❌ Error during merge: {merge_result['errors']}")
@@ -455,18 +703,31 @@ def merge_duplicate_scenes(client, scenes):
             if file_info.get('path', '').lower().endswith('.mkv'):
                 mkv_file_id = file_info.get('id')
         
+        current_primary_id = merged_scene['files'][0].get('id') if merged_scene.get('files') else None
+        if MERGE_PRIMARY_IN_VALUES:
+            if not primary_file_id and not (mkv_file_id or PRIMARY_FILE_BY_SCORE):
+                print(f"   ⚠️  No MKV file found in merged scene")
+            elif not primary_file_id:
+                print(f"   ✅ Best file is already the primary file")
+            elif current_primary_id == primary_file_id:
+                print(f"   ✅ Primary file set in the same request as the merge")
+            else:
+                print(f"   ⚠️  Warning: Merge succeeded but file {primary_file_id} is not primary (got {current_primary_id})")
+        
         # Set MKV as primary if it exists and isn't already primary
-        if mkv_file_id and len(merged_scene.get('files', [])) > 1:
-            current_primary_id = merged_scene['files'][0].get('id') if merged_scene.get('files') else None
-            
+        elif mkv_file_id and len(merged_scene.get('files', [])) > 1:
             if mkv_file_id != current_primary_id:
-                print(f"\n   🎯 Setting MKV file as primary...")
-                primary_result = client.set_primary_file(merged_scene['id'], mkv_file_id)
-                
-                if 'errors' not in primary_result:
-                    print(f"   ✅ Successfully set MKV as primary file")
+                if batcher:
+                    print(f"\n   🎯 Queued MKV file as primary (sent with the next mutation batch)")
+                    scene_id = merged_scene['id']
+                    batcher.add('sceneUpdate',
+                                {'input': ('SceneUpdateInput!', {'id': scene_id, 'primary_file_id': mkv_file_id})},
+                                selection='id',
+                                callback=lambda result: report_primary_file_result(scene_id, result))
                 else:
-                    print(f"   ⚠️  Warning: Could not set MKV as primary: {primary_result['errors']}")
+                    print(f"\n   🎯 Setting MKV file as primary...")
+                    primary_result = client.set_primary_file(merged_scene['id'], mkv_file_id)
+                    report_primary_file_result(merged_scene['id'], primary_result)
             else:
                 print(f"   ✅ MKV file is already the primary file")
         elif mkv_file_id:
@@ -479,124 +740,50 @@ def merge_duplicate_scenes(client, scenes):
         print("   ❌ Merge failed - no result returned")
         return False
 
+def choose_primary_file(scenes, destination_scene):
+    """
+    The file that should be primary once the group is merged: the best-scoring
+    MKV across every scene, or with PRIMARY_FILE_BY_SCORE the best-scoring file
+    of any type. None if there is no such file or the destination's current
+    primary file already is that file.
+    """
+    files = [file_info for scene in scenes for file_info in scene.get('files') or ()]
+    if not PRIMARY_FILE_BY_SCORE:
+        files = [file_info for file_info in files if (file_info.get('path') or '').lower().endswith('.mkv')]
+    if not files:
+        return None
+    best_file = max(files, key=scoring_engine.file_score)
+    current_primary = (destination_scene.get('files') or [{}])[0]
+    if best_file.get('id') == current_primary.get('id'):
+        return None
+    return best_file.get('id')
+
+def report_primary_file_result(scene_id, primary_result):
+    """
+    Print the outcome of setting the MKV file as primary for a merged scene
+    """
+    if 'errors' not in primary_result:
+        print(f"   ✅ Successfully set MKV as primary file for scene {scene_id}")
+    else:
+        print(f"   ⚠️  Warning: Could not set MKV as primary for scene {scene_id}: {primary_result['errors']}")
+
 def find_best_metadata_scene(scenes):
     """
     Find the scene with the best metadata (rating, title, studio, performers, etc.)
     """
-    scored_scenes = []
-    
-    for scene in scenes:
-        score = 0
-        
-        # Metadata quality scoring
-        if scene.get('rating100') and scene.get('rating100') != 'None':
-            score += 100  # Has rating
-        if scene.get('title') and scene.get('title').strip():
-            score += 50   # Has title
-        if scene.get('studio'):
-            score += 25   # Has studio
-        if scene.get('performers'):
-            score += 25   # Has performers
-        if scene.get('scene_markers'):
-            marker_count = len(scene['scene_markers'])
-            score += marker_count * 10  # 10 points per scene marker
-        
-        scored_scenes.append((score, scene))
-    
-    # Sort by score (highest first)
-    scored_scenes.sort(key=lambda x: x[0], reverse=True)
-    
-    return scored_scenes[0][1]
+    return scoring_engine.group(scenes).best_metadata.scene
 
 def find_best_file_scene(scenes):
     """
     Find the scene with the best video file (MKV preferred, then by quality)
     """
-    scored_scenes = []
-    
-    for scene in scenes:
-        score = 0
-        
-        # File quality scoring
-        best_file_size = 0
-        best_bitrate = 0
-        has_mkv = False
-        has_hevc = False
-        
-        for file_info in scene.get('files', []):
-            file_size = file_info.get('size', 0)
-            bitrate = file_info.get('bit_rate', 0)
-            codec = file_info.get('video_codec', '').lower()
-            path = file_info.get('path', '').lower()
-            
-            if file_size > best_file_size:
-                best_file_size = file_size
-            if bitrate > best_bitrate:
-                best_bitrate = bitrate
-            
-            # Check for MKV format
-            if path.endswith('.mkv'):
-                has_mkv = True
-            
-            # Check for HEVC codec
-            if codec in ['hevc', 'h265', 'h.265']:
-                has_hevc = True
-        
-        # Add file quality to score
-        score += (best_file_size / (1024*1024)) / 10  # Size in MB / 10
-        score += best_bitrate / 1000  # Bitrate in kbps / 1000
-        
-        # Strong preference for MKV format
-        if has_mkv:
-            score += 1000  # Very high bonus for MKV
-        
-        # HEVC preference
-        if has_hevc:
-            score += 500  # Large bonus for HEVC codec
-        
-        scored_scenes.append((score, scene))
-    
-    # Sort by score (highest first)
-    scored_scenes.sort(key=lambda x: x[0], reverse=True)
-    
-    return scored_scenes[0][1]
+    return scoring_engine.group(scenes).best_file.scene
 
 def find_best_file_from_scene(scene):
     """
     Find the best file from a given scene (MKV preferred, then by quality)
     """
-    files = scene.get('files', [])
-    if not files:
-        return None
-    
-    # Score files
-    scored_files = []
-    for file_info in files:
-        score = 0
-        
-        file_size = file_info.get('size', 0)
-        bitrate = file_info.get('bit_rate', 0)
-        codec = file_info.get('video_codec', '').lower()
-        path = file_info.get('path', '').lower()
-        
-        # File quality
-        score += (file_size / (1024*1024)) / 10  # Size in MB / 10
-        score += bitrate / 1000  # Bitrate in kbps / 1000
-        
-        # Format preference
-        if path.endswith('.mkv'):
-            score += 1000  # Very high bonus for MKV
-        
-        # Codec preference
-        if codec in ['hevc', 'h265', 'h.265']:
-            score += 500  # Large bonus for HEVC codec
-        
-        scored_files.append((score, file_info))
-    
-    # Sort by score (highest first)
-    scored_files.sort(key=lambda x: x[0], reverse=True)
-    
-    return scored_files[0][1]
+    return scoring_engine.scene(scene).best_file
 
 def delete_scene_safely(client, scene_to_delete):
     """
@@ -616,9 +803,35 @@ def delete_scene_safely(client, scene_to_delete):
     else:
         print(f"   ❌ Error deleting scene: {delete_result['errors']}")
 
-def process_duplicate_groups_batch(client, duplicate_scenes, batch_size=25):
+def merge_and_record(client, group, batcher=None, journal=None, header=None):
+    """
+    Merge one duplicate group and journal the outcome. `header` is printed first
+    so it stays with the merge output when merges run in parallel.
+    Returns True if the merge succeeded.
     """
-    Process duplicate groups in batches for efficient processing
+    if header:
+        print(header)
+    success = merge_duplicate_scenes(client, group, batcher=batcher)
+    
+    client.metrics.count('groups_merged' if success else 'groups_not_merged')
+    if journal:
+        if success:
+            journal.record(group, MERGED)
+        elif len(group) < 2:
+            journal.record(group, SKIPPED)
+        else:
+            journal.record(group, FAILED)
+    return success
+
+def group_scene_ids(group):
+    return [scene['id'] for scene in group]
+
+def process_duplicate_groups_batch(client, duplicate_scenes, batch_size=25, journal=None):
+    """
+    Process duplicate groups in batches for efficient processing.
+    If a MergeJournal is given, groups it already has as merged/skipped are passed
+    over and every outcome is recorded as soon as it is known. batch_size=None
+    processes every pending group in one go.
     """
     if not duplicate_scenes:
         print("No duplicate scenes to process")
@@ -628,33 +841,37 @@ def process_duplicate_groups_batch(client, duplicate_scenes, batch_size=25):
     if isinstance(duplicate_scenes[0], list):
         # We have groups - process in batches
         total_groups = len(duplicate_scenes)
-        print(f"\n🎯 Processing {min(batch_size, total_groups)} of {total_groups} duplicate groups")
+        pending = journal.pending(duplicate_scenes) if journal else duplicate_scenes
+        to_process = pending if batch_size is None else pending[:batch_size]
+        if len(pending) < total_groups:
+            print(f"\n📒 Resuming: {total_groups - len(pending)} of {total_groups} groups already done according to the journal")
+        print(f"\n🎯 Processing {len(to_process)} of {len(pending)} pending duplicate groups")
         
-        processed_count = 0
-        successful_merges = 0
+        batcher = MutationBatcher(client, max_batch_size=MUTATION_BATCH_SIZE)
         
-        for i, group in enumerate(duplicate_scenes[:batch_size], 1):
-            print(f"\n{'='*60}")
-            print(f"📦 BATCH PROGRESS: {i}/{min(batch_size, total_groups)} groups")
-            print(f"🔄 Processing duplicate group {i} ({len(group)} scenes)")
-            
-            success = merge_duplicate_scenes(client, group)
-            processed_count += 1
-            if success:
-                successful_merges += 1
-            
-            # Small delay between merges to be gentle on the server
-            import time
-            time.sleep(DELAY_BETWEEN_MERGES)
+        with ParallelMergeExecutor(MERGE_WORKERS, MAX_MERGE_BACKOFF, client.metrics) as executor:
+            for i, group in enumerate(to_process, 1):
+                header = (f"\n{'='*60}\n"
+                          f"📦 BATCH PROGRESS: {i}/{len(to_process)} groups\n"
+                          f"🔄 Processing duplicate group {i} ({len(group)} scenes)")
+                executor.submit(group_scene_ids(group), merge_and_record, client, group, batcher, journal, header)
+        
+        # Send any primary-file updates still waiting in the batcher
+        batcher.flush()
         
+        outcomes = executor.results()
+        processed_count = len(outcomes)
+        successful_merges = sum(1 for success in outcomes if success)
+        
+        remaining = len(pending) - processed_count
         print(f"\n{'='*60}")
         print(f"📊 BATCH SUMMARY:")
         print(f"   ✅ Successfully merged: {successful_merges}/{processed_count} groups")
-        print(f"   📈 Remaining groups: {total_groups - processed_count}")
+        print(f"   📈 Remaining groups: {remaining}")
+        print_journal_counts(journal)
         
-        if total_groups > batch_size:
-            print(f"\n💡 To process the next batch, run the script again!")
-            print(f"   The script will automatically continue with the next {batch_size} groups.")
+        if remaining:
+            print_resume_hint(journal, batch_size)
         else:
             print(f"\n🎉 All duplicate groups have been processed!")
             
@@ -663,43 +880,396 @@ def process_duplicate_groups_batch(client, duplicate_scenes, batch_size=25):
         print(f"\n🎯 Processing duplicate scenes ({len(duplicate_scenes)} scenes)")
         merge_duplicate_scenes(client, duplicate_scenes)
 
+def print_journal_counts(journal):
+    if journal:
+        counts = journal.counts()
+        print(f"   📒 Journaled this run: {counts[MERGED]} merged, {counts[SKIPPED]} skipped, {counts[FAILED]} failed")
+
+def print_resume_hint(journal, batch_size, cached=True):
+    """How the next run carries on; `cached` is False when DUPLICATES_FILE was not (completely) written"""
+    print(f"\n💡 To process the next batch, run the script again!")
+    if journal and RESUME and cached:
+        print(f"   It will pick up from {MERGE_JOURNAL_FILE} without querying for duplicates again.")
+    elif journal:
+        print(f"   It will query for duplicates again and skip the groups {MERGE_JOURNAL_FILE} has as done.")
+    else:
+        print(f"   The script will automatically continue with the next {batch_size} groups.")
+
+def process_duplicate_group_stream(client, groups, batch_size=25, journal=None, report=None):
+    """
+    Streaming counterpart of process_duplicate_groups_batch(): each group is written
+    to the report and merged (up to batch_size merges) as soon as it is decoded, so
+    only one group is held in memory at a time. The stream is always read to the end
+    so the report lists every group. If the stream breaks off, the merges already
+    submitted are finished (and journaled) before the error is raised.
+    """
+    seen = 0
+    processed_count = 0
+    already_done = 0
+    batcher = MutationBatcher(client, max_batch_size=MUTATION_BATCH_SIZE)
+    
+    try:
+        with ParallelMergeExecutor(MERGE_WORKERS, MAX_MERGE_BACKOFF, client.metrics) as executor:
+            for group in groups:
+                seen += 1
+                if report:
+                    report.write(group)
+                if journal and journal.is_done(group):
+                    already_done += 1
+                    continue
+                if batch_size is not None and processed_count >= batch_size:
+                    continue
+                
+                processed_count += 1
+                header = (f"\n{'='*60}\n"
+                          f"📦 STREAM PROGRESS: group {seen} ({len(group)} scenes), merge {processed_count}"
+                          f"{f'/{batch_size}' if batch_size else ''}")
+                executor.submit(group_scene_ids(group), merge_and_record, client, group, batcher, journal, header)
+    finally:
+        # Primary-file updates for merges that did finish still have to be sent
+        batcher.flush()
+    
+    successful_merges = sum(1 for success in executor.results() if success)
+    
+    remaining = seen - already_done - processed_count
+    print(f"\n{'='*60}")
+    print(f"📊 STREAM SUMMARY:")
+    print(f"   🔎 Duplicate groups received: {seen}")
+    print(f"   ✅ Successfully merged: {successful_merges}/{processed_count} groups")
+    if already_done:
+        print(f"   📒 Already done according to the journal: {already_done}")
+    print(f"   📈 Remaining groups: {remaining}")
+    print_journal_counts(journal)
+    if not seen:
+        print("No duplicate scenes found!")
+    elif not remaining:
+        print(f"\n🎉 All duplicate groups have been processed!")
+
+def stream_and_process_duplicates(client, journal):
+    """
+    Stream findDuplicateScenes, merging groups and writing DUPLICATES_FILE as they arrive.
+    Returns False if the query failed or the stream broke off; merges finished
+    before that are in the journal and are skipped by the next run.
+    """
+    print(f"   🌊 Streaming duplicate groups as they arrive")
+    try:
+        with journal, GroupCacheWriter(DUPLICATES_FILE) as report:
+            process_duplicate_group_stream(client, client.stream_duplicate_scenes(PHASH_DISTANCE),
+                                           batch_size=BATCH_SIZE, journal=journal, report=report)
+    except (StreamingResponseError, ValueError) + TRANSIENT_ERRORS as e:
+        print(f"Error: {e}")
+        # A cache from an earlier query no longer describes what the journal records
+        if os.path.exists(DUPLICATES_FILE):
+            os.remove(DUPLICATES_FILE)
+        print_journal_counts(journal)
+        print_resume_hint(journal, BATCH_SIZE, cached=False)
+        return False
+    
+    if report.count:
+        print(f"\nDuplicate scenes saved to '{DUPLICATES_FILE}'")
+    return True
+
+def plan_all_merges(duplicate_groups, engine):
+    """Decide destination, sources and primary file for every group with the selected engine"""
+    if engine == 'numpy':
+        try:
+            from stashstuff.scoring_numpy import plan_merges
+        except ImportError:
+            print("⚠️  numpy is not installed, planning with the python engine instead (pip install numpy)")
+        else:
+            return plan_merges(duplicate_groups, SCORING_WEIGHTS)
+    return [scoring_engine.plan(group) for group in duplicate_groups]
+
+def write_merge_plan(duplicate_groups, path):
+    """
+    Score every group (without touching the server) and write the resulting merge
+    plan, sorted by destination scene, one JSON object per line
+    """
+    start = time.perf_counter()
+    plan = plan_all_merges(duplicate_groups, SCORING_ENGINE)
+    for entry, group in zip(plan, duplicate_groups):
+        if DELETE_DUPLICATE_FILES:
+            add_file_deletions(entry, group)
+        else:
+            entry['delete_files'] = []
+    plan_seconds = time.perf_counter() - start
+    
+    write_plan(path, plan)
+    
+    scenes_merged = sum(len(entry['sources']) for entry in plan)
+    files_deleted = sum(len(entry['delete_files']) for entry in plan)
+    print(f"\n📝 MERGE PLAN ({SCORING_ENGINE} engine, {plan_seconds:.2f}s):")
+    print(f"   📦 Groups: {len(plan)}")
+    print(f"   🔄 Scenes that would be merged away: {scenes_merged}")
+    print(f"   🗑️  Files that would be deleted: {files_deleted}")
+    print(f"   💾 Plan written to '{path}' - nothing was changed on the server")
+    print(f"   ▶️  Review it, then set EXECUTE_PLAN = True to apply it")
+
+def apply_plan_entry(client, entry, batcher, journal=None):
+    """
+    Apply one planned merge: sceneMerge (which also sets the planned primary file),
+    then the batched deletion of the planned files. With MERGE_PRIMARY_IN_VALUES off
+    the primary is set by a batched sceneUpdate first and files are deleted after it.
+    Returns True if the merge succeeded.
+    """
+    destination = entry['destination']
+    primary_file = entry.get('primary_file')
+    print(f"\n🔄 Merging {', '.join(entry['sources'])} into scene {destination}")
+    merge_result = client.merge_scenes(entry['sources'], destination,
+                                       primary_file if MERGE_PRIMARY_IN_VALUES else None)
+    
+    if 'errors' in merge_result or not (merge_result.get('data') or {}).get('sceneMerge'):
+        print(f"   ❌ Error during merge: {merge_result.get('errors', 'no result returned')}")
+        client.metrics.count('groups_not_merged')
+        if journal:
+            journal.record(plan_group_key(entry), FAILED)
+        return False
+    print(f"   ✅ Merged into scene {destination}")
+    client.metrics.count('groups_merged')
+    if journal:
+        journal.record(plan_group_key(entry), MERGED)
+    
+    files = merge_result['data']['sceneMerge'].get('files') or []
+    delete_files = [file_id for file_id in entry.get('delete_files') or () if file_id != primary_file]
+    
+    def queue_deletions():
+        if delete_files:
+            batcher.add('deleteFiles', {'ids': ('[ID!]!', delete_files)},
+                        callback=lambda result: report_file_deletions(destination, delete_files, result),
+                        verify=lambda: verify_files_deleted(client, destination, delete_files))
+    
+    if MERGE_PRIMARY_IN_VALUES and primary_file and files and files[0].get('id') != primary_file:
+        # Never delete files unless the planned primary is confirmed in place
+        print(f"   ⚠️  Warning: file {primary_file} is not primary after the merge - not deleting any files")
+    elif primary_file and files and files[0].get('id') != primary_file and not MERGE_PRIMARY_IN_VALUES:
+        def on_primary_set(result):
+            report_primary_file_result(destination, result)
+            if 'errors' not in result:
+                queue_deletions()
+        batcher.add('sceneUpdate',
+                    {'input': ('SceneUpdateInput!', {'id': destination, 'primary_file_id': primary_file})},
+                    selection='id', callback=on_primary_set)
+    else:
+        queue_deletions()
+    return True
+
+def verify_files_deleted(client, scene_id, file_ids):
+    """
+    Check a batched deleteFiles whose batch could not confirm it: its result if
+    none of the files are left on the scene, None if they all are (send it again)
+    """
+    result = client.find_scenes_by_ids([scene_id])
+    if 'errors' in result:
+        return result
+    remaining = {f['id'] for scene in result['data']['findScenes']['scenes'] for f in scene.get('files') or []}
+    left = [file_id for file_id in file_ids if file_id in remaining]
+    if not left:
+        return {'data': {'deleteFiles': True}}
+    if len(left) == len(file_ids):
+        return None
+    return {'errors': [{'message': f"files {', '.join(left)} are still on scene {scene_id}"}]}
+
+def report_file_deletions(scene_id, file_ids, result):
+    """
+    Print the outcome of deleting a merged scene's duplicate files
+    """
+    if 'errors' not in result:
+        print(f"   🗑️  Deleted {len(file_ids)} duplicate file(s) from scene {scene_id}")
+    else:
+        print(f"   ⚠️  Warning: Could not delete files {', '.join(file_ids)} from scene {scene_id}: {result['errors']}")
+
+def execute_merge_plan(client, path, journal=None):
+    """
+    Apply a plan written by write_merge_plan(). Nothing is fetched or re-scored;
+    entries the journal already has as merged are skipped, the rest are merged in
+    parallel (MERGE_WORKERS) with follow-up mutations batched.
+    """
+    if not os.path.exists(path):
+        print(f"❌ No merge plan at '{path}' - run with PLAN_ONLY = True first")
+        return
+    
+    print(f"\n▶️  Executing merge plan '{path}'")
+    batcher = MutationBatcher(client, max_batch_size=MUTATION_BATCH_SIZE)
+    skipped = 0
+    with ParallelMergeExecutor(MERGE_WORKERS, MAX_MERGE_BACKOFF, client.metrics) as executor:
+        for entry in iter_plan(path):
+            if journal and journal.is_done(plan_group_key(entry)):
+                skipped += 1
+                continue
+            executor.submit(plan_group_key(entry), apply_plan_entry, client, entry, batcher, journal)
+    batcher.flush()
+    
+    outcomes = executor.results()
+    print(f"\n{'='*60}")
+    print(f"📊 PLAN SUMMARY:")
+    print(f"   ✅ Successfully merged: {sum(1 for ok in outcomes if ok)}/{len(outcomes)} groups")
+    if skipped:
+        print(f"   📒 Already merged according to the journal: {skipped}")
+    print(f"   📨 Follow-up mutation requests: {batcher.requests_sent} ({batcher.mutations_sent} mutations)")
+
+def preflight_duplicate_groups(duplicate_groups):
+    """
+    Stat every file of every group on disk in one pass. Groups with a file that is
+    missing or whose size differs from what Stash reports are left out (the server's
+    view is stale - rescan first). Groups linked by byte-identical copies (same size
+    and head/tail hash) are merged into one, whatever their phash distance.
+    """
+    files = [file_info for group in duplicate_groups for scene in group for file_info in scene.get('files') or ()]
+    print(f"\n🩺 Preflight: checking {len(files)} files on disk...")
+    start = time.perf_counter()
+    checks = preflight(files, prefix_map=LIBRARY_PATH_MAP, workers=PREFLIGHT_WORKERS)
+    elapsed = time.perf_counter() - start
+    
+    verified = []
+    for group in duplicate_groups:
+        bad = [checks[f.get('id')] for scene in group for f in scene.get('files') or ()
+               if f.get('id') in checks and not checks[f.get('id')].ok]
+        if bad:
+            check = bad[0]
+            reason = check.error or ('missing' if not check.exists else f"size {check.size} != {check.expected_size}")
+            print(f"   ⚠️  Skipping group {', '.join(scene['id'] for scene in group)}: {check.local_path} {reason}")
+            continue
+        verified.append(group)
+    
+    print(f"   ✅ {len(verified)}/{len(duplicate_groups)} groups verified on disk in {elapsed:.1f}s")
+    merged = merge_identical_groups(verified, identical_file_groups(checks.values()))
+    if len(merged) < len(verified):
+        print(f"   🧬 Merged {len(verified)} groups into {len(merged)}: "
+              f"byte-identical copies (same size and head/tail hash) link them")
+    return merged
+
+def merge_identical_groups(duplicate_groups, identical):
+    """
+    Join duplicate groups that share byte-identical copies of a file (lists of
+    FileChecks from identical_file_groups()). Groups keep their order, each merged
+    group taking the place of its first member.
+    """
+    group_of_file = {file_info.get('id'): i for i, group in enumerate(duplicate_groups)
+                     for scene in group for file_info in scene.get('files') or ()}
+    links = UnionFind()
+    for i in range(len(duplicate_groups)):
+        links.find(i)
+    for same in identical:
+        indexes = [group_of_file[check.file_id] for check in same if check.file_id in group_of_file]
+        for index in indexes[1:]:
+            links.union(indexes[0], index)
+    
+    merged = {}
+    for i, group in enumerate(duplicate_groups):
+        scenes = merged.setdefault(links.find(i), {})
+        for scene in group:
+            scenes.setdefault(scene['id'], scene)
+    return [list(scenes.values()) for scenes in merged.values()]
+
+def journal_settings():
+    """The settings that decide which duplicate groups a run finds (stored in the journal header)"""
+    return {'phash_distance': PHASH_DISTANCE, 'query_profile': QUERY_PROFILE}
+
+def load_resumable_groups(journal):
+    """
+    The cached group list from the previous run, if RESUME is on and some of its
+    groups have not been attempted yet. Otherwise None (query afresh) - groups that
+    keep failing are retried against fresh data rather than pinning us to the cache.
+    The cache is only trusted while the journal was written with the same settings.
+    """
+    if not RESUME or not journal.matches:
+        return None
+    groups = load_group_cache(DUPLICATES_FILE)
+    if not groups or not journal.unattempted(groups):
+        return None
+    return groups
+
 def main():
+    global scoring_engine
+    if QUERY_PROFILE not in DUPLICATE_SCENE_FRAGMENTS:
+        raise ValueError(f"QUERY_PROFILE must be one of {', '.join(DUPLICATE_SCENE_FRAGMENTS)}, got {QUERY_PROFILE!r}")
+    scoring_engine = ScoringEngine(SCORING_WEIGHTS)
+    
     # Configure your Stashapp connection using the settings above
     client = StashAppClient(
         base_url=STASH_URL,
-        api_key=API_KEY
+        api_key=API_KEY,
+        query_profile=QUERY_PROFILE,
+        pool_maxsize=CONNECTION_POOL_SIZE,
+        max_requests_per_second=MAX_REQUESTS_PER_SECOND,
+        max_retries=MAX_RETRIES,
+        timeouts=OPERATION_TIMEOUTS,
+        metrics=RunMetrics('find-phash-dupes')
     )
+    journal = MergeJournal(MERGE_JOURNAL_FILE, settings=journal_settings())
     
+    try:
+        with profile_run(PROFILE, client.metrics, PROFILE_FILE):
+            find_and_merge_duplicates(client, journal)
+    finally:
+        client.print_latency_report()
+        client.write_metrics(METRICS_FILE)
+
+def find_and_merge_duplicates(client, journal):
+    """Everything main() does once the client is set up, with each step timed as a phase"""
     print(f"🔍 Finding duplicate scenes using Stash's built-in duplicate detection")
     print(f"   📡 Server: {STASH_URL}")
     print(f"   🎯 Distance: {PHASH_DISTANCE} ({'exact match' if PHASH_DISTANCE == 0 else 'tolerant matching'})")
-    print(f"   📦 Batch size: {BATCH_SIZE} groups per run")
+    print(f"   📦 Batch size: {BATCH_SIZE or 'all'} groups per run")
+    print(f"   🧾 Query profile: {QUERY_PROFILE}")
     
-    result = client.find_duplicate_scenes(PHASH_DISTANCE)
+    if MEASURE_QUERY_PROFILES:
+        measure_query_profiles(client, PHASH_DISTANCE)
     
-    if 'errors' in result:
-        print(f"Error: {result['errors']}")
+    if EXECUTE_PLAN:
+        with journal, client.metrics.phase('execute_plan'):
+            execute_merge_plan(client, MERGE_PLAN_FILE, journal)
         return
     
-    duplicate_scenes = result['data']['findDuplicateScenes']
+    duplicate_scenes = load_resumable_groups(journal)
+    if duplicate_scenes is not None:
+        print(f"   📒 Resuming from '{DUPLICATES_FILE}' and '{MERGE_JOURNAL_FILE}' (set RESUME = False to re-query)")
+    elif STREAM_DUPLICATES and not (USE_LOCAL_PHASH_INDEX or INCREMENTAL or PLAN_ONLY or PREFLIGHT_FILES):
+        with client.metrics.phase('stream_and_merge'):
+            if not stream_and_process_duplicates(client, journal):
+                return
+    else:
+        with client.metrics.phase('find_duplicates'):
+            if USE_LOCAL_PHASH_INDEX or INCREMENTAL:
+                print(f"   🗂️  Using local phash index ({PHASH_INDEX_FILE})")
+                result = find_duplicate_scenes_locally(client, PHASH_DISTANCE)
+            else:
+                result = client.find_duplicate_scenes(PHASH_DISTANCE)
+        
+        if 'errors' in result:
+            print(f"Error: {result['errors']}")
+            return
+        
+        duplicate_scenes = result['data']['findDuplicateScenes']
+        
+        # Save results before merging so an interrupted run can resume from them
+        if duplicate_scenes:
+            save_group_cache(DUPLICATES_FILE, duplicate_scenes)
+            print(f"\nDuplicate scenes saved to '{DUPLICATES_FILE}'")
+    
+    if duplicate_scenes and PREFLIGHT_FILES:
+        with client.metrics.phase('preflight'):
+            duplicate_scenes = preflight_duplicate_groups(duplicate_scenes)
     
-    display_duplicate_scenes(duplicate_scenes)
+    if duplicate_scenes is not None and PLAN_ONLY:
+        with client.metrics.phase('plan'):
+            write_merge_plan(duplicate_scenes, MERGE_PLAN_FILE)
+        return
     
-    # Process duplicate groups in batches for merging
-    if duplicate_scenes:
-        process_duplicate_groups_batch(client, duplicate_scenes, batch_size=BATCH_SIZE)
+    if duplicate_scenes is not None:
+        with client.metrics.phase('display'):
+            display_duplicate_scenes(duplicate_scenes)
     
-    # Save results to file for further analysis
+    # Process duplicate groups in batches for merging (the streaming path already has)
     if duplicate_scenes:
-        with open('phash_duplicates.json', 'w') as f:
-            json.dump(duplicate_scenes, f, indent=2, default=str)
-        
-        print(f"\nDuplicate scenes saved to 'phash_duplicates.json'")
+        with journal, client.metrics.phase('merge'):
+            process_duplicate_groups_batch(client, duplicate_scenes, batch_size=BATCH_SIZE, journal=journal)
     
     print(f"\n💡 TIPS:")
-    print(f"   • To process more batches, simply run the script again")
+    print(f"   • To process more batches, simply run the script again - it resumes from {MERGE_JOURNAL_FILE}")
+    print(f"   • Set BATCH_SIZE = None to process every remaining group in one run")
     print(f"   • To find more similar scenes, change PHASH_DISTANCE from {PHASH_DISTANCE} to 4 at the top of the script")
-    print(f"   • Each run processes {BATCH_SIZE} groups (configurable via BATCH_SIZE)")
+    print(f"   • Each run processes {BATCH_SIZE or 'all'} groups (configurable via BATCH_SIZE)")
     print(f"   • Modify STASH_URL and API_KEY at the top for different Stash instances")
 
 if __name__ == "__main__":
@@ -0,0 +1,4 @@
+from stashstuff.cli import main
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+asyncio GraphQL transport for running many Stash operations at once.
+
+Built on aiohttp (optional - only needed for the async modes, and only
+imported when a client is created, since importing it is slow). In-flight
+requests are capped by a semaphore and paced by the same adaptive token
+bucket as the blocking client (stashstuff/ratelimit.py), with the
+requests-per-second budget as its ceiling, so we can keep the server busy
+without flooding it. Timeouts, retries and the circuit breaker follow the
+blocking client's rules (stashstuff/resilience.py): queries are retried with
+jittered backoff, mutations only when the server never saw them, and a 4xx
+with an unreadable body is returned as an error rather than retried. Pass the
+blocking client's CircuitBreaker and RunMetrics to share its view of the
+server's health and fold these requests into the same end-of-run summary.
+"""
+
+import asyncio
+import importlib.util
+import json
+import time
+from typing import Dict, Optional
+
+from stashstuff.client import LatencyStats, operation_name
+from stashstuff.metrics import RunMetrics
+from stashstuff.ratelimit import AdaptiveRateLimiter, is_overload_status
+from stashstuff.resilience import (DEFAULT_CONNECT_TIMEOUT, DEFAULT_MAX_RETRIES, DEFAULT_MUTATION_TIMEOUT,
+                                   DEFAULT_QUERY_TIMEOUT, OPERATION_TIMEOUTS, CircuitBreaker,
+                                   TransientResponseError, backoff_delay, error_result, is_mutation)
+
+aiohttp = None  # Imported by _require_aiohttp()
+
+
+def _require_aiohttp():
+    global aiohttp
+    if aiohttp is None:
+        try:
+            import aiohttp as module
+        except ImportError:  # pragma: no cover - optional dependency
+            raise ImportError("aiohttp is required for async mode. Install it with: pip install aiohttp") from None
+        aiohttp = module
+    return aiohttp
+
+
+def aiohttp_available() -> bool:
+    """True if aiohttp can be imported (checked without importing it)"""
+    return aiohttp is not None or importlib.util.find_spec('aiohttp') is not None
+
+# ====== CONFIGURATION ======
+DEFAULT_CONCURRENCY = 8          # Max requests in flight at once
+DEFAULT_REQUESTS_PER_SECOND = 0  # Request budget (0 = unlimited)
+
+
+class AsyncStashGraphQLClient:
+    """
+    aiohttp-based GraphQL client. Use it as an async context manager:
+
+        async with AsyncStashGraphQLClient(url, key, concurrency=16) as client:
+            result = await client.execute_query(query, variables)
+    """
+
+    def __init__(self, base_url: str, api_key: str,
+                 concurrency: int = DEFAULT_CONCURRENCY,
+                 requests_per_second: float = DEFAULT_REQUESTS_PER_SECOND,
+                 max_retries: int = DEFAULT_MAX_RETRIES,
+                 timeouts: Optional[Dict[str, float]] = None,
+                 breaker: Optional[CircuitBreaker] = None,
+                 metrics: Optional[RunMetrics] = None):
+        _require_aiohttp()
+
+        self.base_url = base_url
+        self.graphql_url = f"{base_url}/graphql"
+        self.headers = {
+            'Content-Type': 'application/json',
+            'Accept-Encoding': 'gzip, deflate',
+            'ApiKey': api_key
+        }
+        self.concurrency = max(1, concurrency)
+        self.requests_per_second = requests_per_second
+        self.session = None
+        self.semaphore = None
+        self.limiter = AdaptiveRateLimiter(max_rate=requests_per_second)
+        self.max_retries = max(0, max_retries)
+        # Read timeouts by operation name, on top of OPERATION_TIMEOUTS
+        self.timeouts = {**OPERATION_TIMEOUTS, **(timeouts or {})}
+        self.breaker = breaker or CircuitBreaker()
+        self.retries = 0
+        self.stats = LatencyStats()
+        self.metrics = metrics or RunMetrics()
+
+    async def __aenter__(self):
+        # asyncio primitives must be created inside the running loop
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        self.session = aiohttp.ClientSession(headers=self.headers, connector=connector)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.session.close()
+
+    async def execute_query(self, query: str, variables: Optional[Dict] = None) -> Dict:
+        """POST a GraphQL document and return the decoded JSON response"""
+        payload = {'query': query}
+        if variables:
+            payload['variables'] = variables
+        body = json.dumps(payload).encode('utf-8')
+
+        name = operation_name(query)
+        mutation = is_mutation(query)
+        read_timeout = self.timeouts.get(name, DEFAULT_MUTATION_TIMEOUT if mutation else DEFAULT_QUERY_TIMEOUT)
+        timeout = aiohttp.ClientTimeout(sock_connect=DEFAULT_CONNECT_TIMEOUT, sock_read=read_timeout)
+        attempt = 0
+        while True:
+            paused_at = time.perf_counter()
+            async with self.breaker.async_attempt() as paused:
+                if paused:
+                    self.metrics.add_time('breaker_pause', time.perf_counter() - paused_at)
+                delay = self.limiter.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    self.metrics.add_time('rate_limit_wait', delay)
+                start = None
+                recorded = False
+                try:
+                    async with self.semaphore:
+                        start = time.perf_counter()
+                        async with self.session.post(self.graphql_url, data=body, timeout=timeout) as response:
+                            self.limiter.observe(name, time.perf_counter() - start, response.status,
+                                                 response.headers.get('Retry-After'))
+                            if is_overload_status(response.status):
+                                raise TransientResponseError(f"HTTP {response.status} from {name}", response.status)
+                            content = await response.read()
+                        elapsed = time.perf_counter() - start
+                        self.metrics.add_time('network', elapsed)
+                        self.metrics.record_request(name, elapsed, len(body), len(content), mutation=mutation)
+                        recorded = True
+                        try:
+                            with self.metrics.phase('json_parse'):
+                                result = json.loads(content)
+                        except ValueError:
+                            if response.status >= 400:
+                                # A client error is not going to get better by retrying
+                                self.breaker.record_success()
+                                text = content[:200].decode('utf-8', 'replace')
+                                return error_result(f"HTTP {response.status} from {name}: {text}")
+                            raise TransientResponseError(f"Unreadable response from {name}", response.status)
+                        self.stats.record(name, time.perf_counter() - start)
+                    self.breaker.record_success()
+                    return result
+                except (aiohttp.ClientError, asyncio.TimeoutError, TransientResponseError) as e:
+                    self.breaker.record_failure(e)
+                    error = e
+                    if start is not None and not recorded:
+                        self.metrics.record_request(name, time.perf_counter() - start, len(body), mutation=mutation,
+                                                    failed=True)
+
+            # Attempts that had to wait for the breaker were server outages, not this request's fault
+            if not paused:
+                attempt += 1
+            # The server never saw the request if we couldn't connect or it turned us away
+            not_processed = (isinstance(error, aiohttp.ClientConnectorError)
+                             or getattr(error, 'status', None) in (429, 503))
+            if mutation and not not_processed:
+                return error_result(f"{name} may not have completed ({error!r}); not retrying a mutation")
+            if attempt > self.max_retries:
+                return error_result(f"{name} failed after {attempt} attempts: {error!r}")
+            self.retries += 1
+            self.metrics.count('retries')
+            delay = backoff_delay(max(attempt, 1))
+            await asyncio.sleep(delay)
+            self.metrics.add_time('retry_backoff', delay)
+
+    def print_latency_report(self):
+        """Print a per-operation latency table for this run"""
+        self.stats.print_report()
@@ -0,0 +1,327 @@
+"""
+Aliased multi-operation batching for GraphQL mutations.
+
+Instead of one HTTP request per sceneMarkerDestroy / sceneUpdate / deleteFiles,
+queued mutations are packed into a single document using field aliases:
+
+    mutation BatchSceneMarkerDestroy($m1_id: ID!, $m2_id: ID!) {
+      m1: sceneMarkerDestroy(id: $m1_id)
+      m2: sceneMarkerDestroy(id: $m2_id)
+    }
+
+Each alias' result (or error) is handed back to whoever queued it, shaped like
+a normal single-mutation response ({'data': {field: ...}} or {'errors': [...]})
+so existing "if 'errors' in result" checks keep working. AsyncMutationBatcher
+does the same for AsyncStashGraphQLClient.
+
+When an alias of a non-null field (sceneMarkerDestroy, deleteFiles: Boolean!)
+fails, the server nulls the whole data object, so the other aliases ran but
+their results are lost. Those mutations are settled before their callbacks
+run: with the mutation's `verify` if it has one (like execute_query's), and
+otherwise by sending the mutation again on its own.
+"""
+
+import asyncio
+import inspect
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# ====== CONFIGURATION ======
+DEFAULT_MAX_BATCH_SIZE = 50   # Mutations per GraphQL document
+DEFAULT_MAX_DELAY = 2.0       # Seconds a queued mutation may wait before a flush
+
+
+class BatchedMutation:
+    """A queued mutation; `response` is filled in once its batch is flushed"""
+
+    __slots__ = ('field', 'arguments', 'selection', 'callback', 'verify', 'response')
+
+    def __init__(self, field: str, arguments: Dict[str, Tuple[str, Any]],
+                 selection: str = '', callback: Optional[Callable[[Dict], None]] = None,
+                 verify: Optional[Callable[[], Any]] = None):
+        self.field = field
+        self.arguments = arguments
+        self.selection = selection
+        self.callback = callback
+        self.verify = verify
+        self.response: Optional[Dict] = None
+
+    @property
+    def done(self) -> bool:
+        return self.response is not None
+
+    @property
+    def ok(self) -> bool:
+        return self.done and 'errors' not in self.response
+
+
+def build_batch_document(mutations: List[BatchedMutation]) -> Tuple[str, Dict[str, Any]]:
+    """Build one aliased mutation document (and its variables) for a list of mutations"""
+    declarations = []
+    fields = []
+    variables = {}
+
+    for index, mutation in enumerate(mutations, 1):
+        alias = f"m{index}"
+        call_args = []
+        for arg_name, (arg_type, value) in mutation.arguments.items():
+            var_name = f"{alias}_{arg_name}"
+            declarations.append(f"${var_name}: {arg_type}")
+            call_args.append(f"{arg_name}: ${var_name}")
+            variables[var_name] = value
+
+        call = f"{alias}: {mutation.field}"
+        if call_args:
+            call += f"({', '.join(call_args)})"
+        if mutation.selection:
+            call += f" {{ {mutation.selection} }}"
+        fields.append(call)
+
+    field_names = {m.field for m in mutations}
+    if len(field_names) == 1:
+        name = next(iter(field_names))
+        operation = f"Batch{name[0].upper()}{name[1:]}"
+    else:
+        operation = "BatchMutations"
+
+    header = f"mutation {operation}"
+    if declarations:
+        header += f"({', '.join(declarations)})"
+    document = header + " {\n  " + "\n  ".join(fields) + "\n}"
+    return document, variables
+
+
+class MutationBatcher:
+    """
+    Collects mutations and sends them as aliased batches.
+
+    A batch is flushed when it reaches max_batch_size, when the oldest queued
+    mutation has waited longer than max_delay (checked whenever something is
+    queued or poll() is called), or when flush() is called explicitly. Callbacks
+    may queue further mutations (e.g. delete a file once its primary-file update
+    succeeded); flush() keeps draining until nothing is pending.
+
+    Safe to share between threads: queueing and flushing are serialized.
+    """
+
+    def __init__(self, client, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 max_delay: float = DEFAULT_MAX_DELAY):
+        self.client = client
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_delay = max_delay
+        self.pending: List[BatchedMutation] = []
+        self.oldest_queued_at: Optional[float] = None
+        self.requests_sent = 0
+        self.mutations_sent = 0
+        self._flushing = False
+        self._lock = threading.RLock()
+
+    def add(self, field: str, arguments: Dict[str, Tuple[str, Any]], selection: str = '',
+            callback: Optional[Callable[[Dict], None]] = None,
+            verify: Optional[Callable[[], Optional[Dict]]] = None) -> BatchedMutation:
+        """
+        Queue a mutation. arguments maps argument name -> (GraphQL type, value),
+        e.g. {'id': ('ID!', marker_id)} or {'ids': ('[ID!]!', file_ids)}.
+        If the batch can't confirm the mutation, verify() is asked: it returns
+        the mutation's result if it was applied, or None to have it sent again.
+        Mutations that are not safe to repeat should pass one.
+        """
+        mutation = BatchedMutation(field, arguments, selection, callback, verify)
+        with self._lock:
+            if not self.pending:
+                self.oldest_queued_at = time.monotonic()
+            self.pending.append(mutation)
+
+            if not self._flushing:
+                if len(self.pending) >= self.max_batch_size:
+                    self.flush()
+                else:
+                    self.poll()
+        return mutation
+
+    def poll(self):
+        """Flush if the oldest queued mutation has waited longer than max_delay"""
+        with self._lock:
+            if (self.pending and not self._flushing and self.oldest_queued_at is not None
+                    and time.monotonic() - self.oldest_queued_at >= self.max_delay):
+                self.flush()
+
+    def flush(self):
+        """Send everything that is queued, including mutations queued by callbacks"""
+        with self._lock:
+            if self._flushing:
+                return
+            self._flushing = True
+            try:
+                while self.pending:
+                    batch = self.pending[:self.max_batch_size]
+                    self.pending = self.pending[self.max_batch_size:]
+                    self._send(batch)
+                self.oldest_queued_at = None
+            finally:
+                self._flushing = False
+
+    def _send(self, batch: List[BatchedMutation]):
+        document, variables = build_batch_document(batch)
+        try:
+            result = self.client.execute_query(document, variables)
+        except Exception as e:
+            result = {'errors': [{'message': f"batch request failed: {e}"}]}
+
+        self.requests_sent += 1
+        self.mutations_sent += len(batch)
+
+        for mutation, response in zip(batch, split_batch_response(batch, result)):
+            if is_unconfirmed(response):
+                response = self._confirm(mutation)
+            mutation.response = response
+            if mutation.callback:
+                mutation.callback(response)
+
+    def _confirm(self, mutation: BatchedMutation) -> Dict:
+        """Settle a mutation whose batch response was nulled by a failing sibling"""
+        if mutation.verify is not None:
+            applied = mutation.verify()
+            if applied is not None:
+                return applied
+        document, variables = build_batch_document([mutation])
+        try:
+            result = self.client.execute_query(document, variables)
+        except Exception as e:
+            result = {'errors': [{'message': f"request failed: {e}"}]}
+        self.requests_sent += 1
+        return split_batch_response([mutation], result)[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+
+
+class AsyncMutationBatcher:
+    """
+    MutationBatcher for AsyncStashGraphQLClient. add() is a plain call, so
+    tasks queue mutations without waiting for them; full batches (or one
+    whose oldest mutation has waited max_delay) are sent in the background,
+    several at once if the client's concurrency allows. Callbacks run on the
+    event loop when their batch returns. flush() sends what is left and
+    waits for every batch, including ones queued by callbacks.
+    """
+
+    def __init__(self, client, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+                 max_delay: float = DEFAULT_MAX_DELAY):
+        self.client = client
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_delay = max_delay
+        self.pending: List[BatchedMutation] = []
+        self.oldest_queued_at: Optional[float] = None
+        self.requests_sent = 0
+        self.mutations_sent = 0
+        self._in_flight: List[asyncio.Future] = []
+
+    def add(self, field: str, arguments: Dict[str, Tuple[str, Any]], selection: str = '',
+            callback: Optional[Callable[[Dict], None]] = None,
+            verify: Optional[Callable[[], Any]] = None) -> BatchedMutation:
+        """
+        Queue a mutation (see MutationBatcher.add); must be called from the event
+        loop. verify may be a plain function or a coroutine function.
+        """
+        mutation = BatchedMutation(field, arguments, selection, callback, verify)
+        if not self.pending:
+            self.oldest_queued_at = time.monotonic()
+        self.pending.append(mutation)
+        if len(self.pending) >= self.max_batch_size:
+            self._send_pending()
+        else:
+            self.poll()
+        return mutation
+
+    def poll(self):
+        """Send the queued mutations if the oldest has waited longer than max_delay"""
+        if self.pending and time.monotonic() - self.oldest_queued_at >= self.max_delay:
+            self._send_pending()
+
+    def _send_pending(self):
+        while self.pending:
+            batch = self.pending[:self.max_batch_size]
+            self.pending = self.pending[self.max_batch_size:]
+            self._in_flight.append(asyncio.ensure_future(self._send(batch)))
+        self.oldest_queued_at = None
+
+    async def flush(self):
+        """Send everything that is queued and wait until every batch has returned"""
+        while self.pending or self._in_flight:
+            self._send_pending()
+            in_flight, self._in_flight = self._in_flight, []
+            await asyncio.gather(*in_flight)
+
+    async def _send(self, batch: List[BatchedMutation]):
+        document, variables = build_batch_document(batch)
+        try:
+            result = await self.client.execute_query(document, variables)
+        except Exception as e:
+            result = {'errors': [{'message': f"batch request failed: {e}"}]}
+
+        self.requests_sent += 1
+        self.mutations_sent += len(batch)
+
+        for mutation, response in zip(batch, split_batch_response(batch, result)):
+            if is_unconfirmed(response):
+                response = await self._confirm(mutation)
+            mutation.response = response
+            if mutation.callback:
+                mutation.callback(response)
+
+    async def _confirm(self, mutation: BatchedMutation) -> Dict:
+        """Async counterpart of MutationBatcher._confirm"""
+        if mutation.verify is not None:
+            applied = mutation.verify()
+            if inspect.isawaitable(applied):
+                applied = await applied
+            if applied is not None:
+                return applied
+        document, variables = build_batch_document([mutation])
+        try:
+            result = await self.client.execute_query(document, variables)
+        except Exception as e:
+            result = {'errors': [{'message': f"request failed: {e}"}]}
+        self.requests_sent += 1
+        return split_batch_response([mutation], result)[0]
+
+
+def is_unconfirmed(response: Dict) -> bool:
+    """True for a batched mutation that may or may not have run (see split_batch_response)"""
+    return bool(response.get('unconfirmed'))
+
+
+def split_batch_response(batch: List[BatchedMutation], result: Dict) -> List[Dict]:
+    """Map an aliased batch response back to one response per queued mutation"""
+    data = result.get('data') or {}
+    errors_by_alias: Dict[str, List[Dict]] = {}
+    global_errors = []
+
+    for error in result.get('errors') or []:
+        path = error.get('path') or []
+        if path and isinstance(path[0], str) and path[0].startswith('m'):
+            errors_by_alias.setdefault(path[0], []).append(error)
+        else:
+            global_errors.append(error)
+
+    responses = []
+    for index, mutation in enumerate(batch, 1):
+        alias = f"m{index}"
+        if alias in errors_by_alias:
+            responses.append({'errors': errors_by_alias[alias]})
+        elif alias in data:
+            responses.append({'data': {mutation.field: data[alias]}})
+        elif global_errors:
+            responses.append({'errors': global_errors})
+        else:
+            # A non-null sibling failed and nulled out the whole data object;
+            # this mutation may have run but we cannot confirm it. Still an
+            # error to "'errors' in result" checks, but marked so it can be settled.
+            responses.append({'errors': [{'message': 'no result returned for batched mutation'}],
+                              'unconfirmed': True})
+    return responses
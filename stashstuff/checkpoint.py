@@ -0,0 +1,208 @@
+"""
+Checkpoint journal for long merge runs.
+
+Every processed duplicate group is appended to a JSONL journal as soon as its
+outcome is known:
+
+    {"group": "101,205,311", "status": "merged", "destination": "205", "at": 1714060000.0}
+
+Each line is flushed and fsync'd before the next group starts, so after a
+crash (or Ctrl-C) the journal is at most one group behind. On the next run
+groups already journaled as merged or skipped are passed over; failed groups
+are tried again. A torn last line from a crash is ignored when loading.
+
+The first line records the settings that produced the groups:
+
+    {"settings": {"phash_distance": 4, "query_profile": "display-full"}, "at": 1714060000.0}
+
+A journal written with other settings describes other groups, so it is moved
+aside to <path>.old and a new one is started.
+
+The duplicate group list itself is cached next to the journal, so a resumed
+run can carry on without asking the server for duplicates again - but only
+while the journal's settings match.
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+MERGED = 'merged'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+# Outcomes that mean a group never needs to be looked at again
+FINAL_STATUSES = (MERGED, SKIPPED)
+
+
+def group_key(scenes: Iterable) -> str:
+    """Stable identity for a duplicate group: its sorted scene ids"""
+    ids = [scene['id'] if isinstance(scene, dict) else scene for scene in scenes]
+    return ','.join(sorted((str(scene_id) for scene_id in ids), key=int))
+
+
+class MergeJournal:
+    """
+    Append-only JSONL record of merged / skipped / failed duplicate groups.
+    `settings` (JSON-serialisable) identify the run that produced the groups;
+    an existing journal with different settings is discarded.
+    """
+
+    def __init__(self, path: str, settings: Optional[Dict] = None):
+        self.path = path
+        self.settings = settings
+        self.written_settings: Optional[Dict] = None  # From the journal's header line
+        # group key -> latest journal entry for that group
+        self.entries: Dict[str, Dict] = {}
+        # Outcomes recorded by this run only
+        self.run_counts: Dict[str, int] = {MERGED: 0, SKIPPED: 0, FAILED: 0}
+        self._file = None
+        self._lock = threading.Lock()
+        self._load()
+        if settings is not None and os.path.exists(path) and self.written_settings != settings:
+            self._discard()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # partially written line from an interrupted run
+                if 'group' in entry:
+                    self.entries[entry['group']] = entry
+                elif 'settings' in entry:
+                    self.written_settings = entry['settings']
+
+    def _discard(self):
+        old_path = f"{self.path}.old"
+        os.replace(self.path, old_path)
+        print(f"📒 {self.path} was written for {self.written_settings or 'unknown settings'}, not {self.settings}; "
+              f"moved it to {old_path} and starting a new journal")
+        self.entries = {}
+        self.written_settings = None
+
+    @property
+    def matches(self) -> bool:
+        """True if the journal on disk was written with this run's settings"""
+        return self.settings is None or self.written_settings == self.settings
+
+    def status(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        return entry['status'] if entry else None
+
+    def is_done(self, scenes) -> bool:
+        return self.status(group_key(scenes)) in FINAL_STATUSES
+
+    def pending(self, groups: List[List]) -> List[List]:
+        """The groups that still need processing, in their original order"""
+        return [group for group in groups if not self.is_done(group)]
+
+    def unattempted(self, groups: List[List]) -> List[List]:
+        """The groups the journal has no outcome for at all"""
+        return [group for group in groups if group_key(group) not in self.entries]
+
+    def record(self, scenes, status: str, **details):
+        """Append an outcome and make sure it is on disk before returning"""
+        entry = {'group': group_key(scenes), 'status': status, **details, 'at': round(time.time(), 3)}
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+                if self.settings is not None and self._file.tell() == 0:
+                    header = {'settings': self.settings, 'at': entry['at']}
+                    self._file.write(json.dumps(header, separators=(',', ':')) + '\n')
+                    self.written_settings = self.settings
+            self._file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.entries[entry['group']] = entry
+            self.run_counts[status] = self.run_counts.get(status, 0) + 1
+
+    def counts(self) -> Dict[str, int]:
+        """Outcomes recorded during this run (earlier runs' entries are not counted)"""
+        with self._lock:
+            return dict(self.run_counts)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def save_group_cache(path: str, groups: List[List]):
+    """Write the duplicate group list atomically so a crash never leaves half a file"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(groups, f, indent=2, default=str)
+    os.replace(tmp_path, path)
+
+
+class GroupCacheWriter:
+    """
+    Writes the duplicate group list one group at a time while groups are still
+    streaming in. The file is a normal JSON list; it only replaces the previous
+    cache once close() is called, so an interrupted stream never leaves a
+    truncated cache behind.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.count = 0
+        self._file = open(self.tmp_path, 'w')
+        self._file.write('[')
+
+    def write(self, group: List):
+        self._file.write(',\n' if self.count else '\n')
+        self._file.write(json.dumps(group, default=str))
+        self.count += 1
+
+    def close(self):
+        if self._file is None:
+            return
+        self._file.write('\n]\n')
+        self._file.close()
+        self._file = None
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def load_group_cache(path: str) -> Optional[List[List]]:
+    """The cached group list, or None if there is no usable cache"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            groups = json.load(f)
+    except ValueError:
+        return None
+    if not isinstance(groups, list) or (groups and not isinstance(groups[0], list)):
+        return None
+    return groups
@@ -0,0 +1,236 @@
+"""
+One command line for all three scripts:
+
+    python -m stashstuff dupes --distance 4 --batch-size all --workers 4
+    python -m stashstuff primaries --unattended --mutation-batch-size 100
+    python -m stashstuff markers --no-dry-run --marker-cache-file markers.sqlite
+
+Each subcommand loads its script (find-phash-dupes.py, update-dupes.py,
+cleanup_overlapping_markers.py), overrides the settings given on the command
+line - module constants, or CONFIG keys for the marker script - and runs its
+main(). Settings left out keep the values at the top of the script, so the
+scripts still work on their own and their settings stay the place to change
+defaults.
+
+Only argparse is imported until a subcommand actually runs: `--help` doesn't
+pay for requests, the scripts or their optional dependencies.
+"""
+
+import argparse
+import importlib.util
+import os
+import sys
+from typing import Dict, List, Optional
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROFILE_CHOICES = ('cprofile', 'tracemalloc', 'none')
+
+
+# ---- value types -------------------------------------------------------------
+
+def int_or_all(value: str) -> Optional[int]:
+    """An integer, or 'all' / 'none' for no limit"""
+    if value.lower() in ('all', 'none'):
+        return None
+    return int(value)
+
+
+def optional_str(value: str) -> Optional[str]:
+    """A string, or 'none' to turn the setting off"""
+    return None if value.lower() == 'none' else value
+
+
+def _mapping(value_type):
+    def parse(value: str):
+        key, separator, item = value.partition('=')
+        if not separator or not key:
+            raise argparse.ArgumentTypeError(f"expected KEY=VALUE, got {value!r}")
+        return key, value_type(item)
+    parse.__name__ = value_type.__name__
+    return parse
+
+
+# Kinds that are not argparse types
+BOOL = 'bool'        # --flag sets True, --no-flag sets False
+MAPPING = 'mapping'  # repeatable KEY=VALUE, collected into a dict
+
+# ---- options -----------------------------------------------------------------
+# (flag, setting, kind, help). kind is a type callable, a tuple of choices, BOOL,
+# or (MAPPING, value type). The setting name is shown in --help so the default
+# can be looked up at the top of the script.
+
+CONNECTION_OPTIONS = [
+    ('--max-rps', 'MAX_REQUESTS_PER_SECOND', float, "ceiling for the adaptive rate limiter (0 = unlimited)"),
+    ('--max-retries', 'MAX_RETRIES', int, "retries for failed queries"),
+    ('--metrics-file', 'METRICS_FILE', optional_str, "run metrics JSON (a .prom file is written next to it; none = off)"),
+    ('--profile', 'PROFILE', PROFILE_CHOICES, "profile the run with cProfile or tracemalloc"),
+    ('--profile-file', 'PROFILE_FILE', str, "where --profile cprofile saves the profile"),
+]
+
+DUPES_OPTIONS = [
+    ('--distance', 'PHASH_DISTANCE', int, "phash distance, 0 = exact match (use multiples of 4)"),
+    ('--batch-size', 'BATCH_SIZE', int_or_all, "duplicate groups merged per run ('all' = every pending group)"),
+    ('--workers', 'MERGE_WORKERS', int, "merges run in parallel"),
+    ('--max-merge-backoff', 'MAX_MERGE_BACKOFF', float, "longest pause between merges when latency rises (seconds)"),
+    ('--pool-size', 'CONNECTION_POOL_SIZE', int, "keep-alive connections to reuse"),
+    ('--timeout', 'OPERATION_TIMEOUTS', (MAPPING, float), "read timeout by operation, e.g. SceneMerge=900 (repeatable)"),
+    ('--mutation-batch-size', 'MUTATION_BATCH_SIZE', int, "follow-up mutations packed into one request"),
+    ('--merge-primary-in-values', 'MERGE_PRIMARY_IN_VALUES', BOOL, "set the primary file in the sceneMerge request"),
+    ('--primary-file-by-score', 'PRIMARY_FILE_BY_SCORE', BOOL, "make the best-scoring file primary even if it isn't an MKV"),
+    ('--query-profile', 'QUERY_PROFILE', ('display-full', 'scoring-minimal'), "scene fields to fetch"),
+    ('--measure-query-profiles', 'MEASURE_QUERY_PROFILES', BOOL, "report payload size and parse time per profile"),
+    ('--stream', 'STREAM_DUPLICATES', BOOL, "merge groups as findDuplicateScenes streams in (no preview)"),
+    ('--local-index', 'USE_LOCAL_PHASH_INDEX', BOOL, "group duplicates from a local phash index"),
+    ('--phash-index-file', 'PHASH_INDEX_FILE', str, "local phash index file"),
+    ('--refresh-index', 'REFRESH_PHASH_INDEX', BOOL, "re-download every phash"),
+    ('--phash-engine', 'PHASH_ENGINE', ('multi-index', 'numpy'), "local grouping engine"),
+    ('--compare-with-server', 'COMPARE_WITH_SERVER', BOOL, "also run findDuplicateScenes and compare"),
+    ('--incremental', 'INCREMENTAL', BOOL, "only groups with scenes changed since the last run"),
+    ('--scoring-engine', 'SCORING_ENGINE', ('python', 'numpy'), "planning engine"),
+    ('--weight', 'SCORING_WEIGHTS', (MAPPING, float), "scoring weight override, e.g. hevc=0 (repeatable)"),
+    ('--plan-only', 'PLAN_ONLY', BOOL, "write the merge plan and exit without changing anything"),
+    ('--execute-plan', 'EXECUTE_PLAN', BOOL, "apply the merge plan as written"),
+    ('--plan-file', 'MERGE_PLAN_FILE', str, "merge plan file"),
+    ('--delete-duplicate-files', 'DELETE_DUPLICATE_FILES', BOOL, "plan deletion of non-primary files (removes them from disk!)"),
+    ('--preflight', 'PREFLIGHT_FILES', BOOL, "check every file on disk before merging"),
+    ('--path-map', 'LIBRARY_PATH_MAP', (MAPPING, str), "server path prefix to local mount, e.g. /data/=/mnt/stash/ (repeatable)"),
+    ('--preflight-workers', 'PREFLIGHT_WORKERS', int, "concurrent stat/hash calls during the preflight"),
+    ('--duplicates-file', 'DUPLICATES_FILE', str, "cached duplicate group list"),
+    ('--journal-file', 'MERGE_JOURNAL_FILE', str, "merge journal"),
+    ('--resume', 'RESUME', BOOL, "continue from the cached groups and the journal"),
+] + CONNECTION_OPTIONS
+
+PRIMARIES_OPTIONS = [
+    ('--batch-size', 'SCENE_BATCH_SIZE', int, "scenes handled per batch"),
+    ('--page-size', 'SCENE_PAGE_SIZE', int, "scenes fetched per findScenes request"),
+    ('--mutation-batch-size', 'MUTATION_BATCH_SIZE', int, "primary-file updates packed into one request"),
+    ('--delete-files-per-call', 'DELETE_FILES_PER_CALL', int, "MP4 file ids sent in one deleteFiles call"),
+    ('--unattended', 'UNATTENDED', BOOL, "run every batch without waiting for Enter"),
+    ('--preflight', 'PREFLIGHT_FILES', BOOL, "only delete an MP4 if its MKV checks out on disk"),
+    ('--path-map', 'LIBRARY_PATH_MAP', (MAPPING, str), "server path prefix to local mount, e.g. /data/=/mnt/stash/ (repeatable)"),
+] + CONNECTION_OPTIONS
+
+MARKERS_OPTIONS = [
+    ('--dry-run', 'dry_run', BOOL, "only report what would be deleted; --no-dry-run deletes"),
+    ('--test-mode', 'test_mode', BOOL, "process a single scene"),
+    ('--max-scenes', 'max_scenes', int_or_all, "scenes to process ('all' = no limit)"),
+    ('--within-seconds', 'within_seconds', float, "markers this close count as overlapping"),
+    ('--overlap-mode', 'overlap_mode', ('anchored', 'chained', 'interval'), "how overlaps are grouped"),
+    ('--same-tag-only', 'same_tag_only', BOOL, "only markers with the same primary tag overlap"),
+    ('--scene-page-size', 'per_page', int, "scenes fetched per findScenes request"),
+    ('--marker-page-size', 'marker_page_size', int, "markers fetched per findSceneMarkers request"),
+    ('--bulk-scan', 'bulk_marker_scan', BOOL, "page through all markers instead of one query per scene"),
+    ('--marker-cache-file', 'marker_cache_file', optional_str, "local SQLite marker cache (none = always query)"),
+    ('--refresh-marker-cache', 'refresh_marker_cache', BOOL, "re-download every marker into the cache"),
+    ('--pool-size', 'pool_size', int, "keep-alive connections to reuse"),
+    ('--timeout', 'timeouts', (MAPPING, float), "read timeout by operation, e.g. SceneMarkerDestroy=60 (repeatable)"),
+    ('--mutation-batch-size', 'mutation_batch_size', int, "marker deletions packed into one request"),
+    ('--async', 'async_mode', BOOL, "process many scenes at once (requires aiohttp)"),
+    ('--concurrency', 'concurrency', int, "async mode: requests in flight"),
+    ('--async-rps', 'requests_per_second', float, "async mode: rate limiter ceiling (0 = unlimited, default = --max-rps)"),
+] + [(flag, setting.lower(), kind, help_text) for flag, setting, kind, help_text in CONNECTION_OPTIONS]
+
+# name -> (script, options, description)
+COMMANDS = {
+    'dupes': ('find-phash-dupes.py', DUPES_OPTIONS, "find duplicate scenes by phash and merge them"),
+    'primaries': ('update-dupes.py', PRIMARIES_OPTIONS, "make MKV files primary and delete their MP4 copies"),
+    'markers': ('cleanup_overlapping_markers.py', MARKERS_OPTIONS, "delete overlapping scene markers"),
+}
+
+
+# ---- parser ------------------------------------------------------------------
+
+def _add_option(parser: argparse.ArgumentParser, flag: str, setting: str, kind, help_text: str):
+    # Options that aren't given leave no attribute at all, so 'none' / 'all' (None) still override
+    common = {'dest': f"setting:{setting}", 'default': argparse.SUPPRESS, 'help': f"{help_text} ({setting})"}
+    if kind == BOOL:
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument(flag, action='store_const', const=True, **common)
+        group.add_argument(f"--no-{flag[2:]}", action='store_const', const=False,
+                           **{**common, 'help': argparse.SUPPRESS})
+    elif isinstance(kind, tuple) and kind[0] == MAPPING:
+        parser.add_argument(flag, type=_mapping(kind[1]), action='append', metavar='KEY=VALUE', **common)
+    elif isinstance(kind, tuple):
+        parser.add_argument(flag, choices=kind, **common)
+    else:
+        parser.add_argument(flag, type=kind, metavar=setting.upper(), **common)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog='python -m stashstuff',
+        description="Stash duplicate management. Options override the settings at the top of each script "
+                    "for this run only; boolean options also have a --no-... form.")
+    parser.add_argument('--env-file', help="read STASH_URL / STASH_API_KEY from this file first "
+                                           "(default: .env, then stash.env)")
+    parser.add_argument('--url', help="Stash server URL (overrides STASH_URL)")
+    parser.add_argument('--api-key', help="Stash API key (overrides STASH_API_KEY)")
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    commands.required = True
+    for name, (script, options, description) in COMMANDS.items():
+        command = commands.add_parser(name, help=description, description=f"{description} ({script})")
+        for option in options:
+            _add_option(command, *option)
+    return parser
+
+
+def settings_from_args(args: argparse.Namespace) -> Dict:
+    """The settings given on the command line, by setting name"""
+    settings = {}
+    for dest, value in vars(args).items():
+        if not dest.startswith('setting:'):
+            continue
+        setting = dest[len('setting:'):]
+        if isinstance(value, list):
+            value = dict(value)
+        elif setting.upper() == 'PROFILE' and value == 'none':
+            value = None
+        settings[setting] = value
+    return settings
+
+
+# ---- running a script --------------------------------------------------------
+
+def load_script(script: str):
+    """Import one of the repository's scripts as a module (its main() is not run)"""
+    path = os.path.join(REPO_DIR, script)
+    if not os.path.exists(path):
+        raise SystemExit(f"❌ {script} not found in {REPO_DIR}")
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    name = os.path.splitext(script)[0].replace('-', '_')
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def apply_settings(module, settings: Dict):
+    """Override module constants, or CONFIG keys for scripts that keep their settings in a CONFIG dict"""
+    config = getattr(module, 'CONFIG', None)
+    for name, value in settings.items():
+        if config is not None and name in config:
+            config[name] = value
+        elif hasattr(module, name):
+            setattr(module, name, value)
+        else:
+            raise SystemExit(f"❌ {module.__name__} has no setting {name}")
+
+
+def main(argv: Optional[List[str]] = None):
+    args = build_parser().parse_args(argv)
+    if args.url:
+        os.environ['STASH_URL'] = args.url
+    if args.api_key:
+        os.environ['STASH_API_KEY'] = args.api_key
+    if args.env_file:
+        if not os.path.isfile(args.env_file):
+            raise SystemExit(f"❌ No such env file: {args.env_file}")
+        from stashstuff.env import load_stash_env
+        load_stash_env(args.env_file)
+
+    script = COMMANDS[args.command][0]
+    module = load_script(script)
+    apply_settings(module, settings_from_args(args))
+    module.main()
@@ -0,0 +1,342 @@
+"""
+Pooled GraphQL transport shared by all of the Stash scripts.
+
+Every script used to call requests.post() once per operation, which meant a
+fresh TCP connection (and TLS handshake) for every query and mutation. This
+client keeps one requests.Session around so connections are reused, asks the
+server for gzip responses and keeps per-operation latency numbers so a run
+can report where its time went. Every request takes a token from an
+AdaptiveRateLimiter first (see stashstuff/ratelimit.py), which speeds up
+while the server keeps up and backs off on slow responses and 429/5xx.
+Timeouts, retries and the circuit breaker that pauses calls while the
+server is down live in stashstuff/resilience.py. Request and byte counts,
+latency histograms and the time spent on the network, decoding JSON and
+waiting (rate limit, retry backoff, breaker pauses) go into a RunMetrics
+(stashstuff/metrics.py) for the end-of-run summary.
+"""
+
+import contextlib
+import json
+import re
+import time
+from collections import defaultdict
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from stashstuff.metrics import RunMetrics
+from stashstuff.ratelimit import DEFAULT_MAX_RATE, AdaptiveRateLimiter, is_overload_status
+from stashstuff.resilience import (DEFAULT_CONNECT_TIMEOUT, DEFAULT_MAX_RETRIES, DEFAULT_MUTATION_TIMEOUT,
+                                   DEFAULT_QUERY_TIMEOUT, OPERATION_TIMEOUTS, TRANSIENT_ERRORS, CircuitBreaker,
+                                   TransientResponseError, backoff_delay, error_result, is_mutation,
+                                   request_not_processed)
+from stashstuff.streaming import DEFAULT_CHUNK_SIZE, StreamingResponseError, iter_json_array
+
+# ====== CONFIGURATION ======
+DEFAULT_POOL_CONNECTIONS = 4   # Number of host pools to cache (we only talk to one Stash)
+DEFAULT_POOL_MAXSIZE = 16      # Max keep-alive connections per host
+
+_OPERATION_RE = re.compile(r'^\s*(query|mutation)\s+(\w+)', re.MULTILINE)
+
+
+def operation_name(query: str) -> str:
+    """Best-effort name for a GraphQL document, used as the latency bucket"""
+    match = _OPERATION_RE.search(query)
+    if match:
+        return match.group(2)
+    return 'anonymous'
+
+
+def _counting(chunks: Iterator[bytes], total: List[int]) -> Iterator[bytes]:
+    """Pass chunks through, adding their sizes to total[0]"""
+    for chunk in chunks:
+        total[0] += len(chunk)
+        yield chunk
+
+
+class LatencyStats:
+    """Per-operation call counts and latency samples (in seconds)"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+
+    def record(self, name: str, elapsed: float):
+        self.samples[name].append(elapsed)
+
+    @property
+    def total_calls(self) -> int:
+        return sum(len(s) for s in self.samples.values())
+
+    @staticmethod
+    def _percentile(sorted_samples: List[float], pct: float) -> float:
+        if not sorted_samples:
+            return 0.0
+        index = min(len(sorted_samples) - 1, int(round(pct / 100 * (len(sorted_samples) - 1))))
+        return sorted_samples[index]
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Return {operation: {calls, total, avg, p50, p95, max}} with times in ms"""
+        report = {}
+        for name, samples in self.samples.items():
+            ordered = sorted(samples)
+            total = sum(ordered)
+            report[name] = {
+                'calls': len(ordered),
+                'total_ms': total * 1000,
+                'avg_ms': total / len(ordered) * 1000,
+                'p50_ms': self._percentile(ordered, 50) * 1000,
+                'p95_ms': self._percentile(ordered, 95) * 1000,
+                'max_ms': ordered[-1] * 1000,
+            }
+        return report
+
+    def print_report(self):
+        """Print a per-operation latency table"""
+        summary = self.summary()
+        if not summary:
+            return
+
+        print(f"\n⏱️  GraphQL latency ({self.total_calls} calls):")
+        print(f"   {'operation':<32} {'calls':>7} {'avg ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+        for name, row in sorted(summary.items(), key=lambda item: -item[1]['total_ms']):
+            print(f"   {name:<32} {row['calls']:>7} {row['avg_ms']:>9.1f} {row['p50_ms']:>9.1f} "
+                  f"{row['p95_ms']:>9.1f} {row['max_ms']:>9.1f}")
+
+
+class StashGraphQLClient:
+    """GraphQL client with a persistent, pooled keep-alive session"""
+
+    def __init__(self, base_url: str, api_key: str,
+                 pool_connections: int = DEFAULT_POOL_CONNECTIONS,
+                 pool_maxsize: int = DEFAULT_POOL_MAXSIZE,
+                 max_requests_per_second: float = DEFAULT_MAX_RATE,
+                 rate_limiter: Optional[AdaptiveRateLimiter] = None,
+                 max_retries: int = DEFAULT_MAX_RETRIES,
+                 timeouts: Optional[Dict[str, float]] = None,
+                 breaker: Optional[CircuitBreaker] = None,
+                 metrics: Optional[RunMetrics] = None):
+        self.base_url = base_url
+        self.graphql_url = f"{base_url}/graphql"
+        self.headers = {
+            'Content-Type': 'application/json',
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive',
+            'ApiKey': api_key
+        }
+
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.stats = LatencyStats()
+        # Pass rate_limiter to share one limiter between clients; max_requests_per_second=0 disables it
+        self.rate_limiter = rate_limiter or AdaptiveRateLimiter(max_rate=max_requests_per_second)
+        self.max_retries = max(0, max_retries)
+        # Read timeouts by operation name, on top of OPERATION_TIMEOUTS
+        self.timeouts = {**OPERATION_TIMEOUTS, **(timeouts or {})}
+        self.breaker = breaker or CircuitBreaker()
+        self.retries = 0
+        self.metrics = metrics or RunMetrics()
+
+    def _timeout(self, name: str, mutation: bool):
+        read_timeout = self.timeouts.get(name, DEFAULT_MUTATION_TIMEOUT if mutation else DEFAULT_QUERY_TIMEOUT)
+        return DEFAULT_CONNECT_TIMEOUT, read_timeout
+
+    def _post(self, name: str, body: bytes, timeout, mutation: bool, stream: bool = False) -> requests.Response:
+        """
+        One rate-limited POST. Raises TransientResponseError for 429/5xx
+        (and the requests exceptions for connection problems and timeouts).
+        Streamed responses are recorded in the metrics by the caller once read.
+        """
+        delay = self.rate_limiter.reserve()
+        if delay > 0:
+            time.sleep(delay)
+            self.metrics.add_time('rate_limit_wait', delay)
+        start = time.perf_counter()
+        try:
+            response = self.session.post(self.graphql_url, data=body, timeout=timeout, stream=stream)
+        except TRANSIENT_ERRORS:
+            self.metrics.record_request(name, time.perf_counter() - start, len(body), mutation=mutation, failed=True)
+            raise
+        elapsed = time.perf_counter() - start
+        self.rate_limiter.observe(name, elapsed, response.status_code, response.headers.get('Retry-After'))
+        overloaded = is_overload_status(response.status_code)
+        # A streamed body is read along with the caller's work, so only the time to the headers counts as network
+        self.metrics.add_time('network', elapsed)
+        if not stream or overloaded:
+            self.metrics.record_request(name, elapsed, len(body), len(response.content) if not stream else 0,
+                                        mutation=mutation, failed=overloaded)
+        if overloaded:
+            response.close()
+            raise TransientResponseError(f"HTTP {response.status_code} from {name}", response.status_code)
+        return response
+
+    @contextlib.contextmanager
+    def _breaker_attempt(self) -> Iterator[bool]:
+        """CircuitBreaker.attempt(), with the time spent paused recorded"""
+        start = time.perf_counter()
+        with self.breaker.attempt() as paused:
+            if paused:
+                self.metrics.add_time('breaker_pause', time.perf_counter() - start)
+            yield paused
+
+    def _backoff(self, attempt: int):
+        delay = backoff_delay(max(attempt, 1))
+        time.sleep(delay)
+        self.metrics.add_time('retry_backoff', delay)
+
+    def execute_query(self, query: str, variables: Optional[Dict] = None,
+                      verify: Optional[Callable[[], Optional[Dict]]] = None) -> Dict:
+        """
+        POST a GraphQL document and return the decoded JSON response.
+
+        Queries are retried on connection errors, timeouts, 429/5xx and
+        unreadable responses. A mutation is only resent if the server can't
+        have processed it, or if `verify` - called after a failed attempt -
+        returns None (not applied). If verify returns a result, the mutation
+        did go through and that result is returned instead. When the retries
+        run out the failure is returned as {'errors': [...]}.
+        """
+        payload = {'query': query}
+        if variables:
+            payload['variables'] = variables
+        body = json.dumps(payload).encode('utf-8')
+
+        name = operation_name(query)
+        mutation = is_mutation(query)
+        timeout = self._timeout(name, mutation)
+        attempt = 0
+        while True:
+            with self._breaker_attempt() as paused:
+                start = time.perf_counter()
+                try:
+                    response = self._post(name, body, timeout, mutation)
+                    try:
+                        with self.metrics.phase('json_parse'):
+                            result = response.json()
+                    except ValueError:
+                        if response.status_code >= 400:
+                            # A client error is not going to get better by retrying
+                            self.breaker.record_success()
+                            return error_result(f"HTTP {response.status_code} from {name}: {response.text[:200]}")
+                        raise TransientResponseError(f"Unreadable response from {name}", response.status_code)
+                except TRANSIENT_ERRORS as e:
+                    self.breaker.record_failure(e)
+                    error = e
+                else:
+                    self.breaker.record_success()
+                    self.stats.record(name, time.perf_counter() - start)
+                    return result
+
+            # Attempts that had to wait for the breaker were server outages, not this request's fault
+            if not paused:
+                attempt += 1
+            if attempt > self.max_retries:
+                return error_result(f"{name} failed after {attempt} attempts: {error}")
+            self._backoff(attempt)
+            if mutation and not request_not_processed(error):
+                if verify is None:
+                    return error_result(f"{name} may not have completed ({error}); not retrying a mutation")
+                applied = verify()
+                if applied is not None:
+                    return applied
+            self.retries += 1
+            self.metrics.count('retries')
+
+    def stream_array(self, query: str, variables: Optional[Dict] = None, key: str = '',
+                     chunk_size: int = DEFAULT_CHUNK_SIZE) -> Iterator[Any]:
+        """
+        POST a GraphQL document and yield the elements of the array under `key`
+        as they are decoded, without holding the whole response in memory.
+        Raises StreamingResponseError if the response has no such array, and
+        the transient error (TransientResponseError for a body cut off
+        mid-array) if the stream fails after elements were handed out, since
+        a retry would repeat them.
+        """
+        payload = {'query': query}
+        if variables:
+            payload['variables'] = variables
+        body = json.dumps(payload).encode('utf-8')
+
+        name = operation_name(query)
+        mutation = is_mutation(query)
+        timeout = self._timeout(name, mutation)
+        attempt = 0
+        while True:
+            with self._breaker_attempt() as paused:
+                start = time.perf_counter()
+                yielded = False
+                received = None  # Set once the headers are in; _post records failures before that
+                try:
+                    with self._post(name, body, timeout, mutation, stream=True) as response:
+                        received = [0]
+                        try:
+                            for item in iter_json_array(_counting(response.iter_content(chunk_size), received), key):
+                                yielded = True
+                                yield item
+                        except StreamingResponseError as e:
+                            if e.result is None and response.status_code < 400:
+                                raise TransientResponseError(f"Unreadable response from {name}: {e}",
+                                                             response.status_code) from e
+                            # The server answered, just not with the array (GraphQL or client errors)
+                            self.breaker.record_success()
+                            raise
+                        except ValueError as e:
+                            # Cut off or garbled mid-body
+                            raise TransientResponseError(f"Truncated response from {name}: {e}",
+                                                         response.status_code) from e
+                except TRANSIENT_ERRORS as e:
+                    self.breaker.record_failure(e)
+                    if received is not None:
+                        self.metrics.record_request(name, time.perf_counter() - start, len(body), received[0],
+                                                    mutation=mutation, failed=True)
+                    if not paused:
+                        attempt += 1
+                    # Once elements have been handed out a retry would repeat them
+                    if yielded or mutation or attempt > self.max_retries:
+                        raise
+                else:
+                    self.breaker.record_success()
+                    elapsed = time.perf_counter() - start
+                    self.stats.record(name, elapsed)
+                    self.metrics.record_request(name, elapsed, len(body), received[0], mutation=mutation)
+                    return
+            self._backoff(attempt)
+            self.retries += 1
+            self.metrics.count('retries')
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def print_latency_report(self):
+        """Print a per-operation latency table and the run's phase timings"""
+        self.stats.print_report()
+        if self.rate_limiter.enabled and self.stats.total_calls:
+            print(f"   adaptive rate limit ended at {self.rate_limiter.rate:.0f} req/s "
+                  f"(backed off {self.rate_limiter.decreases} times)")
+        if self.retries or self.breaker.opened:
+            print(f"   {self.retries} requests retried, paused {self.breaker.opened} times while Stash was unhealthy")
+        self.metrics.print_report()
+
+    def write_metrics(self, path: Optional[str]):
+        """Save the run's metrics as JSON to `path` and as Prometheus text next to it (None = don't)"""
+        if not path:
+            return
+        self.metrics.set_gauge('rate_limit_final_requests_per_second', self.rate_limiter.rate)
+        self.metrics.set_gauge('rate_limit_decreases', self.rate_limiter.decreases)
+        self.metrics.set_gauge('breaker_opened', self.breaker.opened)
+        try:
+            json_path, prom_path = self.metrics.write(path)
+        except OSError as e:
+            print(f"⚠️  Could not write run metrics to {path}: {e}")
+            return
+        print(f"📈 Run metrics written to {json_path} and {prom_path}")
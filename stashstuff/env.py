@@ -0,0 +1,39 @@
+"""
+Where the scripts find STASH_URL and STASH_API_KEY.
+
+find-phash-dupes.py and update-dupes.py used to read .env while
+cleanup_overlapping_markers.py read stash.env, so one of them always needed
+a second copy of the credentials. Every entry point now reads both names,
+.env first, from the current directory and from the repository root.
+Variables already set in the environment win over either file, so
+`python -m stashstuff --url ... --api-key ...` (which sets them before the
+script starts) works without any file at all.
+"""
+
+import os
+from typing import List, Optional
+
+from dotenv import load_dotenv
+
+# ====== CONFIGURATION ======
+ENV_FILES = ('.env', 'stash.env')  # Read in this order; earlier files win
+
+_REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_stash_env(env_file: Optional[str] = None) -> List[str]:
+    """
+    Load `env_file` if given, then any of ENV_FILES in the current directory
+    and the repository root, without overriding variables that are already set.
+    Returns the files that were read.
+    """
+    candidates = [env_file] if env_file else []
+    for directory in dict.fromkeys((os.getcwd(), _REPO_DIR)):
+        candidates.extend(os.path.join(directory, name) for name in ENV_FILES)
+
+    loaded = []
+    for path in candidates:
+        if os.path.isfile(path):
+            load_dotenv(path)
+            loaded.append(path)
+    return loaded
@@ -0,0 +1,189 @@
+"""
+Thread-pool executor for independent merges.
+
+Duplicate groups can be merged in parallel as long as no two in-flight merges
+touch the same scene. SceneLockTable hands out all of a group's scene ids at
+once (or waits until it can), so overlapping groups run one after the other
+while disjoint ones run side by side.
+
+Instead of sleeping a fixed amount after every merge, AdaptiveBackoff watches
+how long merges take. While latency stays near the best level seen so far
+there is no delay at all; when it climbs (the server is struggling) the delay
+between submissions grows multiplicatively, and it shrinks again once
+latency recovers. The pause never exceeds the smoothed merge time itself
+(idling longer than a merge takes doesn't relieve the server any further),
+and the baseline drifts up slowly so running several merges at once - which
+always makes each one slower - settles into a new normal instead of
+throttling forever.
+
+With more than one worker, each task's printed output is collected and
+written in one piece when the task finishes, so the logs of parallel merges
+don't interleave line by line. A single worker prints straight through and
+sys.stdout is left alone.
+"""
+
+import io
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional
+
+from stashstuff.metrics import RunMetrics
+
+# ====== CONFIGURATION ======
+DEFAULT_WORKERS = 4          # Merges in flight at once
+DEFAULT_MAX_BACKOFF = 5.0    # Longest pause between submissions (seconds)
+SLOWDOWN_THRESHOLD = 1.5     # Back off once smoothed latency exceeds this multiple of the best seen
+BACKOFF_STEP = 0.1           # First delay applied when latency starts rising (seconds)
+BACKOFF_FACTOR = 2.0         # Delay multiplier per slow observation (and divisor per fast one)
+LATENCY_SMOOTHING = 0.2      # Weight of the newest sample in the latency moving average
+BASELINE_DRIFT = 0.01        # Best latency creeps up this fraction per merge
+
+
+class SceneLockTable:
+    """Per-scene-id locks, acquired all-or-nothing so overlapping groups can't deadlock"""
+
+    def __init__(self):
+        self._held = set()
+        self._condition = threading.Condition()
+
+    def acquire(self, scene_ids: Iterable[str]):
+        wanted = set(scene_ids)
+        with self._condition:
+            while self._held & wanted:
+                self._condition.wait()
+            self._held |= wanted
+
+    def release(self, scene_ids: Iterable[str]):
+        with self._condition:
+            self._held -= set(scene_ids)
+            self._condition.notify_all()
+
+
+class AdaptiveBackoff:
+    """Delay between submissions that follows the observed merge latency"""
+
+    def __init__(self, max_delay: float = DEFAULT_MAX_BACKOFF):
+        self.max_delay = max_delay
+        self.delay = 0.0
+        self.average = None
+        self.best = None
+        self._lock = threading.Lock()
+
+    def observe(self, elapsed: float):
+        with self._lock:
+            if self.average is None:
+                self.average = elapsed
+            else:
+                self.average += LATENCY_SMOOTHING * (elapsed - self.average)
+            self.best = self.average if self.best is None else min(self.best * (1 + BASELINE_DRIFT), self.average)
+
+            if self.average > self.best * SLOWDOWN_THRESHOLD:
+                self.delay = min(self.max_delay, self.average, max(BACKOFF_STEP, self.delay * BACKOFF_FACTOR))
+            else:
+                self.delay = self.delay / BACKOFF_FACTOR if self.delay > BACKOFF_STEP else 0.0
+
+    def wait(self) -> float:
+        """Sleep for the current delay; returns how long that was"""
+        delay = self.delay
+        if delay:
+            time.sleep(delay)
+        return delay
+
+
+class _ThreadOutput(io.TextIOBase):
+    """sys.stdout stand-in that sends each worker thread's prints to its own buffer"""
+
+    def __init__(self, target):
+        self.target = target
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            with self.lock:
+                return self.target.write(text)
+        return buffer.write(text)
+
+    def flush(self):
+        self.target.flush()
+
+    def capture(self):
+        self.local.buffer = io.StringIO()
+
+    def release(self):
+        text = self.local.buffer.getvalue()
+        self.local.buffer = None
+        with self.lock:
+            self.target.write(text)
+            self.target.flush()
+
+
+class ParallelMergeExecutor:
+    """
+    Runs fn(*args) on a thread pool with the given scene ids locked for the
+    duration. submit() blocks while `workers * 2` tasks are already queued, so
+    feeding it from a stream keeps memory bounded. Use as a context manager;
+    leaving the block waits for every task. Backoff pauses are recorded as
+    the merge_backoff phase of `metrics`, if given.
+    """
+
+    def __init__(self, workers: int = DEFAULT_WORKERS, max_backoff: float = DEFAULT_MAX_BACKOFF,
+                 metrics: Optional[RunMetrics] = None):
+        self.workers = max(1, workers)
+        self.locks = SceneLockTable()
+        self.backoff = AdaptiveBackoff(max_backoff)
+        self.metrics = metrics
+        self.futures: List[Future] = []
+        self._slots = threading.BoundedSemaphore(self.workers * 2)
+        self._pool = None
+        self._output = None
+
+    def __enter__(self):
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='merge')
+        if self.workers > 1:
+            self._output = _ThreadOutput(sys.stdout)
+            sys.stdout = self._output
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self._pool.shutdown(wait=True)
+        finally:
+            if self._output is not None:
+                sys.stdout = self._output.target
+                self._output = None
+
+    def submit(self, scene_ids: List[str], fn: Callable, *args) -> Future:
+        paused = self.backoff.wait()
+        if paused and self.metrics:
+            self.metrics.add_time('merge_backoff', paused)
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(self._run, scene_ids, fn, args)
+        except BaseException:
+            self._slots.release()
+            raise
+        self.futures.append(future)
+        return future
+
+    def _run(self, scene_ids, fn, args):
+        output = self._output
+        if output is not None:
+            output.capture()
+        self.locks.acquire(scene_ids)
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            self.backoff.observe(time.perf_counter() - start)
+            self.locks.release(scene_ids)
+            if output is not None:
+                output.release()
+            self._slots.release()
+
+    def results(self) -> List:
+        """Results of all submitted tasks in submission order (re-raises task errors)"""
+        return [future.result() for future in self.futures]
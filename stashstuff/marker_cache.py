@@ -0,0 +1,240 @@
+"""
+Local SQLite cache of scene markers for offline overlap detection.
+
+Every marker cleanup used to download every marker in the library again. The
+cache keeps what overlap detection needs (id, scene, seconds, end_seconds,
+primary tag) in a single SQLite file and brings it up to date with a delta
+sync:
+
+    1. fetch only markers with updated_at after the cache's watermark (new
+       and edited markers) and upsert them
+    2. page through every marker id (no other fields) and drop cached
+       markers that no longer exist on the server. Comparing counts isn't
+       enough: one marker deleted and another added between runs leave the
+       count unchanged, and a stale marker could then be picked as the
+       keeper of its overlap group while the live ones are deleted
+
+After a small tagging session that's a handful of small requests, and the
+whole library can then be analysed without touching the network. Markers the
+cleaner deletes itself are removed from the cache straight away.
+"""
+
+import sqlite3
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from stashstuff.phash_index import later_timestamp, updated_since_filter
+
+# ====== CONFIGURATION ======
+MARKER_PAGE_SIZE = 1000        # Markers fetched per findSceneMarkers request when syncing
+MARKER_ID_PAGE_SIZE = 10000    # Marker ids fetched per request when looking for deletions
+CACHE_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS scenes (
+    id INTEGER PRIMARY KEY,
+    title TEXT
+);
+CREATE TABLE IF NOT EXISTS markers (
+    id INTEGER PRIMARY KEY,
+    scene_id INTEGER NOT NULL,
+    seconds REAL NOT NULL,
+    end_seconds REAL,
+    title TEXT,
+    primary_tag_id TEXT,
+    primary_tag_name TEXT,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS markers_by_scene ON markers (scene_id, seconds);
+"""
+
+MARKERS_QUERY = """
+query SyncSceneMarkers($marker_filter: SceneMarkerFilterType, $page: Int!, $per_page: Int!) {
+  findSceneMarkers(
+    scene_marker_filter: $marker_filter
+    filter: { page: $page, per_page: $per_page, sort: "id", direction: ASC }
+  ) {
+    count
+    scene_markers {
+      id
+      seconds
+      end_seconds
+      title
+      updated_at
+      primary_tag {
+        id
+        name
+      }
+      scene {
+        id
+        title
+      }
+    }
+  }
+}
+"""
+
+MARKER_IDS_QUERY = """
+query SceneMarkerIds($page: Int!, $per_page: Int!) {
+  findSceneMarkers(filter: { page: $page, per_page: $per_page, sort: "id", direction: ASC }) {
+    scene_markers {
+      id
+    }
+  }
+}
+"""
+
+
+def _iter_pages(client, query: str, variables: Dict, per_page: int) -> Iterator[List[Dict]]:
+    """
+    Yield each page of findSceneMarkers results. Raises RuntimeError if the
+    server returns errors.
+    """
+    page = 1
+    while True:
+        result = client.execute_query(query, {**variables, 'page': page, 'per_page': per_page})
+        if 'errors' in result:
+            raise RuntimeError(f"Error fetching scene markers: {result['errors']}")
+
+        markers = result['data']['findSceneMarkers']['scene_markers']
+        yield markers
+        if len(markers) < per_page:
+            return
+        page += 1
+
+
+class MarkerCache:
+    """Scene markers stored in a local SQLite file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(_SCHEMA)
+        if self._meta('version') != str(CACHE_VERSION):
+            self.clear()
+
+    # ---- metadata ----------------------------------------------------------
+
+    def _meta(self, key: str) -> Optional[str]:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: Optional[str]):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    @property
+    def watermark(self) -> Optional[str]:
+        """Latest marker updated_at seen, so the next sync only fetches newer markers"""
+        return self._meta('watermark')
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM markers")
+            self.conn.execute("DELETE FROM scenes")
+            self.conn.execute("DELETE FROM meta")
+            self._set_meta('version', str(CACHE_VERSION))
+
+    # ---- contents ----------------------------------------------------------
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM markers").fetchone()[0]
+
+    @property
+    def scene_count(self) -> int:
+        return self.conn.execute("SELECT COUNT(DISTINCT scene_id) FROM markers").fetchone()[0]
+
+    def upsert(self, markers: Iterable[Dict]) -> Optional[str]:
+        """Insert or replace markers as returned by MARKERS_QUERY; returns their latest updated_at"""
+        latest = None
+        marker_rows = []
+        scene_rows = {}
+        for marker in markers:
+            tag = marker.get('primary_tag') or {}
+            scene = marker['scene']
+            marker_rows.append((int(marker['id']), int(scene['id']), marker['seconds'], marker.get('end_seconds'),
+                                marker.get('title'), tag.get('id'), tag.get('name'), marker.get('updated_at')))
+            scene_rows[int(scene['id'])] = scene.get('title')
+            latest = later_timestamp(latest, marker.get('updated_at'))
+
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO markers VALUES (?, ?, ?, ?, ?, ?, ?, ?)", marker_rows)
+            self.conn.executemany("INSERT OR REPLACE INTO scenes VALUES (?, ?)", scene_rows.items())
+        return latest
+
+    def remove(self, marker_ids: Iterable) -> int:
+        """Drop markers by id (e.g. after deleting them on the server)"""
+        with self.conn:
+            cursor = self.conn.executemany("DELETE FROM markers WHERE id = ?", ((int(i),) for i in marker_ids))
+        return cursor.rowcount
+
+    def marker_ids(self) -> set:
+        return {row[0] for row in self.conn.execute("SELECT id FROM markers")}
+
+    def iter_scenes(self) -> Iterator[Tuple[Dict, List[Dict]]]:
+        """
+        Yield (scene, markers) for every cached scene with markers, highest scene
+        id first, with markers shaped like the findSceneMarkers results
+        """
+        rows = self.conn.execute("""
+            SELECT m.scene_id, s.title, m.id, m.seconds, m.end_seconds, m.title, m.primary_tag_id, m.primary_tag_name
+            FROM markers m LEFT JOIN scenes s ON s.id = m.scene_id
+            ORDER BY m.scene_id DESC, m.seconds, m.id
+        """)
+        scene = None
+        markers: List[Dict] = []
+        for scene_id, scene_title, marker_id, seconds, end_seconds, title, tag_id, tag_name in rows:
+            if scene is None or scene['id'] != str(scene_id):
+                if markers:
+                    yield scene, markers
+                scene = {'id': str(scene_id), 'title': scene_title}
+                markers = []
+            markers.append({
+                'id': str(marker_id),
+                'seconds': seconds,
+                'end_seconds': end_seconds,
+                'title': title,
+                'primary_tag': {'id': tag_id, 'name': tag_name} if tag_id is not None else None,
+            })
+        if markers:
+            yield scene, markers
+
+    # ---- syncing -----------------------------------------------------------
+
+    def sync(self, client, per_page: int = MARKER_PAGE_SIZE) -> Dict[str, int]:
+        """
+        Bring the cache up to date with the server: everything on the first run,
+        markers updated since the watermark afterwards, plus a pass over every
+        marker id to drop the ones deleted on the server. Returns
+        {'fetched': n, 'removed': n}.
+        """
+        watermark = self.watermark
+        marker_filter = updated_since_filter(watermark) if watermark else None
+
+        fetched = 0
+        for markers in _iter_pages(client, MARKERS_QUERY, {'marker_filter': marker_filter}, per_page):
+            watermark = later_timestamp(watermark, self.upsert(markers))
+            fetched += len(markers)
+
+        removed = self._remove_deleted(client)
+        with self.conn:
+            self._set_meta('watermark', watermark)
+        return {'fetched': fetched, 'removed': removed}
+
+    def _remove_deleted(self, client) -> int:
+        """Drop cached markers the server no longer has"""
+        server_ids = set()
+        for markers in _iter_pages(client, MARKER_IDS_QUERY, {}, MARKER_ID_PAGE_SIZE):
+            server_ids.update(int(marker['id']) for marker in markers)
+        return self.remove(self.marker_ids() - server_ids)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
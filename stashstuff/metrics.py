@@ -0,0 +1,269 @@
+"""
+Per-run instrumentation: phase timers, request counters and latency histograms.
+
+The latency table at the end of a run shows how long each GraphQL operation
+took, but not where the rest of the run's time went. RunMetrics collects:
+
+  * phase timers - seconds and call count per named phase. The clients
+    time their own phases (network, json_parse, rate_limit_wait,
+    retry_backoff, breaker_pause) and the executor its merge_backoff
+    pauses; scripts wrap their steps (find_duplicates, scoring, merge,
+    overlap_detection, ...) in `with metrics.phase(name):`. Phases may nest
+    and are summed across threads, so they can add up to more than the wall
+    time.
+  * counters - requests, bytes sent and received, retries, plus whatever
+    outcomes a script counts
+  * histograms - request latency per operation with Prometheus-style
+    cumulative buckets, so mutation latency can be tracked across runs
+
+write() saves the summary as JSON and, next to it, in the Prometheus text
+format (point node_exporter's textfile collector at it) so nightly runs can
+be compared. profile_run() optionally wraps a run in cProfile or tracemalloc.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# ====== CONFIGURATION ======
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)  # Seconds
+PROFILE_MODES = ('cprofile', 'tracemalloc')
+PROFILE_TOP_ENTRIES = 20       # Functions / allocation sites printed by profile_run()
+METRIC_PREFIX = 'stashstuff'
+
+
+class Histogram:
+    """Cumulative-bucket histogram, as in the Prometheus exposition format"""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+
+    def to_dict(self) -> Dict:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': {str(bound): count for bound, count in zip(self.buckets, self.counts)},
+        }
+
+
+def _labels(**labels) -> str:
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels.items()) + '}'
+
+
+class RunMetrics:
+    """Thread-safe phase timers, counters and latency histograms for one run"""
+
+    def __init__(self, run: str = 'run'):
+        self.run = run
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        self.phases: Dict[str, List[float]] = defaultdict(lambda: [0.0, 0])  # name -> [seconds, calls]
+        self.counters: Counter = Counter()
+        self.requests: Dict[str, Counter] = defaultdict(Counter)  # operation -> requests, bytes, ...
+        self.latency: Dict[Tuple[str, str], Histogram] = {}       # (operation, query|mutation) -> histogram
+        self.gauges: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    # ---- recording ---------------------------------------------------------
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time the enclosed block as one call of phase `name`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name: str, seconds: float):
+        with self._lock:
+            phase = self.phases[name]
+            phase[0] += seconds
+            phase[1] += 1
+
+    def count(self, name: str, amount: int = 1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def set_gauge(self, name: str, value: float):
+        with self._lock:
+            self.gauges[name] = value
+
+    def record_request(self, operation: str, elapsed: float, bytes_sent: int = 0, bytes_received: int = 0,
+                       mutation: bool = False, failed: bool = False):
+        """One HTTP round trip (including failed attempts that will be retried)"""
+        with self._lock:
+            stats = self.requests[operation]
+            stats['requests'] += 1
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+            if failed:
+                stats['failures'] += 1
+            key = (operation, 'mutation' if mutation else 'query')
+            histogram = self.latency.get(key)
+            if histogram is None:
+                histogram = self.latency[key] = Histogram()
+            histogram.observe(elapsed)
+
+    # ---- reporting ---------------------------------------------------------
+
+    @property
+    def wall_seconds(self) -> float:
+        return time.perf_counter() - self._started
+
+    def summary(self) -> Dict:
+        """Everything collected so far as a JSON-serialisable dict"""
+        with self._lock:
+            totals = Counter()
+            for stats in self.requests.values():
+                totals.update(stats)
+            return {
+                'run': self.run,
+                'started_at': self.started_at,
+                'wall_seconds': self.wall_seconds,
+                'phases': {name: {'seconds': seconds, 'calls': calls}
+                           for name, (seconds, calls) in sorted(self.phases.items())},
+                'counters': {**dict(totals), **self.counters},
+                'gauges': dict(self.gauges),
+                'operations': {name: dict(stats) for name, stats in sorted(self.requests.items())},
+                'latency': {f"{operation} ({kind})": histogram.to_dict()
+                            for (operation, kind), histogram in sorted(self.latency.items())},
+            }
+
+    def to_prometheus(self) -> str:
+        """The summary in the Prometheus text exposition format"""
+        summary = self.summary()
+        run = summary['run']
+        with self._lock:
+            events = dict(self.counters)
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            full_name = f"{METRIC_PREFIX}_{name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for suffix, labels, value in samples:
+                lines.append(f"{full_name}{suffix}{_labels(run=run, **labels)} {value}")
+
+        metric('run_wall_seconds', 'gauge', "Wall-clock duration of the run",
+               [('', {}, summary['wall_seconds'])])
+        metric('run_started_timestamp_seconds', 'gauge', "Unix time the run started",
+               [('', {}, summary['started_at'])])
+        metric('phase_seconds_total', 'counter', "Time spent in each phase (phases nest and sum across threads)",
+               [('', {'phase': name}, row['seconds']) for name, row in summary['phases'].items()])
+        metric('phase_calls_total', 'counter', "Times each phase was entered",
+               [('', {'phase': name}, row['calls']) for name, row in summary['phases'].items()])
+        for field, help_text in (('requests', "HTTP requests sent, including retried attempts"),
+                                 ('failures', "Requests that failed with a transient error"),
+                                 ('bytes_sent', "Request body bytes sent"),
+                                 ('bytes_received', "Response body bytes received (decompressed)")):
+            metric(f"graphql_{field}_total", 'counter', help_text,
+                   [('', {'operation': name}, stats.get(field, 0)) for name, stats in summary['operations'].items()])
+        metric('events_total', 'counter', "Events counted during the run (retries, merges, deletions, ...)",
+               [('', {'event': name}, value) for name, value in sorted(events.items())])
+        if self.gauges:
+            metric('gauge', 'gauge', "Values recorded at the end of the run",
+                   [('', {'name': name}, value) for name, value in sorted(self.gauges.items())])
+
+        samples = []
+        with self._lock:
+            for (operation, kind), histogram in sorted(self.latency.items()):
+                labels = {'operation': operation, 'type': kind}
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    samples.append(('_bucket', {**labels, 'le': bound}, count))
+                samples.append(('_bucket', {**labels, 'le': '+Inf'}, histogram.count))
+                samples.append(('_sum', labels, histogram.sum))
+                samples.append(('_count', labels, histogram.count))
+        metric('graphql_request_duration_seconds', 'histogram', "GraphQL request latency", samples)
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str) -> Tuple[str, str]:
+        """Write the JSON summary to `path` and the Prometheus text next to it (.prom)"""
+        prom_path = os.path.splitext(path)[0] + '.prom'
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, indent=2)
+        # Write then rename so a textfile collector never reads half a file
+        with open(prom_path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        os.replace(prom_path + '.tmp', prom_path)
+        return path, prom_path
+
+    def print_report(self):
+        """Print where the run's time went, phase by phase"""
+        summary = self.summary()
+        if not summary['phases']:
+            return
+        counters = summary['counters']
+        print(f"\n🧭 Run phases ({summary['wall_seconds']:.1f}s wall; phases nest and sum across threads):")
+        print(f"   {'phase':<32} {'seconds':>9} {'calls':>7} {'% wall':>7}")
+        for name, row in sorted(summary['phases'].items(), key=lambda item: -item[1]['seconds']):
+            share = row['seconds'] / summary['wall_seconds'] * 100 if summary['wall_seconds'] else 0.0
+            print(f"   {name:<32} {row['seconds']:>9.2f} {row['calls']:>7} {share:>6.0f}%")
+        if counters.get('requests'):
+            print(f"   {counters['requests']} requests, {counters.get('bytes_sent', 0) / 1024:.0f} KiB sent, "
+                  f"{counters.get('bytes_received', 0) / 1024:.0f} KiB received")
+
+
+@contextlib.contextmanager
+def profile_run(mode: Optional[str], metrics: Optional[RunMetrics] = None,
+                output: str = 'run_profile.prof') -> Iterator[None]:
+    """
+    Profile the enclosed block: 'cprofile' writes `output` (open it with
+    snakeviz or pstats) and prints the slowest functions, 'tracemalloc' prints
+    the biggest allocation sites and records the peak. None does nothing.
+    cProfile only sees the calling thread, so with MERGE_WORKERS > 1 the merge
+    work itself shows up as time waiting on the pool.
+    """
+    if not mode:
+        yield
+        return
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"profile mode must be one of {', '.join(PROFILE_MODES)}, got {mode!r}")
+
+    if mode == 'cprofile':
+        import cProfile
+        import pstats
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(output)
+            print(f"\n🔬 cProfile: top {PROFILE_TOP_ENTRIES} functions by cumulative time (full profile in {output})")
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(PROFILE_TOP_ENTRIES)
+        return
+
+    import tracemalloc
+
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        if metrics:
+            metrics.set_gauge('tracemalloc_peak_bytes', peak)
+            metrics.set_gauge('tracemalloc_current_bytes', current)
+        print(f"\n🔬 tracemalloc: peak {peak / (1024 * 1024):.1f} MiB traced, "
+              f"{current / (1024 * 1024):.1f} MiB still allocated at the end")
+        for stat in snapshot.statistics('lineno')[:PROFILE_TOP_ENTRIES]:
+            print(f"   {stat.size / 1024:>10.0f} KiB  {stat.count:>8} blocks  {stat.traceback}")
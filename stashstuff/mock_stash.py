@@ -0,0 +1,773 @@
+"""
+Local stand-in for a Stash GraphQL server, for benchmarks and dry runs.
+
+Serves the operations the scripts use - findDuplicateScenes, findScenes,
+findSceneMarkers, sceneMerge, sceneUpdate, sceneDestroy, deleteFiles,
+sceneMarkerCreate and sceneMarkerDestroy - over a synthetic library
+generated from a seed, so every run starts from the same data:
+
+  * a share of the scenes form duplicate groups whose phashes are a few
+    bits apart (found by findDuplicateScenes at distance >= 4, like Stash)
+  * a share have an MP4 and an MKV file, MP4 primary (update-dupes work)
+  * every scene gets markers, some of them starting within a second of
+    another one (cleanup_overlapping_markers work)
+
+Requests are parsed with a small GraphQL reader (operations, aliases,
+variables, fragments, nested selections), and responses contain only the
+fields that were asked for, so payload sizes are realistic. As in Stash
+(gqlgen), a failed non-null root field - sceneMarkerDestroy, deleteFiles,
+sceneDestroy (Boolean!) and sceneMerge - nulls the whole data object, while
+the other fields in the document still run. Latency, HTTP
+503s and dropped connections can be injected. GET /stats returns request
+and operation counts, POST /reset regenerates the library.
+
+    python -m stashstuff.mock_stash --scenes 5000 --port 9999 --latency 0.005
+"""
+
+import argparse
+import json
+import random
+import re
+import socket
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+from stashstuff.phash_index import PhashIndex, parse_timestamp
+
+# ====== CONFIGURATION ======
+DEFAULT_SCENES = 1000
+DEFAULT_DUPLICATE_FRACTION = 0.2   # Share of scenes that belong to a duplicate group
+DEFAULT_MULTI_FILE_FRACTION = 0.1  # Share of scenes with an MP4 and an MKV file
+DEFAULT_MARKERS_PER_SCENE = 4      # Average markers per scene
+DEFAULT_OVERLAP_FRACTION = 0.3     # Chance that a marker gets a near-duplicate
+DEFAULT_PER_PAGE = 25              # Stash's default page size
+TAG_COUNT = 50
+EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+# ---- GraphQL reader ---------------------------------------------------------
+
+_TOKEN_RE = re.compile(r'''
+    (?P<ignored>[\s,]+|\#[^\n]*)
+  | (?P<spread>\.\.\.)
+  | (?P<punct>[{}()\[\]:!$=@|&])
+  | (?P<string>"(?:\\.|[^"\\])*")
+  | (?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+  | (?P<name>[_A-Za-z][_0-9A-Za-z]*)
+''', re.VERBOSE)
+
+
+class GraphQLSyntaxError(Exception):
+    pass
+
+
+class Variable:
+    __slots__ = ('name',)
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+class Field:
+    """One field of a selection set; children is None for leaf fields"""
+
+    __slots__ = ('alias', 'name', 'args', 'children')
+
+    def __init__(self, alias: str, name: str, args: Dict, children: Optional[List]):
+        self.alias = alias
+        self.name = name
+        self.args = args
+        self.children = children
+
+
+class FragmentSpread:
+    __slots__ = ('name',)
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+def tokenize(source: str) -> List[Tuple[str, str]]:
+    tokens = []
+    position = 0
+    while position < len(source):
+        match = _TOKEN_RE.match(source, position)
+        if not match:
+            raise GraphQLSyntaxError(f"Unexpected character {source[position]!r} at {position}")
+        position = match.end()
+        if match.lastgroup != 'ignored':
+            tokens.append((match.lastgroup, match.group()))
+    return tokens
+
+
+class Parser:
+    """Recursive-descent reader for the subset of GraphQL the scripts send"""
+
+    def __init__(self, source: str):
+        self.tokens = tokenize(source)
+        self.position = 0
+
+    def peek(self, offset: int = 0) -> Tuple[Optional[str], Optional[str]]:
+        index = self.position + offset
+        return self.tokens[index] if index < len(self.tokens) else (None, None)
+
+    def take(self, value: Optional[str] = None) -> str:
+        kind, text = self.peek()
+        if kind is None or (value is not None and text != value):
+            raise GraphQLSyntaxError(f"Expected {value or 'token'}, got {text!r}")
+        self.position += 1
+        return text
+
+    def document(self) -> Tuple[str, List, Dict[str, List]]:
+        """Returns (operation type, root selections, fragments by name)"""
+        operation, selections, fragments = None, None, {}
+        while self.peek()[0] is not None:
+            _, text = self.peek()
+            if text == 'fragment':
+                self.take()
+                name = self.take()
+                self.take('on')
+                self.take()
+                fragments[name] = self.selection_set()
+            elif text == '{':
+                operation, selections = 'query', self.selection_set()
+            else:
+                operation = self.take()
+                if self.peek()[0] == 'name':
+                    self.take()
+                if self.peek()[1] == '(':
+                    self.skip_balanced('(', ')')
+                selections = self.selection_set()
+        if selections is None:
+            raise GraphQLSyntaxError("No operation in document")
+        return operation, selections, fragments
+
+    def skip_balanced(self, open_char: str, close_char: str):
+        depth = 0
+        while True:
+            text = self.take()
+            if text == open_char:
+                depth += 1
+            elif text == close_char:
+                depth -= 1
+                if not depth:
+                    return
+
+    def selection_set(self) -> List:
+        self.take('{')
+        selections = []
+        while self.peek()[1] != '}':
+            if self.peek()[0] == 'spread':
+                self.take()
+                if self.peek()[1] == 'on':
+                    self.take()
+                    self.take()
+                    selections.extend(self.selection_set())
+                else:
+                    selections.append(FragmentSpread(self.take()))
+                continue
+            alias = name = self.take()
+            if self.peek()[1] == ':':
+                self.take()
+                name = self.take()
+            args = self.arguments() if self.peek()[1] == '(' else {}
+            children = self.selection_set() if self.peek()[1] == '{' else None
+            selections.append(Field(alias, name, args, children))
+        self.take('}')
+        return selections
+
+    def arguments(self) -> Dict:
+        self.take('(')
+        args = {}
+        while self.peek()[1] != ')':
+            name = self.take()
+            self.take(':')
+            args[name] = self.value()
+        self.take(')')
+        return args
+
+    def value(self) -> Any:
+        kind, text = self.peek()
+        if text == '$':
+            self.take()
+            return Variable(self.take())
+        if text == '[':
+            self.take()
+            items = []
+            while self.peek()[1] != ']':
+                items.append(self.value())
+            self.take(']')
+            return items
+        if text == '{':
+            self.take()
+            fields = {}
+            while self.peek()[1] != '}':
+                name = self.take()
+                self.take(':')
+                fields[name] = self.value()
+            self.take('}')
+            return fields
+        self.take()
+        if kind == 'string':
+            return json.loads(text)
+        if kind == 'number':
+            return float(text) if any(c in text for c in '.eE') else int(text)
+        return {'true': True, 'false': False, 'null': None}.get(text, text)
+
+
+def substitute(value: Any, variables: Dict) -> Any:
+    """Replace Variable references in a parsed argument value"""
+    if isinstance(value, Variable):
+        return variables.get(value.name)
+    if isinstance(value, list):
+        return [substitute(item, variables) for item in value]
+    if isinstance(value, dict):
+        return {key: substitute(item, variables) for key, item in value.items()}
+    return value
+
+
+def project(value: Any, selections: Optional[List], fragments: Dict[str, List]) -> Any:
+    """Keep only the selected fields of a result object (recursively)"""
+    if selections is None or value is None:
+        return value
+    if isinstance(value, list):
+        return [project(item, selections, fragments) for item in value]
+    result = {}
+    for selection in selections:
+        if isinstance(selection, FragmentSpread):
+            result.update(project(value, fragments[selection.name], fragments))
+        elif selection.name == 'fingerprint':
+            result[selection.alias] = value.get('fingerprints', {}).get(selection.args.get('type'))
+        elif selection.name == '__typename':
+            result[selection.alias] = value.get('__typename')
+        else:
+            result[selection.alias] = project(value.get(selection.name), selection.children, fragments)
+    return result
+
+
+# ---- synthetic library ------------------------------------------------------
+
+def _timestamp(moment: datetime) -> str:
+    return moment.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _compare(actual, criterion: Dict, convert=lambda v: v) -> bool:
+    modifier = criterion.get('modifier', 'EQUALS')
+    if modifier in ('IS_NULL', 'NOT_NULL'):
+        return (actual is None) == (modifier == 'IS_NULL')
+    if actual is None:
+        return False
+    actual, expected = convert(actual), convert(criterion.get('value'))
+    if modifier == 'EQUALS':
+        return actual == expected
+    if modifier == 'NOT_EQUALS':
+        return actual != expected
+    if modifier == 'GREATER_THAN':
+        return actual > expected
+    if modifier == 'LESS_THAN':
+        return actual < expected
+    raise ValueError(f"Unsupported modifier {modifier}")
+
+
+class MockLibrary:
+    """Scenes, files and markers generated from a seed, with the mutations applied to them"""
+
+    def __init__(self, scenes: int = DEFAULT_SCENES, duplicate_fraction: float = DEFAULT_DUPLICATE_FRACTION,
+                 multi_file_fraction: float = DEFAULT_MULTI_FILE_FRACTION,
+                 markers_per_scene: float = DEFAULT_MARKERS_PER_SCENE,
+                 overlap_fraction: float = DEFAULT_OVERLAP_FRACTION, seed: int = 0):
+        self.settings = dict(scenes=scenes, duplicate_fraction=duplicate_fraction,
+                             multi_file_fraction=multi_file_fraction, markers_per_scene=markers_per_scene,
+                             overlap_fraction=overlap_fraction, seed=seed)
+        self.lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        settings = self.settings
+        rng = random.Random(settings['seed'])
+        with self.lock:
+            self.scenes: Dict[int, Dict] = {}
+            self.markers: Dict[int, Dict] = {}
+            self.markers_by_scene: Dict[int, Dict[int, Dict]] = defaultdict(dict)
+            self.files: Dict[int, Dict] = {}
+            self._next_file_id = 1
+            self._next_marker_id = 1
+            self._clock = EPOCH
+            self._phash_index = None
+            tags = [{'id': str(i), 'name': f"Tag {i}"} for i in range(1, TAG_COUNT + 1)]
+            studios = [{'id': str(i), 'name': f"Studio {i}"} for i in range(1, 21)]
+
+            count = settings['scenes']
+            scene_ids = list(range(1, count + 1))
+            phashes = {scene_id: rng.getrandbits(64) for scene_id in scene_ids}
+            duplicates = rng.sample(scene_ids, int(count * settings['duplicate_fraction']))
+            while len(duplicates) >= 2:
+                size = min(len(duplicates), rng.choice((2, 2, 2, 3)))
+                group, duplicates = duplicates[:size], duplicates[size:]
+                base = rng.getrandbits(64)
+                for scene_id in group:
+                    flips = 0
+                    for bit in rng.sample(range(64), rng.randint(0, 2)):
+                        flips |= 1 << bit
+                    phashes[scene_id] = base ^ flips
+            multi_file = set(rng.sample(scene_ids, int(count * settings['multi_file_fraction'])))
+
+            for scene_id in scene_ids:
+                created = EPOCH + timedelta(minutes=scene_id)
+                scene = {
+                    '__typename': 'Scene',
+                    'id': str(scene_id),
+                    'title': f"Scene {scene_id}" if rng.random() < 0.8 else '',
+                    'date': (EPOCH - timedelta(days=rng.randint(0, 3650))).strftime('%Y-%m-%d'),
+                    'created_at': _timestamp(created),
+                    'updated_at': _timestamp(created),
+                    'resume_time': 0,
+                    'play_count': rng.randint(0, 5),
+                    'rating100': rng.choice((None, None, 60, 80, 100)),
+                    'studio': rng.choice(studios) if rng.random() < 0.6 else None,
+                    'performers': [{'id': str(rng.randint(1, 500)), 'name': 'Performer'}
+                                   for _ in range(rng.randint(0, 3))],
+                    'paths': {key: f"http://mock/scene/{scene_id}/{key}" for key in (
+                        'screenshot', 'preview', 'stream', 'webp', 'vtt', 'sprite', 'funscript',
+                        'interactive_heatmap', 'caption')},
+                    'files': [],
+                }
+                extensions = ('mp4', 'mkv') if scene_id in multi_file else (rng.choice(('mp4', 'mp4', 'mkv')),)
+                for extension in extensions:
+                    scene['files'].append(self._new_file(rng, scene_id, extension, phashes[scene_id]))
+                self.scenes[scene_id] = scene
+
+                for _ in range(int(rng.expovariate(1 / settings['markers_per_scene'])) if settings['markers_per_scene'] else 0):
+                    seconds = round(rng.uniform(0, 1800), 1)
+                    self._new_marker(rng, scene_id, seconds, tags, created)
+                    if rng.random() < settings['overlap_fraction']:
+                        self._new_marker(rng, scene_id, round(seconds + rng.uniform(0, 1), 1), tags, created)
+
+    def _new_file(self, rng: random.Random, scene_id: int, extension: str, phash: int) -> Dict:
+        file_id = self._next_file_id
+        self._next_file_id += 1
+        basename = f"scene_{scene_id}_{file_id}.{extension}"
+        file_info = {
+            'id': str(file_id),
+            'path': f"/data/library/{basename}",
+            'basename': basename,
+            'size': rng.randint(200, 8000) * 1024 * 1024,
+            'duration': round(rng.uniform(300, 3600), 2),
+            'video_codec': 'hevc' if extension == 'mkv' and rng.random() < 0.7 else 'h264',
+            'width': 1920,
+            'height': 1080,
+            'frame_rate': 29.97,
+            'bit_rate': rng.randint(1000, 20000) * 1000,
+            'fingerprints': {'phash': format(phash, '016x')},
+        }
+        self.files[file_id] = file_info
+        return file_info
+
+    def _new_marker(self, rng: random.Random, scene_id: int, seconds: float, tags: List[Dict], created: datetime):
+        marker_id = self._next_marker_id
+        self._next_marker_id += 1
+        self.markers[marker_id] = self.markers_by_scene[scene_id][marker_id] = {
+            'id': str(marker_id),
+            'scene_id': scene_id,
+            'title': f"Marker {marker_id}",
+            'seconds': seconds,
+            'end_seconds': round(seconds + rng.uniform(5, 60), 1) if rng.random() < 0.3 else None,
+            'primary_tag': rng.choice(tags),
+            'created_at': _timestamp(created),
+            'updated_at': _timestamp(created),
+        }
+
+    def _touch(self) -> str:
+        """A strictly increasing timestamp for writes"""
+        self._clock = max(self._clock + timedelta(seconds=1), datetime.now(timezone.utc).replace(microsecond=0))
+        return _timestamp(self._clock)
+
+    # ---- views ----
+
+    def _scene_view(self, scene: Dict) -> Dict:
+        markers = self.markers_by_scene.get(int(scene['id']), {})
+        return {**scene, 'scene_markers': [self._marker_view(m, with_scene=False) for m in markers.values()]}
+
+    def _marker_view(self, marker: Dict, with_scene: bool = True) -> Dict:
+        view = dict(marker)
+        if with_scene:
+            scene = self.scenes.get(marker['scene_id'])
+            view['scene'] = {'id': str(marker['scene_id']), 'title': scene['title'] if scene else None}
+        return view
+
+    @staticmethod
+    def _page(items: List, page_filter: Optional[Dict], sort_keys: Dict) -> List:
+        page_filter = page_filter or {}
+        key = sort_keys.get(page_filter.get('sort') or 'id', sort_keys['id'])
+        items = sorted(items, key=key, reverse=page_filter.get('direction') == 'DESC')
+        per_page = page_filter.get('per_page', DEFAULT_PER_PAGE)
+        if per_page is None or per_page < 0:
+            return items
+        start = (max(1, page_filter.get('page') or 1) - 1) * per_page
+        return items[start:start + per_page]
+
+    def _scene_matches(self, scene: Dict, scene_filter: Optional[Dict]) -> bool:
+        for name, criterion in (scene_filter or {}).items():
+            if criterion is None:
+                continue
+            if name == 'id':
+                if not _compare(scene['id'], criterion, int):
+                    return False
+            elif name in ('updated_at', 'created_at'):
+                if not _compare(scene[name], criterion, parse_timestamp):
+                    return False
+            elif name == 'file_count':
+                if not _compare(len(scene['files']), criterion):
+                    return False
+            elif name == 'has_markers':
+                if bool(self.markers_by_scene.get(int(scene['id']))) != (str(criterion).lower() == 'true'):
+                    return False
+            else:
+                raise ValueError(f"Unsupported scene filter {name}")
+        return True
+
+    # ---- queries ----
+
+    def find_scenes(self, ids=None, scene_filter=None, filter=None, **_) -> Dict:
+        if ids is not None:
+            candidates = [self.scenes[int(i)] for i in ids if int(i) in self.scenes]
+        else:
+            candidates = list(self.scenes.values())
+        matching = [s for s in candidates if self._scene_matches(s, scene_filter)]
+        page = self._page(matching, filter, {
+            'id': lambda s: int(s['id']),
+            'updated_at': lambda s: (s['updated_at'], int(s['id'])),
+            'created_at': lambda s: (s['created_at'], int(s['id'])),
+        })
+        return {'count': len(matching), 'scenes': [self._scene_view(s) for s in page]}
+
+    def find_scene_markers(self, scene_marker_filter=None, filter=None, **_) -> Dict:
+        marker_filter = dict(scene_marker_filter or {})
+        scene_filter = marker_filter.pop('scene_filter', None)
+        candidates = self.markers.values()
+        scene_id = (scene_filter or {}).get('id') or {}
+        if scene_id.get('modifier', 'EQUALS') == 'EQUALS' and scene_id.get('value') is not None:
+            candidates = self.markers_by_scene.get(int(scene_id['value']), {}).values()
+        matching = []
+        for marker in candidates:
+            if scene_filter:
+                scene = self.scenes.get(marker['scene_id'])
+                if scene is None or not self._scene_matches(scene, scene_filter):
+                    continue
+            if any(criterion is not None and not _compare(marker[name], criterion, parse_timestamp)
+                   for name, criterion in marker_filter.items()):
+                continue
+            matching.append(marker)
+        page = self._page(matching, filter, {
+            'id': lambda m: int(m['id']),
+            'scene_id': lambda m: (m['scene_id'], int(m['id'])),
+            'seconds': lambda m: (m['seconds'], int(m['id'])),
+            'updated_at': lambda m: (m['updated_at'], int(m['id'])),
+        })
+        return {'count': len(matching), 'scene_markers': [self._marker_view(m) for m in page]}
+
+    def find_duplicate_scenes(self, distance=0, **_) -> List[List[Dict]]:
+        if self._phash_index is None:
+            index = PhashIndex()
+            for scene in self.scenes.values():
+                for file_info in scene['files']:
+                    index.add(scene['id'], int(file_info['fingerprints']['phash'], 16))
+            self._phash_index = index
+        groups = self._phash_index.duplicate_groups(distance or 0)
+        return [[self._scene_view(self.scenes[int(scene_id)]) for scene_id in group] for group in groups]
+
+    # ---- mutations ----
+
+    def scene_merge(self, input=None, **_) -> Optional[Dict]:
+        destination = self.scenes.get(int(input['destination']))
+        sources = [self.scenes.get(int(scene_id)) for scene_id in input['source']]
+        if destination is None or any(source is None for source in sources):
+            raise ValueError("scene not found")
+        for source in sources:
+            destination['files'].extend(source['files'])
+            for marker_id, marker in self.markers_by_scene.pop(int(source['id']), {}).items():
+                marker['scene_id'] = int(destination['id'])
+                self.markers_by_scene[int(destination['id'])][marker_id] = marker
+            del self.scenes[int(source['id'])]
+        self._set_primary(destination, (input.get('values') or {}).get('primary_file_id'))
+        destination['updated_at'] = self._touch()
+        self._phash_index = None
+        return self._scene_view(destination)
+
+    def scene_update(self, input=None, **_) -> Dict:
+        scene = self.scenes.get(int(input['id']))
+        if scene is None:
+            raise ValueError(f"scene {input['id']} not found")
+        self._set_primary(scene, input.get('primary_file_id'))
+        scene['updated_at'] = self._touch()
+        return self._scene_view(scene)
+
+    @staticmethod
+    def _set_primary(scene: Dict, file_id):
+        if file_id is None:
+            return
+        for index, file_info in enumerate(scene['files']):
+            if file_info['id'] == str(file_id):
+                scene['files'].insert(0, scene['files'].pop(index))
+                return
+        raise ValueError(f"file {file_id} is not part of scene {scene['id']}")
+
+    def scene_destroy(self, input=None, **_) -> bool:
+        scene = self.scenes.pop(int(input['id']), None)
+        if scene is None:
+            raise ValueError(f"scene {input['id']} not found")
+        for marker_id in self.markers_by_scene.pop(int(input['id']), {}):
+            del self.markers[marker_id]
+        self._phash_index = None
+        return True
+
+    def delete_files(self, ids=None, **_) -> bool:
+        doomed = {str(file_id) for file_id in ids or ()}
+        for scene in self.scenes.values():
+            if any(f['id'] in doomed for f in scene['files']):
+                if scene['files'][0]['id'] in doomed:
+                    raise ValueError(f"cannot delete the primary file of scene {scene['id']}")
+                scene['files'] = [f for f in scene['files'] if f['id'] not in doomed]
+                scene['updated_at'] = self._touch()
+        for file_id in doomed:
+            self.files.pop(int(file_id), None)
+        self._phash_index = None
+        return True
+
+    def scene_marker_create(self, input=None, **_) -> Dict:
+        scene_id = int(input['scene_id'])
+        if scene_id not in self.scenes:
+            raise ValueError(f"scene {input['scene_id']} not found")
+        marker_id = self._next_marker_id
+        self._next_marker_id += 1
+        now = self._touch()
+        tag_id = input.get('primary_tag_id')
+        self.markers[marker_id] = self.markers_by_scene[scene_id][marker_id] = {
+            'id': str(marker_id),
+            'scene_id': scene_id,
+            'title': input.get('title') or '',
+            'seconds': input['seconds'],
+            'end_seconds': input.get('end_seconds'),
+            'primary_tag': {'id': str(tag_id), 'name': f"Tag {tag_id}"} if tag_id is not None else None,
+            'created_at': now,
+            'updated_at': now,
+        }
+        return self._marker_view(self.markers[marker_id])
+
+    def scene_marker_destroy(self, id=None, **_) -> bool:
+        marker = self.markers.pop(int(id), None)
+        if marker is None:
+            raise ValueError(f"scene marker {id} not found")
+        scene_markers = self.markers_by_scene[marker['scene_id']]
+        del scene_markers[int(id)]
+        if not scene_markers:
+            del self.markers_by_scene[marker['scene_id']]
+        return True
+
+    RESOLVERS = {
+        'findScenes': 'find_scenes',
+        'findSceneMarkers': 'find_scene_markers',
+        'findDuplicateScenes': 'find_duplicate_scenes',
+        'sceneMerge': 'scene_merge',
+        'sceneUpdate': 'scene_update',
+        'sceneDestroy': 'scene_destroy',
+        'deleteFiles': 'delete_files',
+        'sceneMarkerCreate': 'scene_marker_create',
+        'sceneMarkerDestroy': 'scene_marker_destroy',
+    }
+    # Root fields whose failure propagates up and nulls `data`
+    NON_NULL_FIELDS = {'sceneMerge', 'sceneDestroy', 'deleteFiles', 'sceneMarkerDestroy'}
+
+    def execute(self, query: str, variables: Optional[Dict] = None) -> Tuple[Dict, List[str]]:
+        """Run a GraphQL document; returns (response, root field names)"""
+        try:
+            operation, selections, fragments = Parser(query).document()
+        except GraphQLSyntaxError as e:
+            return {'errors': [{'message': f"syntax error: {e}"}]}, []
+
+        data, errors, names = {}, [], []
+        nulled = False
+        with self.lock:
+            for field in selections:
+                names.append(field.name)
+                resolver = self.RESOLVERS.get(field.name)
+                if resolver is None:
+                    errors.append({'message': f"Cannot query field \"{field.name}\"", 'path': [field.alias]})
+                    data[field.alias] = None
+                    continue
+                try:
+                    value = getattr(self, resolver)(**substitute(field.args, variables or {}))
+                except (ValueError, KeyError, TypeError) as e:
+                    errors.append({'message': str(e), 'path': [field.alias]})
+                    data[field.alias] = None
+                    nulled = nulled or field.name in self.NON_NULL_FIELDS
+                else:
+                    data[field.alias] = project(value, field.children, fragments)
+        response = {'data': None if nulled else data}
+        if errors:
+            response['errors'] = errors
+        return response, names
+
+
+# ---- HTTP server ------------------------------------------------------------
+
+class MockStashServer:
+    """
+    Serves a MockLibrary over HTTP on a background thread:
+
+        with MockStashServer(MockLibrary(scenes=5000), latency=0.005) as server:
+            client = StashGraphQLClient(server.url, 'any-key')
+    """
+
+    def __init__(self, library: MockLibrary, host: str = '127.0.0.1', port: int = 0,
+                 latency: float = 0.0, jitter: float = 0.0, mutation_latency: float = 0.0,
+                 error_rate: float = 0.0, reset_rate: float = 0.0, seed: int = 0):
+        self.library = library
+        self.latency = latency
+        self.jitter = jitter
+        self.mutation_latency = mutation_latency
+        self.error_rate = error_rate
+        self.reset_rate = reset_rate
+        self.rng = random.Random(seed)
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, **increments):
+        with self._stats_lock:
+            self.stats.update(increments)
+
+    def snapshot(self) -> Dict:
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def reset(self):
+        self.library.reset()
+        with self._stats_lock:
+            self.stats.clear()
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                # Headers and body go out in separate writes; don't let Nagle hold the body back
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: bytes):
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                server.count(bytes_out=len(body))
+
+            def do_GET(self):
+                if self.path.rstrip('/') == '/stats':
+                    self._send(200, json.dumps(server.snapshot()).encode())
+                else:
+                    self._send(404, b'{}')
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                if self.path.rstrip('/') == '/reset':
+                    server.reset()
+                    self._send(200, b'{}')
+                    return
+                server.count(requests=1, bytes_in=len(body))
+
+                with server._stats_lock:
+                    roll = server.rng.random()
+                    delay = server.latency + server.rng.uniform(0, server.jitter)
+                if roll < server.reset_rate:
+                    server.count(injected_resets=1)
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    self.close_connection = True
+                    return
+                if roll < server.reset_rate + server.error_rate:
+                    server.count(injected_errors=1)
+                    self._send(503, b'Service Unavailable')
+                    return
+
+                try:
+                    payload = json.loads(body)
+                except ValueError:
+                    self._send(400, b'{"errors":[{"message":"invalid JSON"}]}')
+                    return
+                query = payload.get('query') or ''
+                if server.mutation_latency and re.match(r'\s*mutation\b', query):
+                    delay += server.mutation_latency
+                if delay:
+                    time.sleep(delay)
+                response, names = server.library.execute(query, payload.get('variables'))
+                server.count(**Counter(f"op:{name}" for name in names))
+                self._send(200, json.dumps(response, separators=(',', ':')).encode())
+
+        return Handler
+
+    def start(self) -> 'MockStashServer':
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name='mock-stash', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a synthetic Stash library over GraphQL")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--scenes', type=int, default=DEFAULT_SCENES)
+    parser.add_argument('--duplicate-fraction', type=float, default=DEFAULT_DUPLICATE_FRACTION)
+    parser.add_argument('--multi-file-fraction', type=float, default=DEFAULT_MULTI_FILE_FRACTION)
+    parser.add_argument('--markers-per-scene', type=float, default=DEFAULT_MARKERS_PER_SCENE)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument('--jitter', type=float, default=0.0, help="random extra latency, up to this many seconds")
+    parser.add_argument('--mutation-latency', type=float, default=0.0, help="extra seconds for mutations")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of requests answered with HTTP 503")
+    parser.add_argument('--reset-rate', type=float, default=0.0, help="share of connections dropped without a response")
+    args = parser.parse_args()
+
+    library = MockLibrary(scenes=args.scenes, duplicate_fraction=args.duplicate_fraction,
+                          multi_file_fraction=args.multi_file_fraction,
+                          markers_per_scene=args.markers_per_scene, seed=args.seed)
+    server = MockStashServer(library, args.host, args.port, latency=args.latency, jitter=args.jitter,
+                             mutation_latency=args.mutation_latency, error_rate=args.error_rate,
+                             reset_rate=args.reset_rate, seed=args.seed)
+    print(f"🧪 Mock Stash with {len(library.scenes)} scenes and {len(library.markers)} markers at {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Sweep-line detection of overlapping scene markers.
+
+Markers are sorted by start time once and swept left to right, so finding
+every overlapping group is O(n log n) for the sort plus O(n) for the sweep.
+How markers are grouped depends on the mode:
+
+    anchored  - a group starts at its first marker and takes every later
+                marker starting within `within` seconds of it; the next
+                marker after that starts a new group (the original behaviour)
+    chained   - single linkage: consecutive markers whose starts are within
+                `within` seconds join the same group, so 0s, 1.9s and 3.8s
+                form one group whichever marker comes first
+    interval  - markers cover [seconds, end_seconds] (just their start when
+                end_seconds is missing); a marker joins the group when it
+                starts within `within` seconds of the furthest end so far
+
+With same_tag_only, markers are only grouped with markers that have the same
+primary tag. Each group is returned sorted by marker id, so group[0] is the
+marker to keep.
+"""
+
+from collections import defaultdict
+from typing import Dict, List
+
+OVERLAP_MODES = ('anchored', 'chained', 'interval')
+
+
+def _marker_end(marker: Dict) -> float:
+    end = marker.get('end_seconds')
+    return end if end is not None else marker['seconds']
+
+
+def _sweep(ordered: List[Dict], within: float, mode: str) -> List[List[Dict]]:
+    groups = []
+    group = []
+    anchor = None  # a marker starting within `within` seconds after `anchor` joins the current group
+    for marker in ordered:
+        start = marker['seconds']
+        if group and start - anchor <= within:
+            group.append(marker)
+            if mode == 'chained':
+                anchor = start
+            elif mode == 'interval':
+                anchor = max(anchor, _marker_end(marker))
+            continue
+        if len(group) > 1:
+            groups.append(group)
+        group = [marker]
+        anchor = _marker_end(marker) if mode == 'interval' else start
+    if len(group) > 1:
+        groups.append(group)
+    return groups
+
+
+def find_overlap_groups(markers: List[Dict], within: float, mode: str = 'anchored',
+                        same_tag_only: bool = False) -> List[List[Dict]]:
+    """Groups of two or more overlapping markers, ordered by start time, each sorted by id"""
+    if mode not in OVERLAP_MODES:
+        raise ValueError(f"Unknown overlap mode {mode!r}, expected one of {', '.join(OVERLAP_MODES)}")
+
+    if same_tag_only:
+        partitions = defaultdict(list)
+        for marker in markers:
+            partitions[(marker.get('primary_tag') or {}).get('id')].append(marker)
+        partitions = list(partitions.values())
+    else:
+        partitions = [markers]
+
+    groups = []
+    for partition in partitions:
+        groups.extend(_sweep(sorted(partition, key=lambda m: m['seconds']), within, mode))
+
+    if same_tag_only:
+        groups.sort(key=lambda group: group[0]['seconds'])
+    for group in groups:
+        group.sort(key=lambda m: int(m['id']))
+    return groups
@@ -0,0 +1,359 @@
+"""
+Local perceptual-hash index for offline duplicate detection.
+
+findDuplicateScenes makes the server compare every phash against every other
+one on each run, which takes minutes at distance 8. Instead we pull each
+scene's phash once, keep them in a local index and answer radius queries and
+all-pairs grouping here.
+
+The index uses multi-index hashing: each 64-bit phash is split into
+`chunks` substrings (16 bits each by default) and every substring gets its
+own lookup table. By the pigeonhole principle two hashes within Hamming
+distance d agree to within d // chunks bits on at least one substring, so we
+only have to probe a handful of neighbouring table keys per substring and
+verify the (few) candidates exactly.
+"""
+
+import json
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta
+from itertools import combinations
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# ====== CONFIGURATION ======
+DEFAULT_CHUNKS = 4       # Substrings per 64-bit phash (4 x 16 bits)
+PHASH_PAGE_SIZE = 1000   # Scenes fetched per findScenes request when building the index
+INDEX_VERSION = 1
+
+PHASH_BITS = 64
+PHASH_MASK = (1 << PHASH_BITS) - 1
+
+if hasattr(int, 'bit_count'):
+    def popcount(value: int) -> int:
+        return value.bit_count()
+else:  # Python < 3.10
+    def popcount(value: int) -> int:
+        return bin(value).count('1')
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return popcount(a ^ b)
+
+
+def parse_phash(value) -> Optional[int]:
+    """Convert a phash fingerprint as returned by Stash (hex string) to an unsigned 64-bit int"""
+    if value is None or value == '':
+        return None
+    if isinstance(value, int):
+        return value & PHASH_MASK
+    try:
+        return int(str(value), 16) & PHASH_MASK
+    except ValueError:
+        return None
+
+
+class UnionFind:
+    """Disjoint-set forest keyed by arbitrary hashable values"""
+
+    def __init__(self):
+        self.parent: Dict = {}
+
+    def find(self, item):
+        parent = self.parent.setdefault(item, item)
+        if parent == item:
+            return item
+        # Path halving
+        while self.parent[item] != item:
+            self.parent[item] = self.parent[self.parent[item]]
+            item = self.parent[item]
+        return item
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[root_b] = root_a
+
+    def groups(self) -> List[List]:
+        members = defaultdict(list)
+        for item in self.parent:
+            members[self.find(item)].append(item)
+        return list(members.values())
+
+
+class PhashIndex:
+    """Multi-index hash table over 64-bit scene phashes"""
+
+    def __init__(self, chunks: int = DEFAULT_CHUNKS):
+        if PHASH_BITS % chunks:
+            raise ValueError(f"chunks must divide {PHASH_BITS}, got {chunks}")
+        self.chunks = chunks
+        self.chunk_bits = PHASH_BITS // chunks
+        self.chunk_mask = (1 << self.chunk_bits) - 1
+        # Unique phash -> scene ids that have a file with that phash
+        self.scenes_by_hash: Dict[int, List[str]] = defaultdict(list)
+        self._tables: Optional[List[Dict[int, List[int]]]] = None
+        self._flip_masks: Dict[int, List[int]] = {}
+        # Latest scene updated_at seen, so the next sync only fetches newer scenes
+        self.watermark: Optional[str] = None
+
+    def __len__(self) -> int:
+        return len(self.scenes_by_hash)
+
+    @property
+    def scene_count(self) -> int:
+        return len({scene_id for ids in self.scenes_by_hash.values() for scene_id in ids})
+
+    def add(self, scene_id: str, phash: int):
+        scene_ids = self.scenes_by_hash[phash]
+        if scene_id not in scene_ids:
+            scene_ids.append(scene_id)
+            self._tables = None
+
+    def remove_scenes(self, scene_ids: Iterable[str]):
+        """Drop every phash entry for the given scenes (e.g. before re-adding their current files)"""
+        doomed = set(scene_ids)
+        if not doomed:
+            return
+        for phash in list(self.scenes_by_hash):
+            remaining = [scene_id for scene_id in self.scenes_by_hash[phash] if scene_id not in doomed]
+            if len(remaining) != len(self.scenes_by_hash[phash]):
+                if remaining:
+                    self.scenes_by_hash[phash] = remaining
+                else:
+                    del self.scenes_by_hash[phash]
+                self._tables = None
+
+    # ---- multi-index lookup ------------------------------------------------
+
+    def _chunk(self, phash: int, index: int) -> int:
+        return (phash >> (index * self.chunk_bits)) & self.chunk_mask
+
+    def _build_tables(self):
+        tables = [defaultdict(list) for _ in range(self.chunks)]
+        for phash in self.scenes_by_hash:
+            for index in range(self.chunks):
+                tables[index][self._chunk(phash, index)].append(phash)
+        self._tables = tables
+
+    def _masks_within(self, radius: int) -> List[int]:
+        """All chunk-sized bit masks with at most `radius` bits set"""
+        if radius not in self._flip_masks:
+            masks = []
+            for bits in range(radius + 1):
+                for positions in combinations(range(self.chunk_bits), bits):
+                    mask = 0
+                    for position in positions:
+                        mask |= 1 << position
+                    masks.append(mask)
+            self._flip_masks[radius] = masks
+        return self._flip_masks[radius]
+
+    def _candidates(self, phash: int, distance: int) -> set:
+        if self._tables is None:
+            self._build_tables()
+        masks = self._masks_within(distance // self.chunks)
+        candidates = set()
+        for index, table in enumerate(self._tables):
+            key = self._chunk(phash, index)
+            for mask in masks:
+                bucket = table.get(key ^ mask)
+                if bucket:
+                    candidates.update(bucket)
+        return candidates
+
+    def radius_query(self, phash: int, distance: int) -> List[Tuple[str, int]]:
+        """Return (scene_id, distance) for every indexed scene within `distance` of phash"""
+        matches = []
+        for candidate in self._candidates(phash, distance):
+            diff = hamming_distance(phash, candidate)
+            if diff <= distance:
+                for scene_id in self.scenes_by_hash[candidate]:
+                    matches.append((scene_id, diff))
+        matches.sort(key=lambda match: (match[1], int(match[0])))
+        return matches
+
+    def similar_pairs(self, distance: int, only: Optional[Iterable[int]] = None) -> Iterable[Tuple[int, int]]:
+        """
+        Yield each pair of distinct indexed phashes within `distance` once.
+        If `only` is given, just the pairs involving at least one of those phashes.
+        """
+        if only is None:
+            probes = self.scenes_by_hash.keys()
+            seen_pair = lambda a, b: b <= a
+        else:
+            probes = set(only)
+            seen_pair = lambda a, b: b in probes and b <= a
+        for phash in probes:
+            for candidate in self._candidates(phash, distance):
+                if candidate == phash or seen_pair(phash, candidate):
+                    continue
+                if hamming_distance(phash, candidate) <= distance:
+                    yield phash, candidate
+
+    def duplicate_groups(self, distance: int, only: Optional[Iterable[int]] = None) -> List[List[str]]:
+        """
+        Group scene ids whose phashes are within `distance` of each other (transitively,
+        like findDuplicateScenes). Only groups with more than one scene are returned.
+        With `only`, just the whole groups containing those phashes.
+        """
+        uf = UnionFind()
+        if only is None:
+            touched = self.scenes_by_hash.keys()
+            for a, b in self.similar_pairs(distance):
+                uf.union(self.scenes_by_hash[a][0], self.scenes_by_hash[b][0])
+        else:
+            # Probe outwards from the new phashes until no new neighbours turn up, so a
+            # new scene near one that already has duplicates brings the rest of its group
+            touched = set()
+            frontier = {phash for phash in only if phash in self.scenes_by_hash}
+            while frontier:
+                touched |= frontier
+                reached = set()
+                for a, b in self.similar_pairs(distance, only=frontier):
+                    uf.union(self.scenes_by_hash[a][0], self.scenes_by_hash[b][0])
+                    if b not in touched:
+                        reached.add(b)
+                frontier = reached
+        for phash in touched:
+            scene_ids = self.scenes_by_hash[phash]
+            for scene_id in scene_ids:
+                uf.union(scene_ids[0], scene_id)
+
+        groups = [sorted(group, key=int) for group in uf.groups() if len(group) > 1]
+        groups.sort(key=lambda group: int(group[0]))
+        return groups
+
+    # ---- persistence -------------------------------------------------------
+
+    def to_dict(self) -> Dict:
+        return {
+            'version': INDEX_VERSION,
+            'watermark': self.watermark,
+            'hashes': {format(phash, '016x'): scene_ids for phash, scene_ids in self.scenes_by_hash.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict, chunks: int = DEFAULT_CHUNKS) -> 'PhashIndex':
+        index = cls(chunks=chunks)
+        index.watermark = data.get('watermark')
+        for phash_hex, scene_ids in data.get('hashes', {}).items():
+            index.scenes_by_hash[int(phash_hex, 16)] = list(scene_ids)
+        return index
+
+    def save(self, path: str):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, chunks: int = DEFAULT_CHUNKS) -> 'PhashIndex':
+        with open(path) as f:
+            return cls.from_dict(json.load(f), chunks=chunks)
+
+
+SCENE_PHASHES_QUERY = """
+query FindScenePhashes($scene_filter: SceneFilterType, $per_page: Int!) {
+  findScenes(
+    scene_filter: $scene_filter
+    filter: { per_page: $per_page, sort: "id", direction: ASC }
+  ) {
+    count
+    scenes {
+      id
+      updated_at
+      files {
+        fingerprint(type: "phash")
+      }
+    }
+  }
+}
+"""
+
+
+def parse_timestamp(value: str) -> datetime:
+    """Parse a Stash RFC 3339 timestamp"""
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def later_timestamp(a: Optional[str], b: Optional[str]) -> Optional[str]:
+    if not a:
+        return b
+    if not b:
+        return a
+    return b if parse_timestamp(b) > parse_timestamp(a) else a
+
+
+def updated_since_filter(watermark: str) -> Dict:
+    """
+    An updated_at filter for everything changed since `watermark`. Timestamps only
+    have second resolution, so it steps back a second to catch anything written in
+    the same second as the previous sync finished reading.
+    """
+    since = (parse_timestamp(watermark) - timedelta(seconds=1)).isoformat()
+    return {'updated_at': {'value': since, 'modifier': 'GREATER_THAN'}}
+
+
+def iter_scene_phashes(client, scene_filter: Optional[Dict] = None,
+                       per_page: int = PHASH_PAGE_SIZE) -> Iterable[Tuple[str, List[int], Optional[str]]]:
+    """
+    Yield (scene_id, [phash, ...], updated_at) for every scene matching scene_filter,
+    paging by ascending scene id. Raises RuntimeError if the server returns errors.
+    """
+    after_id = None
+    while True:
+        page_filter = dict(scene_filter or {})
+        if after_id is not None:
+            page_filter['id'] = {'value': after_id, 'modifier': 'GREATER_THAN'}
+
+        result = client.execute_query(SCENE_PHASHES_QUERY, {'scene_filter': page_filter, 'per_page': per_page})
+        if 'errors' in result:
+            raise RuntimeError(f"Error fetching phashes: {result['errors']}")
+
+        scenes = result['data']['findScenes']['scenes']
+        for scene in scenes:
+            phashes = [parse_phash(f.get('fingerprint')) for f in scene.get('files') or []]
+            yield scene['id'], [phash for phash in phashes if phash is not None], scene.get('updated_at')
+
+        if len(scenes) < per_page:
+            return
+        after_id = int(scenes[-1]['id'])
+
+
+def build_phash_index(client, per_page: int = PHASH_PAGE_SIZE, chunks: int = DEFAULT_CHUNKS) -> PhashIndex:
+    """Pull every scene's phash from Stash into a new index"""
+    index = PhashIndex(chunks=chunks)
+    for scene_id, phashes, updated_at in iter_scene_phashes(client, per_page=per_page):
+        for phash in phashes:
+            index.add(scene_id, phash)
+        index.watermark = later_timestamp(index.watermark, updated_at)
+    return index
+
+
+def sync_phash_index(client, index: PhashIndex, per_page: int = PHASH_PAGE_SIZE) -> set:
+    """
+    Bring an existing index up to date with scenes created or updated since its
+    watermark (new scenes have updated_at == created_at, and tdarr replacements,
+    merges and rescans all bump updated_at). Returns the set of phashes belonging
+    to those scenes so grouping can be limited to them.
+    """
+    if not index.watermark:
+        raise ValueError("Index has no watermark - rebuild it with build_phash_index()")
+
+    scene_filter = updated_since_filter(index.watermark)
+
+    changed = {}
+    watermark = index.watermark
+    for scene_id, phashes, updated_at in iter_scene_phashes(client, scene_filter=scene_filter, per_page=per_page):
+        changed[scene_id] = phashes
+        watermark = later_timestamp(watermark, updated_at)
+
+    index.remove_scenes(changed)
+    touched = set()
+    for scene_id, phashes in changed.items():
+        for phash in phashes:
+            index.add(scene_id, phash)
+            touched.add(phash)
+    index.watermark = watermark
+    return touched
@@ -0,0 +1,143 @@
+"""
+NumPy Hamming-distance engine for phash grouping.
+
+All unique phashes live in one contiguous uint64 array. Pairs are found by
+comparing square tiles of that array against each other: XOR the tiles with
+broadcasting, popcount the result (np.bitwise_count on NumPy 2, a byte lookup
+table otherwise) and keep the cells within the threshold. Tiling keeps memory
+at roughly tile_size^2 * 10 bytes no matter how many hashes there are, so
+500k hashes can be grouped without materialising the full distance matrix.
+
+Matching pairs are unioned into the same transitive groups findDuplicateScenes
+returns. Requires numpy (only imported when this engine is selected).
+"""
+
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from stashstuff.phash_index import PhashIndex, UnionFind
+
+# ====== CONFIGURATION ======
+DEFAULT_TILE_SIZE = 512  # Hashes per tile side (~2.5 MB of scratch space, stays in cache)
+
+_BYTE_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount64(values: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """Number of set bits in each element of a uint64 array"""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values, out=out)
+    # Tile buffers are slices of a larger array; view() needs contiguous memory on older NumPy
+    as_bytes = np.ascontiguousarray(values).view(np.uint8).reshape(values.shape + (8,))
+    return _BYTE_POPCOUNT[as_bytes].sum(axis=-1, dtype=np.uint8, out=out)
+
+
+def to_phash_array(phashes: Iterable[int]) -> np.ndarray:
+    """Pack Python int phashes into a contiguous uint64 array"""
+    phashes = list(phashes)
+    return np.fromiter(phashes, dtype=np.uint64, count=len(phashes))
+
+
+class _TileBuffers:
+    """Scratch arrays reused for every tile so the inner loop doesn't allocate"""
+
+    def __init__(self, tile_size: int):
+        self.xor = np.empty((tile_size, tile_size), dtype=np.uint64)
+        self.bits = np.empty((tile_size, tile_size), dtype=np.uint8)
+        self.within = np.empty((tile_size, tile_size), dtype=bool)
+
+    def compare(self, row_block: np.ndarray, col_block: np.ndarray, distance: int) -> np.ndarray:
+        """Boolean (rows x cols) matrix of pairs within `distance`"""
+        shape = (len(row_block), len(col_block))
+        xor = self.xor[:shape[0], :shape[1]]
+        bits = self.bits[:shape[0], :shape[1]]
+        within = self.within[:shape[0], :shape[1]]
+        np.bitwise_xor(row_block[:, None], col_block[None, :], out=xor)
+        popcount64(xor, out=bits)
+        return np.less_equal(bits, distance, out=within)
+
+
+def iter_pairs_within(hashes: np.ndarray, distance: int, tile_size: int = DEFAULT_TILE_SIZE,
+                      probes: Optional[np.ndarray] = None) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Yield (rows, cols) index arrays of pairs within `distance`, one batch per tile.
+
+    Without probes every unordered pair i < j of `hashes` is yielded once. With
+    probes (indexes into hashes) only pairs involving a probe are compared; rows
+    are then probe positions in `hashes` and a pair may be yielded from both ends.
+    """
+    count = len(hashes)
+    buffers = _TileBuffers(tile_size)
+    if probes is None:
+        for row_start in range(0, count, tile_size):
+            row_block = hashes[row_start:row_start + tile_size]
+            for col_start in range(row_start, count, tile_size):
+                col_block = hashes[col_start:col_start + tile_size]
+                within = buffers.compare(row_block, col_block, distance)
+                if not within.any():
+                    continue
+                rows, cols = np.nonzero(within)
+                if col_start == row_start:
+                    upper = rows < cols
+                    rows, cols = rows[upper], cols[upper]
+                if rows.size:
+                    yield rows + row_start, cols + col_start
+    else:
+        for probe_start in range(0, len(probes), tile_size):
+            probe_indexes = probes[probe_start:probe_start + tile_size]
+            probe_block = hashes[probe_indexes]
+            for col_start in range(0, count, tile_size):
+                col_block = hashes[col_start:col_start + tile_size]
+                within = buffers.compare(probe_block, col_block, distance)
+                if not within.any():
+                    continue
+                rows, cols = np.nonzero(within)
+                cols = cols + col_start
+                rows = probe_indexes[rows]
+                keep = rows != cols
+                if keep.any():
+                    yield rows[keep], cols[keep]
+
+
+def duplicate_groups(index: PhashIndex, distance: int, tile_size: int = DEFAULT_TILE_SIZE,
+                     only: Optional[Iterable[int]] = None) -> List[List[str]]:
+    """
+    Vectorized equivalent of PhashIndex.duplicate_groups(): scene-id groups whose
+    phashes are (transitively) within `distance`. With `only`, just the whole
+    groups containing those phashes.
+    """
+    unique_hashes = list(index.scenes_by_hash)
+    hashes = to_phash_array(unique_hashes)
+    scenes_by_hash = index.scenes_by_hash
+
+    uf = UnionFind()
+    if only is None:
+        touched = range(len(unique_hashes))
+        for rows, cols in iter_pairs_within(hashes, distance, tile_size):
+            for row, col in zip(rows.tolist(), cols.tolist()):
+                uf.union(scenes_by_hash[unique_hashes[row]][0], scenes_by_hash[unique_hashes[col]][0])
+    else:
+        # Probe outwards until no new neighbours turn up, as PhashIndex.duplicate_groups() does
+        position = {phash: i for i, phash in enumerate(unique_hashes)}
+        touched = set()
+        frontier = {position[phash] for phash in only if phash in position}
+        while frontier:
+            touched |= frontier
+            reached = set()
+            probes = np.fromiter(frontier, dtype=np.int64, count=len(frontier))
+            for rows, cols in iter_pairs_within(hashes, distance, tile_size, probes=probes):
+                for row, col in zip(rows.tolist(), cols.tolist()):
+                    uf.union(scenes_by_hash[unique_hashes[row]][0], scenes_by_hash[unique_hashes[col]][0])
+                    if col not in touched:
+                        reached.add(col)
+            frontier = reached
+
+    for i in touched:
+        scene_ids = scenes_by_hash[unique_hashes[i]]
+        for scene_id in scene_ids:
+            uf.union(scene_ids[0], scene_id)
+
+    groups = [sorted(group, key=int) for group in uf.groups() if len(group) > 1]
+    groups.sort(key=lambda group: int(group[0]))
+    return groups
@@ -0,0 +1,49 @@
+"""
+Merge plans: decide first, apply later.
+
+Planning turns duplicate groups into one small record per group:
+
+    {"destination":"205","sources":["101","311"],"primary_file":"9001","delete_files":[],"best_metadata":"101"}
+
+Records are sorted by destination scene id and written one per line, so a
+plan is cheap to write, easy to diff between runs and can be applied later by
+an executor that doesn't need to fetch or score anything again.
+"""
+
+import json
+import os
+from typing import Dict, Iterable, Iterator, List
+
+
+def plan_group_key(entry: Dict) -> List[str]:
+    """Scene ids of a plan entry, in the form checkpoint.group_key() expects"""
+    return [entry['destination']] + list(entry['sources'])
+
+
+def add_file_deletions(entry: Dict, group: List[Dict]) -> Dict:
+    """List every file in the group other than the planned primary file for deletion"""
+    entry['delete_files'] = [
+        file_info['id'] for scene in group for file_info in scene.get('files') or ()
+        if file_info.get('id') != entry.get('primary_file')
+    ]
+    return entry
+
+
+def write_plan(path: str, entries: Iterable[Dict]) -> int:
+    """Write entries sorted by destination id (atomically); returns the number written"""
+    ordered = sorted(entries, key=lambda entry: int(entry['destination']))
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        for entry in ordered:
+            f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+    os.replace(tmp_path, path)
+    return len(ordered)
+
+
+def iter_plan(path: str) -> Iterator[Dict]:
+    """Yield plan entries one at a time"""
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
@@ -0,0 +1,128 @@
+"""
+Local filesystem preflight for Stash files.
+
+When the library is mounted on the machine running the scripts we don't have
+to trust the size Stash reported when it last scanned a file. preflight()
+stats every path on a thread pool (stat is I/O bound, so threads overlap the
+waits, which matters a lot on network mounts), checks the file exists and
+that its size matches, and for files whose size collides with another file
+computes a cheap partial hash: blake2b over the size plus the first and last
+PARTIAL_HASH_BLOCK bytes, read through mmap. Equal partial hashes on
+equal-sized files are a strong sign of byte-identical copies, found without
+any phash work.
+
+Paths can be rewritten with a prefix map when Stash sees the library at a
+different location than this machine (e.g. {'/data/': '/mnt/stash/'}).
+"""
+
+import hashlib
+import mmap
+import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+# ====== CONFIGURATION ======
+DEFAULT_WORKERS = 32               # Concurrent stat/hash calls
+PARTIAL_HASH_BLOCK = 64 * 1024     # Bytes hashed from each end of a file
+
+
+class FileCheck:
+    """What the disk says about one Stash file"""
+
+    __slots__ = ('file_id', 'path', 'local_path', 'expected_size', 'exists', 'size', 'partial_hash', 'error')
+
+    def __init__(self, file_id, path: str, local_path: str, expected_size: Optional[int]):
+        self.file_id = file_id
+        self.path = path
+        self.local_path = local_path
+        self.expected_size = expected_size
+        self.exists = False
+        self.size: Optional[int] = None
+        self.partial_hash: Optional[str] = None
+        self.error: Optional[str] = None
+
+    @property
+    def size_matches(self) -> bool:
+        return self.exists and (self.expected_size is None or self.size == self.expected_size)
+
+    @property
+    def ok(self) -> bool:
+        return self.size_matches and self.error is None
+
+
+def map_path(path: str, prefix_map: Optional[Dict[str, str]] = None) -> str:
+    """Rewrite the first matching server-side prefix to its local equivalent"""
+    for server_prefix, local_prefix in (prefix_map or {}).items():
+        if path.startswith(server_prefix):
+            return local_prefix + path[len(server_prefix):]
+    return path
+
+
+def partial_hash(path: str, size: int, block: int = PARTIAL_HASH_BLOCK) -> str:
+    """blake2b of the size plus the first and last `block` bytes of a file"""
+    digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+    if size:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            digest.update(data[:block])
+            if size > block:
+                digest.update(data[max(block, size - block):])
+    return digest.hexdigest()
+
+
+def _stat(check: FileCheck) -> FileCheck:
+    try:
+        check.size = os.stat(check.local_path).st_size
+        check.exists = True
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        check.error = str(e)
+    return check
+
+
+def _hash(check: FileCheck) -> FileCheck:
+    try:
+        check.partial_hash = partial_hash(check.local_path, check.size)
+    except (OSError, ValueError) as e:
+        check.error = str(e)
+    return check
+
+
+def preflight(files: Iterable[Dict], prefix_map: Optional[Dict[str, str]] = None,
+              workers: int = DEFAULT_WORKERS, hash_same_size: bool = True) -> Dict[str, FileCheck]:
+    """
+    Check Stash file dicts (id, path, size) against the disk. Returns
+    {file_id: FileCheck}. With hash_same_size, files that exist and share their
+    size with at least one other file also get a partial hash.
+    """
+    checks = []
+    seen = set()
+    for file_info in files:
+        if file_info.get('id') in seen or not file_info.get('path'):
+            continue
+        seen.add(file_info.get('id'))
+        checks.append(FileCheck(file_info.get('id'), file_info['path'],
+                                map_path(file_info['path'], prefix_map), file_info.get('size')))
+
+    with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='preflight') as pool:
+        list(pool.map(_stat, checks))
+
+        if hash_same_size:
+            by_size = defaultdict(list)
+            for check in checks:
+                if check.exists:
+                    by_size[check.size].append(check)
+            candidates = [check for same in by_size.values() if len(same) > 1 for check in same]
+            list(pool.map(_hash, candidates))
+
+    return {check.file_id: check for check in checks}
+
+
+def identical_file_groups(checks: Iterable[FileCheck]) -> List[List[FileCheck]]:
+    """Groups of files with the same size and partial hash (likely byte-identical copies)"""
+    groups = defaultdict(list)
+    for check in checks:
+        if check.partial_hash is not None:
+            groups[(check.size, check.partial_hash)].append(check)
+    return [group for group in groups.values() if len(group) > 1]
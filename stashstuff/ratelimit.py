@@ -0,0 +1,131 @@
+"""
+Adaptive token-bucket rate limiting for GraphQL requests.
+
+Fixed sleeps between calls waste time while Stash is idle and don't help
+when it is busy scanning or generating. AdaptiveRateLimiter hands out
+tokens at a rate that follows the server instead (AIMD, as in TCP
+congestion control):
+
+    slow start              until the first sign of overload every fast,
+                            successful response adds one request/s, so the
+                            rate roughly doubles each second
+    additive increase       after that, each one adds a little rate, about
+                            ADDITIVE_INCREASE requests/s per second of
+                            traffic, up to max_rate
+    multiplicative decrease an HTTP 429 or 5xx, or an operation running
+                            SLOWDOWN_THRESHOLD times slower than its best
+                            smoothed latency, multiplies the rate by
+                            DECREASE_FACTOR (at most once per DECREASE_COOLDOWN
+                            so one slow burst of concurrent requests counts once)
+
+Latency is tracked per operation, because a findScenes page and a
+sceneMarkerDestroy take very different amounts of time even on an idle
+server. A Retry-After header on a 429/503 also pauses every caller until
+that time.
+
+reserve() takes a token and returns how long the caller has to wait for it,
+so the same limiter works from threads (acquire()) and from asyncio
+(await asyncio.sleep(limiter.reserve())).
+"""
+
+import threading
+import time
+from typing import Dict, Optional
+
+# ====== CONFIGURATION ======
+DEFAULT_INITIAL_RATE = 50.0    # Requests per second to start at
+DEFAULT_MIN_RATE = 1.0         # Never throttle below this (requests per second)
+DEFAULT_MAX_RATE = 200.0       # Ceiling for the additive increase (0 = no limiter at all)
+BURST_SECONDS = 0.5            # Bucket holds this many seconds' worth of tokens
+ADDITIVE_INCREASE = 5.0        # Requests/s added per second of fast, successful responses
+DECREASE_FACTOR = 0.5          # Rate multiplier on overload
+DECREASE_COOLDOWN = 1.0        # Minimum seconds between two decreases
+SLOWDOWN_THRESHOLD = 2.0       # An operation is "slow" above this multiple of its best smoothed latency
+LATENCY_SMOOTHING = 0.2        # Weight of the newest sample in the per-operation moving average
+BASELINE_DRIFT = 0.01          # Best latency creeps up this fraction per sample, so a lasting slowdown becomes the new normal
+MAX_RETRY_AFTER = 60.0         # Longest Retry-After pause we honour (seconds)
+
+
+def is_overload_status(status: Optional[int]) -> bool:
+    """HTTP 429 Too Many Requests or any 5xx"""
+    return status is not None and (status == 429 or status >= 500)
+
+
+class AdaptiveRateLimiter:
+    """Thread-safe token bucket whose rate follows observed latency and errors"""
+
+    def __init__(self, initial_rate: float = DEFAULT_INITIAL_RATE, min_rate: float = DEFAULT_MIN_RATE,
+                 max_rate: float = DEFAULT_MAX_RATE):
+        self.enabled = bool(max_rate and max_rate > 0)
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate) if self.enabled else min_rate
+        self.rate = max(self.min_rate, min(initial_rate, max_rate)) if self.enabled else 0.0
+        self.tokens = 1.0  # Start empty-handed so a pool of workers doesn't open with a burst
+        self.decreases = 0
+        self.slow_start = True
+        self._updated = time.monotonic()
+        self._last_decrease = float('-inf')
+        self._paused_until = 0.0
+        self._average: Dict[str, float] = {}
+        self._best: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _capacity(self) -> float:
+        return max(1.0, self.rate * BURST_SECONDS)
+
+    def reserve(self) -> float:
+        """Take one token; returns the number of seconds to wait before using it"""
+        if not self.enabled:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self._capacity(), self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            return max(delay, self._paused_until - now)
+
+    def acquire(self):
+        """Block until a token is available"""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def observe(self, name: str, elapsed: float, status: Optional[int] = None,
+                retry_after: Optional[str] = None):
+        """Feed back one finished request: operation name, seconds taken, HTTP status"""
+        if not self.enabled:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if is_overload_status(status):
+                self._decrease(now)
+                if retry_after:
+                    try:
+                        pause = min(MAX_RETRY_AFTER, float(retry_after))
+                    except ValueError:
+                        pause = 0.0
+                    self._paused_until = max(self._paused_until, now + pause)
+                return
+
+            average = self._average.get(name)
+            average = elapsed if average is None else average + LATENCY_SMOOTHING * (elapsed - average)
+            self._average[name] = average
+            best = self._best[name] = min(self._best.get(name, average) * (1 + BASELINE_DRIFT), average)
+
+            if average > best * SLOWDOWN_THRESHOLD:
+                self._decrease(now)
+            elif self.slow_start:
+                self.rate = min(self.max_rate, self.rate + 1)
+            else:
+                # +ADDITIVE_INCREASE per second at the current rate, whatever that rate is
+                self.rate = min(self.max_rate, self.rate + ADDITIVE_INCREASE / self.rate)
+
+    def _decrease(self, now: float):
+        if now - self._last_decrease < DECREASE_COOLDOWN:
+            return
+        self._last_decrease = now
+        self.slow_start = False
+        self.rate = max(self.min_rate, self.rate * DECREASE_FACTOR)
+        self.tokens = min(self.tokens, self._capacity())
+        self.decreases += 1
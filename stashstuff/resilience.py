@@ -0,0 +1,218 @@
+"""
+Timeouts, retries and a circuit breaker for GraphQL calls.
+
+A long unattended run has to get through Stash restarts, connection resets
+and scan-induced stalls:
+
+  * every request has a read timeout (per operation, so findDuplicateScenes
+    can take its time while a stalled sceneMerge doesn't hang the run)
+  * queries are idempotent, so failed ones are retried with jittered
+    exponential backoff ("full jitter": a random delay up to
+    base * 2**attempt, capped), which keeps many workers from retrying in
+    lock step
+  * mutations are only sent again when the server certainly didn't process
+    them (connection refused, connect timeout, 429/503) or when the caller
+    supplied a verify() that checks the server and says it wasn't applied
+  * CircuitBreaker counts consecutive failures across all callers; once
+    the server looks unhealthy it pauses every request for a growing
+    cooldown and lets a single probe through before resuming, so the
+    pipeline waits out a restart instead of burning through its work
+    queue with errors
+
+Failures that can't be retried come back as a GraphQL-style
+{'errors': [...]} result, which every script already checks for.
+"""
+
+import asyncio
+import contextlib
+import random
+import re
+import threading
+import time
+from typing import AsyncIterator, Dict, Iterator, Optional, Tuple
+
+import requests
+
+try:
+    from urllib3.exceptions import NewConnectionError
+except ImportError:  # pragma: no cover - urllib3 always ships with requests
+    NewConnectionError = ()
+
+# ====== CONFIGURATION ======
+DEFAULT_CONNECT_TIMEOUT = 10.0     # Seconds to establish a connection
+DEFAULT_QUERY_TIMEOUT = 120.0      # Read timeout for queries (seconds)
+DEFAULT_MUTATION_TIMEOUT = 600.0   # Read timeout for mutations (seconds)
+OPERATION_TIMEOUTS = {
+    'FindDuplicateScenes': 3600.0,  # Server-side phash comparison can take many minutes
+}
+DEFAULT_MAX_RETRIES = 5            # Retries per request (attempts paused by the breaker don't count)
+RETRY_BASE_DELAY = 0.5             # First backoff ceiling (seconds)
+RETRY_MAX_DELAY = 30.0             # Longest backoff between retries (seconds)
+BREAKER_FAILURE_THRESHOLD = 5      # Consecutive failures that open the breaker
+BREAKER_RESET_TIMEOUT = 5.0        # First pause once the breaker opens (seconds)
+BREAKER_MAX_RESET_TIMEOUT = 300.0  # Longest pause; each failed probe doubles it up to this
+BREAKER_ASYNC_POLL = 0.05          # How often async callers re-check a paused breaker (seconds)
+
+_MUTATION_RE = re.compile(r'^\s*mutation\b', re.MULTILINE)
+# Statuses that mean the request was turned away before it was processed
+_NOT_PROCESSED_STATUSES = (429, 503)
+
+
+class TransientResponseError(Exception):
+    """An HTTP 429/5xx or an unreadable response body"""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError,
+                    TransientResponseError)
+
+
+def is_mutation(query: str) -> bool:
+    return bool(_MUTATION_RE.search(query))
+
+
+def request_not_processed(error: Exception) -> bool:
+    """True if the server certainly never acted on the request, so even a mutation can be resent"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, TransientResponseError):
+        return error.status in _NOT_PROCESSED_STATUSES
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        reason = getattr(error.args[0], 'reason', None)
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+def backoff_delay(attempt: int, base: float = RETRY_BASE_DELAY, cap: float = RETRY_MAX_DELAY) -> float:
+    """Full-jitter exponential backoff for the given retry (1 = first retry)"""
+    return random.uniform(0, min(cap, base * (2 ** (attempt - 1))))
+
+
+def error_result(message: str) -> Dict:
+    """A failure shaped like a GraphQL error response"""
+    return {'errors': [{'message': message}]}
+
+
+class CircuitBreaker:
+    """
+    Shared health switch for one server. Closed: requests flow. Open: every
+    caller waits out the cooldown. Then one probe request is let through;
+    success closes the breaker, failure reopens it with twice the cooldown.
+    Send requests inside attempt() so a probe that ends any other way (an
+    unexpected exception, a stream closed early) hands the probe on instead
+    of leaving every other caller waiting for a verdict that never comes.
+    Coroutines use async_attempt(), which waits without blocking the event
+    loop, so one breaker can be shared by the blocking and async clients.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT,
+                 max_reset_timeout: float = BREAKER_MAX_RESET_TIMEOUT):
+        self.failure_threshold = max(1, failure_threshold)
+        self.base_reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self._open_until = 0.0
+        self._probe: Optional[object] = None  # Token of the probe in flight while half-open
+        self._condition = threading.Condition()
+
+    def _poll(self) -> Tuple[bool, Optional[object], Optional[float]]:
+        """
+        With the lock held: (may send now, probe token or None, seconds until
+        the cooldown ends - None while waiting for a probe's verdict)
+        """
+        if self.state == self.CLOSED:
+            return True, None, None
+        now = time.monotonic()
+        if self.state == self.OPEN and now >= self._open_until:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN and self._probe is None:
+            self._probe = object()
+            return True, self._probe, None
+        return False, None, self._open_until - now if self.state == self.OPEN else None
+
+    def _acquire(self) -> Tuple[bool, Optional[object]]:
+        """Block until a request may be sent; returns (had to wait, probe token or None)"""
+        waited = False
+        with self._condition:
+            while True:
+                allowed, probe, timeout = self._poll()
+                if allowed:
+                    return waited or probe is not None, probe
+                waited = True
+                self._condition.wait(timeout)
+
+    def _release(self, probe: Optional[object]):
+        """Hand the probe on if it ended without a verdict"""
+        if probe is not None:
+            with self._condition:
+                if self._probe is probe:
+                    self._probe = None
+                    self._condition.notify_all()
+
+    def wait(self) -> bool:
+        """Block until a request may be sent; returns True if it had to wait"""
+        return self._acquire()[0]
+
+    @contextlib.contextmanager
+    def attempt(self) -> Iterator[bool]:
+        """
+        wait() for the enclosed request, yielding whether it had to wait. If it
+        was the half-open probe and neither record_success() nor
+        record_failure() was called, the next caller gets to probe.
+        """
+        waited, probe = self._acquire()
+        try:
+            yield waited
+        finally:
+            self._release(probe)
+
+    @contextlib.asynccontextmanager
+    async def async_attempt(self) -> AsyncIterator[bool]:
+        """attempt() for coroutines: sleeps instead of blocking the event loop"""
+        waited = False
+        while True:
+            with self._condition:
+                allowed, probe, timeout = self._poll()
+            if allowed:
+                break
+            waited = True
+            await asyncio.sleep(BREAKER_ASYNC_POLL if timeout is None else min(max(timeout, 0), BREAKER_ASYNC_POLL))
+        try:
+            yield waited or probe is not None
+        finally:
+            self._release(probe)
+
+    def record_success(self):
+        with self._condition:
+            if self.state != self.CLOSED:
+                print("▶️  Stash is responding again, resuming")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.reset_timeout = self.base_reset_timeout
+            self._probe = None
+            self._condition.notify_all()
+
+    def record_failure(self, error: Exception):
+        with self._condition:
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self.reset_timeout = min(self.max_reset_timeout, self.reset_timeout * 2)
+            elif self.state == self.OPEN or self.failures < self.failure_threshold:
+                return
+            self.state = self.OPEN
+            self.opened += 1
+            self._probe = None
+            self._open_until = time.monotonic() + self.reset_timeout
+            print(f"⏸️  Stash looks unhealthy ({self.failures} failed requests in a row, last: {error}), "
+                  f"pausing for {self.reset_timeout:.0f}s")
+            self._condition.notify_all()
@@ -0,0 +1,157 @@
+"""
+Single-pass scoring of duplicate scenes.
+
+Picking a merge destination used to walk every scene's files three or four
+times (best metadata, best file, best overall, best file within a scene),
+lower-casing paths and codecs and sorting each time. ScoringEngine walks each
+scene once, keeps the few numbers the decisions need in small __slots__
+records and picks every winner in the same pass (no sorting).
+
+Weights come from a dict so they can be tuned from a script's configuration
+instead of editing constants; anything not overridden uses DEFAULT_WEIGHTS.
+Ties go to the scene (or file) listed first, as before.
+"""
+
+from typing import Dict, List, Optional
+
+# ====== CONFIGURATION ======
+DEFAULT_WEIGHTS = {
+    'rating': 100,            # Scene has a rating
+    'title': 50,              # Scene has a non-blank title
+    'studio': 25,             # Scene has a studio
+    'performers': 25,         # Scene has performers
+    'marker': 10,             # Per scene marker
+    'size_mb': 0.1,           # Per MB of the largest file
+    'bit_rate': 0.001,        # Per bit/s of the highest bitrate file
+    'mkv': 1000,              # File is an MKV
+    'hevc': 500,              # File is HEVC / H.265
+}
+
+HEVC_CODECS = frozenset(('hevc', 'h265', 'h.265'))
+BYTES_PER_MB = 1024 * 1024
+
+
+class SceneFeatures:
+    """Per-scene scores, built in one pass over the scene's files"""
+
+    __slots__ = ('scene', 'metadata_score', 'quality_score', 'file_score', 'overall_score', '_engine')
+
+    def __init__(self, scene: Dict, metadata_score: float, quality_score: float, file_score: float, engine):
+        self.scene = scene
+        self.metadata_score = metadata_score
+        self.quality_score = quality_score      # size, bitrate and codec
+        self.file_score = file_score            # quality plus the MKV bonus
+        self.overall_score = metadata_score + quality_score
+        self._engine = engine
+
+    @property
+    def best_file(self) -> Optional[Dict]:
+        """The highest scoring file of this scene (only computed when asked for)"""
+        files = self.scene.get('files') or []
+        if not files:
+            return None
+        return max(files, key=self._engine.file_score)
+
+
+class GroupScore:
+    """Winners for one duplicate group (SceneFeatures of each winner)"""
+
+    __slots__ = ('scenes', 'best_metadata', 'best_file', 'best_overall')
+
+    def __init__(self, scenes: List[SceneFeatures], best_metadata: SceneFeatures,
+                 best_file: SceneFeatures, best_overall: SceneFeatures):
+        self.scenes = scenes
+        self.best_metadata = best_metadata
+        self.best_file = best_file
+        self.best_overall = best_overall
+
+    @property
+    def destination(self) -> SceneFeatures:
+        """The merge destination: the scene with the best file (MKV preferred)"""
+        return self.best_file
+
+
+class ScoringEngine:
+    """Scores scenes and groups with a fixed set of weights"""
+
+    def __init__(self, weights: Optional[Dict] = None):
+        unknown = set(weights or {}) - set(DEFAULT_WEIGHTS)
+        if unknown:
+            raise ValueError(f"Unknown scoring weights: {', '.join(sorted(unknown))}")
+        self.weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+        # Per-byte size weight, so the hot loop doesn't divide
+        self._size_weight = self.weights['size_mb'] / BYTES_PER_MB
+
+    def file_score(self, file_info: Dict) -> float:
+        weights = self.weights
+        score = (file_info.get('size') or 0) * self._size_weight + (file_info.get('bit_rate') or 0) * weights['bit_rate']
+        if (file_info.get('path') or '').lower().endswith('.mkv'):
+            score += weights['mkv']
+        if (file_info.get('video_codec') or '').lower() in HEVC_CODECS:
+            score += weights['hevc']
+        return score
+
+    def scene(self, scene: Dict) -> SceneFeatures:
+        weights = self.weights
+        best_size = best_bit_rate = 0
+        has_mkv = has_hevc = False
+        for file_info in scene.get('files') or ():
+            size = file_info.get('size') or 0
+            if size > best_size:
+                best_size = size
+            bit_rate = file_info.get('bit_rate') or 0
+            if bit_rate > best_bit_rate:
+                best_bit_rate = bit_rate
+            if not has_mkv and (file_info.get('path') or '').lower().endswith('.mkv'):
+                has_mkv = True
+            if not has_hevc and (file_info.get('video_codec') or '').lower() in HEVC_CODECS:
+                has_hevc = True
+
+        rating = scene.get('rating100')
+        title = scene.get('title')
+        metadata_score = len(scene.get('scene_markers') or ()) * weights['marker']
+        if rating and rating != 'None':
+            metadata_score += weights['rating']
+        if title and title.strip():
+            metadata_score += weights['title']
+        if scene.get('studio'):
+            metadata_score += weights['studio']
+        if scene.get('performers'):
+            metadata_score += weights['performers']
+
+        quality_score = best_size * self._size_weight + best_bit_rate * weights['bit_rate']
+        if has_hevc:
+            quality_score += weights['hevc']
+        file_score = quality_score + weights['mkv'] if has_mkv else quality_score
+        return SceneFeatures(scene, metadata_score, quality_score, file_score, self)
+
+    def group(self, scenes: List[Dict]) -> GroupScore:
+        """Score every scene of a non-empty group once and pick all winners in the same pass"""
+        features = [self.scene(scene) for scene in scenes]
+        best_metadata = best_file = best_overall = features[0]
+        for candidate in features:
+            # Strictly greater, so ties keep the scene listed first
+            if candidate.metadata_score > best_metadata.metadata_score:
+                best_metadata = candidate
+            if candidate.file_score > best_file.file_score:
+                best_file = candidate
+            if candidate.overall_score > best_overall.overall_score:
+                best_overall = candidate
+        return GroupScore(features, best_metadata, best_file, best_overall)
+
+    def plan(self, scenes: List[Dict]) -> Dict:
+        """
+        Merge decision for one group: destination (scene with the best file), the
+        sources merged into it, the scene with the best metadata and the file that
+        should end up primary (the best-scoring file in the whole group)
+        """
+        group = self.group(scenes)
+        destination = group.best_file.scene['id']
+        primary_file = max((f for scene in scenes for f in scene.get('files') or ()),
+                           key=self.file_score, default=None)
+        return {
+            'destination': destination,
+            'sources': [scene['id'] for scene in scenes if scene['id'] != destination],
+            'best_metadata': group.best_metadata.scene['id'],
+            'primary_file': primary_file.get('id') if primary_file else None,
+        }
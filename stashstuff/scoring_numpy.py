@@ -0,0 +1,143 @@
+"""
+Columnar NumPy scoring for whole-library merge plans.
+
+ScoringEngine scores one group at a time, which is fine while merging but
+slow for a "what would happen" report over every duplicate group. Here all
+groups are flattened once into flat arrays (one row per scene, one row per
+file, each tagged with its group), the scores are computed for every row at
+once, and the winners are picked with a grouped argmax: sort rows by
+(group, -score, original position) and take the first row of each group, so
+ties go to the scene listed first exactly like ScoringEngine.
+
+Requires numpy (only imported when this engine is selected).
+"""
+
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from stashstuff.scoring import BYTES_PER_MB, DEFAULT_WEIGHTS, HEVC_CODECS
+
+
+def flatten_groups(groups: List[List[Dict]]) -> Dict[str, object]:
+    """
+    One pass over the group dicts into columns. Scene rows: group, rating, title,
+    studio and performer flags, marker count. File rows: group, scene row, size,
+    bit_rate, mkv and hevc flags. Ids are kept as plain lists alongside.
+    """
+    scene_ids, scene_group, rating, title, studio, performers, markers = [], [], [], [], [], [], []
+    file_ids, file_group, file_scene, size, bit_rate, mkv, hevc = [], [], [], [], [], [], []
+
+    for group_index, group in enumerate(groups):
+        for scene in group:
+            scene_row = len(scene_ids)
+            scene_ids.append(scene['id'])
+            scene_group.append(group_index)
+            scene_rating = scene.get('rating100')
+            scene_title = scene.get('title')
+            rating.append(bool(scene_rating) and scene_rating != 'None')
+            title.append(bool(scene_title and scene_title.strip()))
+            studio.append(bool(scene.get('studio')))
+            performers.append(bool(scene.get('performers')))
+            markers.append(len(scene.get('scene_markers') or ()))
+
+            for file_info in scene.get('files') or ():
+                file_ids.append(file_info.get('id'))
+                file_group.append(group_index)
+                file_scene.append(scene_row)
+                size.append(file_info.get('size') or 0)
+                bit_rate.append(file_info.get('bit_rate') or 0)
+                mkv.append((file_info.get('path') or '').lower().endswith('.mkv'))
+                hevc.append((file_info.get('video_codec') or '').lower() in HEVC_CODECS)
+
+    return {
+        'group_count': len(groups),
+        'group_sizes': [len(group) for group in groups],
+        'scene_ids': scene_ids,
+        'scene_group': np.array(scene_group, dtype=np.int64),
+        'rating': np.array(rating, dtype=bool),
+        'title': np.array(title, dtype=bool),
+        'studio': np.array(studio, dtype=bool),
+        'performers': np.array(performers, dtype=bool),
+        'markers': np.array(markers, dtype=np.int64),
+        'file_ids': file_ids,
+        'file_group': np.array(file_group, dtype=np.int64),
+        'file_scene': np.array(file_scene, dtype=np.int64),
+        'size': np.array(size, dtype=np.float64),
+        'bit_rate': np.array(bit_rate, dtype=np.float64),
+        'mkv': np.array(mkv, dtype=bool),
+        'hevc': np.array(hevc, dtype=bool),
+    }
+
+
+def grouped_argmax(values: np.ndarray, group_of_row: np.ndarray, group_count: int) -> np.ndarray:
+    """
+    Row index of the largest value in each group (first row wins ties),
+    or -1 for groups without rows.
+    """
+    rows = np.arange(len(values))
+    order = np.lexsort((rows, -values, group_of_row))
+    sorted_groups = group_of_row[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = sorted_groups[1:] != sorted_groups[:-1]
+    winners = np.full(group_count, -1, dtype=np.int64)
+    winners[sorted_groups[first]] = order[first]
+    return winners
+
+
+def score_columns(columns: Dict, weights: Optional[Dict] = None) -> Dict[str, np.ndarray]:
+    """Metadata, per-scene file and per-file scores for every row, with ScoringEngine's formulas"""
+    weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+    size_weight = weights['size_mb'] / BYTES_PER_MB
+    scene_count = len(columns['scene_ids'])
+    file_scene = columns['file_scene']
+
+    metadata = (columns['markers'] * weights['marker']
+                + columns['rating'] * weights['rating'] + columns['title'] * weights['title']
+                + columns['studio'] * weights['studio'] + columns['performers'] * weights['performers'])
+
+    best_size = np.zeros(scene_count)
+    best_bit_rate = np.zeros(scene_count)
+    np.maximum.at(best_size, file_scene, columns['size'])
+    np.maximum.at(best_bit_rate, file_scene, columns['bit_rate'])
+    has_mkv = np.bincount(file_scene, weights=columns['mkv'], minlength=scene_count) > 0
+    has_hevc = np.bincount(file_scene, weights=columns['hevc'], minlength=scene_count) > 0
+
+    quality = best_size * size_weight + best_bit_rate * weights['bit_rate'] + has_hevc * weights['hevc']
+    scene_file = quality + has_mkv * weights['mkv']
+
+    per_file = (columns['size'] * size_weight + columns['bit_rate'] * weights['bit_rate']
+                + columns['mkv'] * weights['mkv'] + columns['hevc'] * weights['hevc'])
+    return {'metadata': metadata.astype(np.float64), 'scene_file': scene_file, 'file': per_file}
+
+
+def plan_merges(groups: List[List[Dict]], weights: Optional[Dict] = None) -> List[Dict]:
+    """
+    Decide every group at once. Each entry has the destination (scene with the
+    best file), the source scenes merged into it, the scene with the best metadata
+    and the file that should end up primary (the best-scoring file in the group).
+    """
+    columns = flatten_groups(groups)
+    scores = score_columns(columns, weights)
+    group_count = columns['group_count']
+    scene_ids = columns['scene_ids']
+    file_ids = columns['file_ids']
+
+    destinations = grouped_argmax(scores['scene_file'], columns['scene_group'], group_count).tolist()
+    best_metadata = grouped_argmax(scores['metadata'], columns['scene_group'], group_count).tolist()
+    primary_files = grouped_argmax(scores['file'], columns['file_group'], group_count).tolist()
+
+    plan = []
+    scene_row = 0
+    for group_index, group_size in enumerate(columns['group_sizes']):
+        destination = scene_ids[destinations[group_index]]
+        members = scene_ids[scene_row:scene_row + group_size]
+        scene_row += group_size
+        primary = primary_files[group_index]
+        plan.append({
+            'destination': destination,
+            'sources': [scene_id for scene_id in members if scene_id != destination],
+            'best_metadata': scene_ids[best_metadata[group_index]],
+            'primary_file': file_ids[primary] if primary >= 0 else None,
+        })
+    return plan
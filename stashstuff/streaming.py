@@ -0,0 +1,116 @@
+"""
+Incremental parsing of large GraphQL responses.
+
+response.json() on a findDuplicateScenes body builds the whole nested result
+in memory before we can look at the first group. iter_json_array() instead
+reads the body in chunks, finds the array under a given key and decodes its
+elements one at a time with json.JSONDecoder.raw_decode (C speed), keeping
+only the undecoded tail of the buffer around. Memory stays proportional to
+one element plus one chunk.
+
+No third-party streaming parser is needed: the decoder only has to locate the
+array, after that every element is a complete JSON value it can decode alone.
+"""
+
+import codecs
+import json
+from typing import Any, Iterable, Iterator
+
+# ====== CONFIGURATION ======
+DEFAULT_CHUNK_SIZE = 1 << 20  # Bytes read from the response per step
+
+_WHITESPACE = ' \t\n\r'
+
+
+class StreamingResponseError(RuntimeError):
+    """The response did not contain the expected array (e.g. GraphQL errors)"""
+
+    def __init__(self, message: str, result=None):
+        super().__init__(message)
+        self.result = result
+
+
+def _decoded_chunks(chunks: Iterable[bytes]) -> Iterator[str]:
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+def iter_json_array(chunks: Iterable[bytes], key: str) -> Iterator[Any]:
+    """
+    Yield the elements of the first array found under `"key":` in a JSON byte
+    stream, decoding one element at a time. If the key is missing or is not an
+    array (for example {"data": null, "errors": [...]}), the whole body is parsed
+    and StreamingResponseError is raised with the decoded result attached.
+    """
+    decoder = json.JSONDecoder()
+    marker = json.dumps(key)
+    text_chunks = _decoded_chunks(chunks)
+    buffer = ''
+    consumed = []  # only kept until the array is found, for error reporting
+
+    # Find the opening bracket of the array
+    while True:
+        at = buffer.find(marker)
+        if at >= 0:
+            pos = at + len(marker)
+            while pos < len(buffer) and buffer[pos] in _WHITESPACE + ':':
+                pos += 1
+            if pos < len(buffer):
+                if buffer[pos] != '[':
+                    break
+                buffer = buffer[pos + 1:]
+                consumed = None
+                break
+        chunk = next(text_chunks, None)
+        if chunk is None:
+            break
+        if at < 0 and len(buffer) > len(marker):
+            # Keep enough of the tail to match a marker split across chunks
+            consumed.append(buffer[:-len(marker)])
+            buffer = buffer[-len(marker):]
+        buffer += chunk
+
+    if consumed is not None:
+        body = ''.join(consumed) + buffer + ''.join(text_chunks)
+        try:
+            result = json.loads(body)
+        except ValueError:
+            result = None
+        errors = result.get('errors') if isinstance(result, dict) else None
+        raise StreamingResponseError(f"no {key} array in response: {errors or body[:200]}", result)
+
+    # Decode one element at a time
+    pos = 0
+    exhausted = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in _WHITESPACE + ',':
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == ']':
+            return
+        if pos < len(buffer):
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                if exhausted:
+                    raise
+            else:
+                # A number at the very end of the buffer may continue in the next chunk
+                # (and at the end of the stream was cut off, since the array never closed)
+                if end < len(buffer) or buffer[pos] in '[{"':
+                    yield item
+                    pos = end
+                    continue
+        if exhausted:
+            raise ValueError(f"unterminated {key} array in response")
+        chunk = next(text_chunks, None)
+        if chunk is None:
+            exhausted = True
+        else:
+            buffer = buffer[pos:] + chunk
+            pos = 0
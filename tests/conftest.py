@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_DIR not in sys.path:
+    sys.path.insert(0, REPO_DIR)
+
+from stashstuff.mock_stash import MockLibrary  # noqa: E402
+
+
+class LibraryClient:
+    """Answers execute_query() straight from a MockLibrary, without HTTP"""
+
+    def __init__(self, library: MockLibrary):
+        self.library = library
+        self.queries = []
+
+    def execute_query(self, query, variables=None, verify=None):
+        self.queries.append(query)
+        return self.library.execute(query, variables)[0]
+
+
+@pytest.fixture
+def library():
+    return MockLibrary(scenes=60, seed=1)
+
+
+@pytest.fixture
+def library_client(library):
+    return LibraryClient(library)
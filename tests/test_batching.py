@@ -0,0 +1,173 @@
+import asyncio
+
+from stashstuff.batching import AsyncMutationBatcher, MutationBatcher, is_unconfirmed, split_batch_response
+
+
+def queue_deletions(batcher, marker_ids, results, library=None):
+    """Queue sceneMarkerDestroy for each id; with a library, verify unconfirmed ones against it"""
+    for marker_id in marker_ids:
+        verify = None
+        if library is not None:
+            def verify(marker_id=marker_id):
+                return None if marker_id in library.markers else {'data': {'sceneMarkerDestroy': True}}
+        batcher.add('sceneMarkerDestroy', {'id': ('ID!', marker_id)},
+                    callback=lambda response, marker_id=marker_id: results.__setitem__(marker_id, response),
+                    verify=verify)
+
+
+class CountingClient:
+    def __init__(self, library_client):
+        self.library_client = library_client
+        self.documents = []
+
+    def execute_query(self, query, variables=None):
+        self.documents.append(query)
+        return self.library_client.execute_query(query, variables)
+
+
+def test_one_failing_alias_nulls_the_whole_batch(library):
+    marker_ids = sorted(library.markers)[:2]
+    result, _ = library.execute('mutation { m1: sceneMarkerDestroy(id: %d) m2: sceneMarkerDestroy(id: 999999) '
+                                'm3: sceneMarkerDestroy(id: %d) }' % tuple(marker_ids))
+    assert result['data'] is None
+    assert [error['path'] for error in result['errors']] == [['m2']]
+    # The other aliases still ran
+    assert not set(marker_ids) & set(library.markers)
+
+
+def test_partial_failure_is_reported_per_mutation(library, library_client):
+    present = sorted(library.markers)[:4]
+    marker_ids = [present[0], 999999, present[1], present[2], 888888, present[3]]
+    results = {}
+    client = CountingClient(library_client)
+    with MutationBatcher(client, max_batch_size=50) as batcher:
+        queue_deletions(batcher, marker_ids, results, library)
+
+    assert len(client.documents) == 1  # verified, not sent again
+    for marker_id in present:
+        assert results[marker_id] == {'data': {'sceneMarkerDestroy': True}}
+        assert marker_id not in library.markers
+    for marker_id in (999999, 888888):
+        assert 'errors' in results[marker_id] and not is_unconfirmed(results[marker_id])
+        assert str(marker_id) in results[marker_id]['errors'][0]['message']
+
+
+def test_batches_are_split_at_max_batch_size_and_callbacks_can_queue_more(library, library_client):
+    marker_ids = sorted(library.markers)[:7]
+    results = {}
+    batcher = MutationBatcher(library_client, max_batch_size=3, max_delay=60)
+
+    def then_delete_last(response):
+        results[marker_ids[0]] = response
+        queue_deletions(batcher, marker_ids[-1:], results)
+
+    batcher.add('sceneMarkerDestroy', {'id': ('ID!', marker_ids[0])}, callback=then_delete_last)
+    queue_deletions(batcher, marker_ids[1:-1], results)
+    batcher.flush()
+
+    assert batcher.requests_sent == 3  # 3 + 3 + the one queued by the callback
+    assert batcher.mutations_sent == 7
+    assert all('errors' not in results[marker_id] for marker_id in marker_ids)
+    assert not set(marker_ids) & set(library.markers)
+
+
+class FailingClient:
+    def __init__(self, result=None):
+        self.result = result
+
+    def execute_query(self, query, variables=None):
+        if self.result is None:
+            raise ConnectionError('connection reset')
+        return self.result
+
+
+def test_failed_request_fails_every_mutation():
+    results = {}
+    with MutationBatcher(FailingClient()) as batcher:
+        queue_deletions(batcher, [1, 2, 3], results)
+    assert all('batch request failed' in results[marker_id]['errors'][0]['message'] for marker_id in (1, 2, 3))
+
+
+def test_error_without_a_path_applies_to_every_mutation():
+    results = {}
+    with MutationBatcher(FailingClient({'data': None, 'errors': [{'message': 'not authorized'}]})) as batcher:
+        queue_deletions(batcher, [1, 2], results)
+    assert results[1] == results[2] == {'errors': [{'message': 'not authorized'}]}
+
+
+def test_nulled_data_is_not_mistaken_for_success():
+    batcher = MutationBatcher(FailingClient(), max_delay=60)
+    batch = [batcher.add('sceneMarkerDestroy', {'id': ('ID!', marker_id)}) for marker_id in (1, 2, 3)]
+    result = {'data': None, 'errors': [{'message': 'marker 2 is locked', 'path': ['m2']}]}
+    responses = split_batch_response(batch, result)
+    assert responses[1] == {'errors': [{'message': 'marker 2 is locked', 'path': ['m2']}]}
+    assert not is_unconfirmed(responses[1])
+    assert is_unconfirmed(responses[0]) and 'errors' in responses[0]
+    assert is_unconfirmed(responses[2]) and 'errors' in responses[2]
+
+
+def test_siblings_without_verify_are_sent_again_on_their_own(library, library_client):
+    scene_ids = sorted(library.scenes)[:2]
+    results = {}
+    client = CountingClient(library_client)
+    with MutationBatcher(client) as batcher:
+        for scene_id in scene_ids:
+            batcher.add('sceneUpdate', {'input': ('SceneUpdateInput!', {'id': scene_id})}, selection='id',
+                        callback=lambda response, scene_id=scene_id: results.__setitem__(scene_id, response))
+        batcher.add('sceneMarkerDestroy', {'id': ('ID!', 999999)},
+                    callback=lambda response: results.__setitem__('doomed', response))
+
+    assert len(client.documents) == 3  # the batch, then each sceneUpdate alone
+    assert all(results[scene_id] == {'data': {'sceneUpdate': {'id': str(scene_id)}}} for scene_id in scene_ids)
+    assert 'errors' in results['doomed']
+    assert batcher.requests_sent == 3
+
+
+class AsyncLibraryClient:
+    def __init__(self, library_client):
+        self.library_client = library_client
+        self.requests = 0
+
+    async def execute_query(self, query, variables=None):
+        self.requests += 1
+        await asyncio.sleep(0)
+        return self.library_client.execute_query(query, variables)
+
+
+def test_async_batcher_splits_partial_failures(library, library_client):
+    present = sorted(library.markers)[:5]
+    marker_ids = present[:3] + [999999] + present[3:]
+    results = {}
+
+    async def run():
+        batcher = AsyncMutationBatcher(AsyncLibraryClient(library_client), max_batch_size=2)
+        queue_deletions(batcher, marker_ids, results, library)
+        await batcher.flush()
+        return batcher
+
+    batcher = asyncio.run(run())
+    assert batcher.requests_sent == 3
+    assert 'errors' in results[999999]
+    assert all(results[marker_id] == {'data': {'sceneMarkerDestroy': True}} for marker_id in present)
+    assert not set(present) & set(library.markers)
+
+
+def test_async_batcher_awaits_verify(library, library_client):
+    present = sorted(library.markers)[:2]
+    results = {}
+
+    async def verify(marker_id):
+        await asyncio.sleep(0)
+        return None if marker_id in library.markers else {'data': {'sceneMarkerDestroy': True}}
+
+    async def run():
+        batcher = AsyncMutationBatcher(AsyncLibraryClient(library_client))
+        for marker_id in [999999, *present]:
+            batcher.add('sceneMarkerDestroy', {'id': ('ID!', marker_id)},
+                        callback=lambda response, marker_id=marker_id: results.__setitem__(marker_id, response),
+                        verify=lambda marker_id=marker_id: verify(marker_id))
+        await batcher.flush()
+
+    asyncio.run(run())
+    assert all(results[marker_id] == {'data': {'sceneMarkerDestroy': True}} for marker_id in present)
+    assert 'errors' in results[999999]
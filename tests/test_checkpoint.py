@@ -0,0 +1,45 @@
+import json
+
+from stashstuff.checkpoint import FAILED, MERGED, SKIPPED, MergeJournal
+
+SETTINGS = {'phash_distance': 8, 'query_profile': 'display-full'}
+GROUP = [{'id': '1'}, {'id': '2'}]
+OTHER_GROUP = [{'id': '3'}, {'id': '4'}]
+
+
+def test_journal_starts_with_its_settings(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    journal = MergeJournal(path, settings=SETTINGS)
+    journal.record(GROUP, MERGED)
+    journal.close()
+    with open(path) as f:
+        assert json.loads(f.readline())['settings'] == SETTINGS
+
+    reopened = MergeJournal(path, settings=SETTINGS)
+    assert reopened.matches
+    assert reopened.is_done(GROUP)
+
+
+def test_journal_for_other_settings_is_discarded(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    journal = MergeJournal(path, settings=SETTINGS)
+    journal.record(GROUP, MERGED)
+    journal.close()
+
+    changed = MergeJournal(path, settings={**SETTINGS, 'phash_distance': 4})
+    assert not changed.matches
+    assert not changed.is_done(GROUP)
+    assert (tmp_path / 'journal.jsonl.old').exists()
+    changed.record(OTHER_GROUP, SKIPPED)
+    assert changed.matches
+
+
+def test_counts_cover_only_this_run(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    journal = MergeJournal(path, settings=SETTINGS)
+    journal.record(GROUP, MERGED)
+    journal.close()
+
+    journal = MergeJournal(path, settings=SETTINGS)
+    journal.record(OTHER_GROUP, FAILED)
+    assert journal.counts() == {MERGED: 0, SKIPPED: 0, FAILED: 1}
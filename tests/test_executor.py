@@ -0,0 +1,40 @@
+import contextlib
+import io
+import sys
+import time
+
+from stashstuff.executor import ParallelMergeExecutor
+
+
+def chatty(name, lines=3):
+    for i in range(lines):
+        print(f"{name} line {i}")
+        time.sleep(0.001)
+    return name
+
+
+def test_single_worker_leaves_stdout_alone():
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        with ParallelMergeExecutor(workers=1) as executor:
+            assert sys.stdout is output
+            executor.submit(['1'], chatty, 'a')
+            executor.submit(['2'], chatty, 'b')
+        assert sys.stdout is output
+    assert executor.results() == ['a', 'b']
+    assert output.getvalue() == ''.join(f"{name} line {i}\n" for name in 'ab' for i in range(3))
+
+
+def test_parallel_workers_print_each_task_in_one_piece():
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        with ParallelMergeExecutor(workers=4) as executor:
+            for name in 'abcdef':
+                executor.submit([name], chatty, name)
+        assert sys.stdout is output
+    lines = output.getvalue().splitlines()
+    blocks = [lines[i:i + 3] for i in range(0, len(lines), 3)]
+    assert sorted(block[0].split()[0] for block in blocks) == list('abcdef')
+    for block in blocks:
+        name = block[0].split()[0]
+        assert block == [f"{name} line {i}" for i in range(3)]
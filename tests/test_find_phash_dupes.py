@@ -0,0 +1,96 @@
+import contextlib
+import io
+import json
+
+import pytest
+
+from stashstuff.cli import load_script
+from stashstuff.mock_stash import MockLibrary, MockStashServer
+from stashstuff.resilience import TransientResponseError
+from stashstuff.scoring import ScoringEngine
+
+
+@pytest.fixture
+def server():
+    with MockStashServer(MockLibrary(scenes=200, seed=3)) as server:
+        yield server
+
+
+def load(server, monkeypatch, tmp_path, **settings):
+    monkeypatch.setenv('STASH_URL', server.url)
+    monkeypatch.setenv('STASH_API_KEY', 'test')
+    monkeypatch.chdir(tmp_path)
+    script = load_script('find-phash-dupes.py')
+    for name, value in {'METRICS_FILE': None, **settings}.items():
+        setattr(script, name, value)
+    return script
+
+
+def run(script):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        script.main()
+    return output.getvalue()
+
+
+def test_broken_stream_journals_finished_merges_and_explains_how_to_resume(server, monkeypatch, tmp_path):
+    script = load(server, monkeypatch, tmp_path, STREAM_DUPLICATES=True, BATCH_SIZE=None)
+    stream = script.StashAppClient.stream_duplicate_scenes
+
+    def breaks_off(self, distance=0):
+        for i, group in enumerate(stream(self, distance)):
+            if i == 2:
+                raise TransientResponseError('Truncated response from FindDuplicateScenes')
+            yield group
+
+    monkeypatch.setattr(script.StashAppClient, 'stream_duplicate_scenes', breaks_off)
+    (tmp_path / script.DUPLICATES_FILE).write_text('[]')
+    output = run(script)
+
+    assert 'Error: Truncated response' in output
+    assert 'Journaled this run: 2 merged' in output
+    assert 'It will query for duplicates again' in output
+    assert not (tmp_path / script.DUPLICATES_FILE).exists()
+    with open(tmp_path / script.MERGE_JOURNAL_FILE) as f:
+        lines = [json.loads(line) for line in f]
+    assert lines[0]['settings'] == script.journal_settings()
+    assert [entry['status'] for entry in lines[1:]] == ['merged', 'merged']
+
+
+def test_preflight_merges_groups_linked_by_identical_copies(server, monkeypatch, tmp_path):
+    script = load(server, monkeypatch, tmp_path)
+    contents = {'a.mkv': b'same bytes' * 1000, 'b.mp4': b'b' * 500, 'c.mkv': b'same bytes' * 1000,
+                'd.mp4': b'd' * 700, 'e.mkv': b'e' * 300}
+    for name, data in contents.items():
+        (tmp_path / name).write_bytes(data)
+
+    def scene(scene_id, *names):
+        return {'id': scene_id, 'files': [{'id': f"{scene_id}-{name}", 'path': str(tmp_path / name),
+                                           'size': len(contents.get(name, b''))} for name in names]}
+
+    groups = [[scene('1', 'a.mkv'), scene('2', 'b.mp4')],
+              [scene('3', 'e.mkv'), scene('4', 'missing.mp4')],
+              [scene('5', 'c.mkv'), scene('6', 'd.mp4')],
+              [scene('7', 'e.mkv'), scene('8', 'b.mp4')]]
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        merged = script.preflight_duplicate_groups(groups)
+
+    # a.mkv and c.mkv are the same file; b.mp4 is shared by the first and last groups
+    assert [[scene['id'] for scene in group] for group in merged] == [['1', '2', '5', '6', '7', '8']]
+    assert 'Skipping group 3, 4' in output.getvalue()
+    assert 'Merged 3 groups into 1' in output.getvalue()
+
+
+@pytest.mark.parametrize('by_score, expected', [(False, None), (True, 'big')])
+def test_primary_file_is_only_an_mkv_unless_scoring_picks_it(server, monkeypatch, tmp_path, by_score, expected):
+    script = load(server, monkeypatch, tmp_path, PRIMARY_FILE_BY_SCORE=by_score)
+    script.scoring_engine = ScoringEngine({})
+    small = {'id': 'small', 'path': '/a.mp4', 'size': 100, 'width': 640, 'height': 360}
+    big = {'id': 'big', 'path': '/b.mp4', 'size': 900, 'width': 1920, 'height': 1080}
+    scenes = [{'id': '1', 'files': [small]}, {'id': '2', 'files': [big]}]
+    assert script.choose_primary_file(scenes, scenes[0]) == expected
+
+    mkv = {'id': 'mkv', 'path': '/c.MKV', 'size': 50, 'width': 320, 'height': 240}
+    scenes.append({'id': '3', 'files': [mkv]})
+    assert script.choose_primary_file(scenes, scenes[0]) == 'mkv'
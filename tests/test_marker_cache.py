@@ -0,0 +1,49 @@
+from stashstuff.marker_cache import MarkerCache
+
+
+def cached_ids(cache):
+    return {str(marker_id) for marker_id in cache.marker_ids()}
+
+
+def server_ids(library):
+    return {str(marker_id) for marker_id in library.markers}
+
+
+def test_first_sync_downloads_every_marker(tmp_path, library, library_client):
+    with MarkerCache(str(tmp_path / 'markers.sqlite')) as cache:
+        changes = cache.sync(library_client, per_page=50)
+        assert changes == {'fetched': len(library.markers), 'removed': 0}
+        assert cached_ids(cache) == server_ids(library)
+        assert cache.watermark
+
+
+def test_sync_drops_deletions_hidden_by_an_addition(tmp_path, library, library_client):
+    """One marker deleted and one added leave the count unchanged; the stale one must still go"""
+    with MarkerCache(str(tmp_path / 'markers.sqlite')) as cache:
+        cache.sync(library_client, per_page=50)
+        count_before = len(library.markers)
+
+        doomed = min(library.markers)
+        scene_id = library.markers[doomed]['scene_id']
+        library.execute('mutation { sceneMarkerDestroy(id: %d) }' % doomed)
+        library.execute('mutation { sceneMarkerCreate(input: {scene_id: %d, seconds: 12.5, primary_tag_id: 3}) { id } }'
+                        % scene_id)
+        assert len(library.markers) == count_before
+
+        changes = cache.sync(library_client, per_page=50)
+        assert changes['removed'] == 1
+        assert cached_ids(cache) == server_ids(library)
+        assert str(doomed) not in cached_ids(cache)
+
+
+def test_sync_picks_up_edits_and_keeps_scene_order(tmp_path, library, library_client):
+    with MarkerCache(str(tmp_path / 'markers.sqlite')) as cache:
+        cache.sync(library_client, per_page=50)
+        marker_id = max(library.markers)
+        scene_id = library.markers[marker_id]['scene_id']
+        library.execute('mutation { sceneMarkerCreate(input: {scene_id: %d, seconds: 0.5}) { id } }' % scene_id)
+
+        cache.sync(library_client, per_page=50)
+        by_scene = {scene['id']: markers for scene, markers in cache.iter_scenes()}
+        assert [int(scene_id) for scene_id in by_scene] == sorted(library.markers_by_scene, reverse=True)
+        assert by_scene[str(scene_id)][0]['seconds'] == 0.5
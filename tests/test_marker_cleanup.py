@@ -0,0 +1,94 @@
+import contextlib
+import io
+
+import pytest
+
+from stashstuff.cli import load_script
+from stashstuff.mock_stash import MockLibrary, MockStashServer
+
+MODES = {
+    'serial': {},
+    'async': {'async_mode': True},
+    'bulk': {'bulk_marker_scan': True},
+    'cache': {'marker_cache_file': 'markers.sqlite'},
+}
+
+
+@pytest.fixture(scope='module')
+def server():
+    with MockStashServer(MockLibrary(scenes=120, seed=7)) as server:
+        yield server
+
+
+def run_cleanup(server, monkeypatch, tmp_path, **settings):
+    """Run the script's main() against a fresh mock library; returns (output, marker ids left)"""
+    server.reset()
+    monkeypatch.setenv('STASH_URL', server.url)
+    monkeypatch.setenv('STASH_API_KEY', 'test')
+    monkeypatch.chdir(tmp_path)
+    script = load_script('cleanup_overlapping_markers.py')
+    script.CONFIG.update({'dry_run': False, 'max_scenes': None, 'metrics_file': None, **settings})
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        script.main()
+    return output.getvalue(), set(server.library.markers)
+
+
+def scene_output(output):
+    """Everything from the first scene through the summary, without the timing report"""
+    start = output.index('\n[1/')
+    return output[start:output.index('⏱️', start)]
+
+
+@pytest.fixture(scope='module')
+def serial_run(server, tmp_path_factory):
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        return run_cleanup(server, monkeypatch, tmp_path_factory.mktemp('serial'))
+
+
+@pytest.mark.parametrize('mode', ['async', 'bulk', 'cache'])
+def test_output_matches_serial_run_with_default_batching(mode, server, serial_run, monkeypatch, tmp_path):
+    output, remaining = run_cleanup(server, monkeypatch, tmp_path, **MODES[mode])
+    serial_output, serial_remaining = serial_run
+    assert scene_output(output) == scene_output(serial_output)
+    assert remaining == serial_remaining
+
+
+def test_batched_results_print_under_their_marker(serial_run):
+    output = scene_output(serial_run[0])
+    lines = output.splitlines()
+    deleting = [i for i, line in enumerate(lines) if line.startswith('    Deleting: ID ')]
+    assert deleting
+    for i in deleting:
+        marker_id = lines[i].split()[2]
+        assert lines[i + 1] == f"    ✓ Deleted marker {marker_id}"
+    assert 'Deletion requests sent: ' in output
+
+
+def test_unbatched_run_prints_the_same(server, serial_run, monkeypatch, tmp_path):
+    output, remaining = run_cleanup(server, monkeypatch, tmp_path, mutation_batch_size=1)
+    # Only the summary differs: no batches were sent
+    assert scene_output(output).split('CLEANUP SUMMARY')[0] == scene_output(serial_run[0]).split('CLEANUP SUMMARY')[0]
+    assert remaining == serial_run[1]
+
+
+@pytest.mark.parametrize('mode', ['serial', 'async'])
+def test_failed_deletions_are_not_counted(mode, server, monkeypatch, tmp_path):
+    original = server.library.scene_marker_destroy
+
+    def refuse_odd_ids(id=None, **kwargs):
+        if int(id) % 2:
+            raise ValueError(f"scene marker {id} is locked")
+        return original(id=id, **kwargs)
+
+    monkeypatch.setattr(server.library, 'scene_marker_destroy', refuse_odd_ids)
+    output, remaining = run_cleanup(server, monkeypatch, tmp_path, **MODES[mode])
+    failed = output.count('✗ Failed to delete marker')
+    deleted = output.count('✓ Deleted marker')
+    assert failed and deleted
+    # Each failure nulls its whole batch (sceneMarkerDestroy is Boolean!); the markers
+    # deleted alongside it must still be reported as deleted
+    assert deleted == len(MockLibrary(scenes=120, seed=7).markers) - len(remaining)
+    assert 'no result returned' not in output
+    assert f"Markers successfully deleted: {deleted}\n" in output
+    assert f"Markers that could not be deleted: {failed}\n" in output
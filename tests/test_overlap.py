@@ -0,0 +1,104 @@
+import random
+
+import pytest
+
+from stashstuff.overlap import find_overlap_groups
+from stashstuff.phash_index import UnionFind
+
+
+def random_markers(rng, count, tags=3):
+    markers = []
+    for marker_id in rng.sample(range(1, count * 10), count):
+        seconds = round(rng.uniform(0, 120), 1)
+        end = seconds + round(rng.uniform(0, 8), 1) if rng.random() < 0.6 else None
+        markers.append({'id': str(marker_id), 'seconds': seconds, 'end_seconds': end,
+                        'primary_tag': {'id': str(rng.randrange(tags))}})
+    return markers
+
+
+def original_anchored_groups(markers, within):
+    """The marker cleanup's grouping before the sweep line replaced it"""
+    sorted_markers = sorted(markers, key=lambda x: x['seconds'])
+    groups = []
+    used = set()
+    for i, marker in enumerate(sorted_markers):
+        if marker['id'] in used:
+            continue
+        group = [marker]
+        used.add(marker['id'])
+        for other in sorted_markers[i + 1:]:
+            if other['id'] in used:
+                continue
+            if abs(other['seconds'] - marker['seconds']) <= within:
+                group.append(other)
+                used.add(other['id'])
+            else:
+                break
+        if len(group) > 1:
+            group.sort(key=lambda x: int(x['id']))
+            groups.append(group)
+    return groups
+
+
+def pairwise_groups(markers, close):
+    """Connected components of the 'close' relation, comparing every pair"""
+    uf = UnionFind()
+    for a in markers:
+        uf.find(a['id'])
+        for b in markers:
+            if a is not b and close(a, b):
+                uf.union(a['id'], b['id'])
+    return uf.groups()
+
+
+def chained_close(within):
+    return lambda a, b: abs(a['seconds'] - b['seconds']) <= within
+
+
+def interval_close(within):
+    def end(marker):
+        return marker['end_seconds'] if marker['end_seconds'] is not None else marker['seconds']
+    return lambda a, b: a['seconds'] <= end(b) + within and b['seconds'] <= end(a) + within
+
+
+def as_id_sets(groups):
+    return sorted(sorted(group) for group in groups if len(group) > 1)
+
+
+def ids(groups):
+    return as_id_sets([[marker['id'] for marker in group] for group in groups])
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_anchored_matches_the_original_grouping(seed):
+    rng = random.Random(seed)
+    markers = random_markers(rng, rng.randrange(2, 80))
+    within = rng.choice([0.5, 2.0, 5.0])
+    assert find_overlap_groups(markers, within, 'anchored') == original_anchored_groups(markers, within)
+
+
+@pytest.mark.parametrize('mode,close', [('chained', chained_close), ('interval', interval_close)])
+@pytest.mark.parametrize('seed', range(20))
+def test_linkage_modes_match_pairwise_comparison(mode, close, seed):
+    rng = random.Random(seed)
+    markers = random_markers(rng, rng.randrange(2, 80))
+    within = rng.choice([0.5, 2.0, 5.0])
+    assert ids(find_overlap_groups(markers, within, mode)) == as_id_sets(pairwise_groups(markers, close(within)))
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_same_tag_only_groups_each_tag_separately(seed):
+    rng = random.Random(seed)
+    markers = random_markers(rng, 60)
+    expected = []
+    for tag in {marker['primary_tag']['id'] for marker in markers}:
+        tagged = [marker for marker in markers if marker['primary_tag']['id'] == tag]
+        expected.extend(pairwise_groups(tagged, chained_close(2.0)))
+    groups = find_overlap_groups(markers, 2.0, 'chained', same_tag_only=True)
+    assert ids(groups) == as_id_sets(expected)
+    assert [group[0]['id'] for group in groups] == [min(group, key=lambda m: int(m['id']))['id'] for group in groups]
+
+
+def test_unknown_mode_is_rejected():
+    with pytest.raises(ValueError):
+        find_overlap_groups([], 1.0, 'fuzzy')
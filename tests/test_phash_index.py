@@ -0,0 +1,115 @@
+import random
+
+import pytest
+
+from stashstuff.phash_index import PHASH_BITS, PhashIndex, UnionFind, hamming_distance, updated_since_filter
+
+
+def clustered_index(seed, clusters=40, size=5, noise=8):
+    """Scenes whose phashes sit a few bit flips from a shared base, plus exact copies"""
+    rng = random.Random(seed)
+    index = PhashIndex()
+    scene_id = 0
+    for _ in range(clusters):
+        base = rng.getrandbits(PHASH_BITS)
+        for _ in range(rng.randrange(1, size + 1)):
+            phash = base
+            for bit in rng.sample(range(PHASH_BITS), rng.randrange(noise + 1)):
+                phash ^= 1 << bit
+            scene_id += 1
+            index.add(str(scene_id), phash)
+            if rng.random() < 0.1:
+                scene_id += 1
+                index.add(str(scene_id), phash)
+    return index
+
+
+def brute_force_groups(index, distance, only=None):
+    """Compare every pair of phashes; with `only`, keep the groups containing those phashes"""
+    uf = UnionFind()
+    hashes = list(index.scenes_by_hash)
+    for phash in hashes:
+        scene_ids = index.scenes_by_hash[phash]
+        for scene_id in scene_ids:
+            uf.union(scene_ids[0], scene_id)
+    for i, a in enumerate(hashes):
+        for b in hashes[i + 1:]:
+            if hamming_distance(a, b) <= distance:
+                uf.union(index.scenes_by_hash[a][0], index.scenes_by_hash[b][0])
+    groups = [sorted(group, key=int) for group in uf.groups() if len(group) > 1]
+    if only is not None:
+        touched = {scene_id for phash in only for scene_id in index.scenes_by_hash[phash]}
+        groups = [group for group in groups if touched.intersection(group)]
+    return sorted(groups, key=lambda group: int(group[0]))
+
+
+@pytest.mark.parametrize('distance', [0, 4, 8, 10])
+@pytest.mark.parametrize('seed', range(3))
+def test_duplicate_groups_match_brute_force(seed, distance):
+    index = clustered_index(seed)
+    assert index.duplicate_groups(distance) == brute_force_groups(index, distance)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_incremental_groups_match_brute_force(seed):
+    index = clustered_index(seed)
+    only = random.Random(seed).sample(list(index.scenes_by_hash), 15)
+    assert index.duplicate_groups(8, only=only) == brute_force_groups(index, 8, only=only)
+
+
+def chained_index():
+    """A and B already duplicates; N is new, near A but too far from B"""
+    index = PhashIndex()
+    index.add('1', 0)          # A
+    index.add('2', 0b1111)     # B: 4 bits from A
+    index.add('3', 0b11110000)  # N: 4 bits from A, 8 from B
+    index.add('4', (1 << 64) - 1)  # unrelated
+    return index
+
+
+def test_incremental_groups_include_transitive_members():
+    index = chained_index()
+    assert index.duplicate_groups(4, only=[0b11110000]) == [['1', '2', '3']]
+    assert index.duplicate_groups(4, only=[(1 << 64) - 1]) == []
+
+
+def test_radius_query_finds_exactly_the_scenes_within_distance():
+    index = clustered_index(5)
+    probe = next(iter(index.scenes_by_hash))
+    expected = sorted(((scene_id, hamming_distance(probe, phash))
+                       for phash, scene_ids in index.scenes_by_hash.items() for scene_id in scene_ids
+                       if hamming_distance(probe, phash) <= 8), key=lambda match: (match[1], int(match[0])))
+    assert index.radius_query(probe, 8) == expected
+
+
+@pytest.mark.parametrize('tile_size', [7, 64, 4096])
+@pytest.mark.parametrize('distance', [0, 8])
+def test_numpy_groups_match_brute_force(tile_size, distance):
+    phash_numpy = pytest.importorskip('stashstuff.phash_numpy')
+    index = clustered_index(11)
+    assert phash_numpy.duplicate_groups(index, distance, tile_size=tile_size) == brute_force_groups(index, distance)
+
+    only = random.Random(11).sample(list(index.scenes_by_hash), 15)
+    assert (phash_numpy.duplicate_groups(index, distance, tile_size=tile_size, only=only)
+            == brute_force_groups(index, distance, only=only))
+    assert phash_numpy.duplicate_groups(chained_index(), 4, tile_size=tile_size, only=[0b11110000]) == [['1', '2', '3']]
+
+
+def test_updated_since_filter_steps_back_a_second():
+    assert updated_since_filter('2024-05-01T10:00:00Z') == {
+        'updated_at': {'value': '2024-05-01T09:59:59+00:00', 'modifier': 'GREATER_THAN'}}
+
+
+def test_numpy_fallback_popcount_handles_tile_slices(monkeypatch):
+    phash_numpy = pytest.importorskip('stashstuff.phash_numpy')
+    np = phash_numpy.np
+    monkeypatch.delattr(np, 'bitwise_count', raising=False)
+    rng = random.Random(3)
+    values = np.array([[rng.getrandbits(PHASH_BITS) for _ in range(9)] for _ in range(9)], dtype=np.uint64)
+    tile = values[:5, 2:7]
+    assert not tile.flags['C_CONTIGUOUS']
+    expected = [[bin(int(value)).count('1') for value in row] for row in tile]
+    assert phash_numpy.popcount64(tile).tolist() == expected
+
+    index = clustered_index(11)
+    assert phash_numpy.duplicate_groups(index, 8, tile_size=7) == brute_force_groups(index, 8)
@@ -0,0 +1,236 @@
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from stashstuff.async_client import AsyncStashGraphQLClient, aiohttp_available
+from stashstuff.client import StashGraphQLClient
+from stashstuff.resilience import CircuitBreaker, TransientResponseError
+
+FAILURE = requests.exceptions.ConnectionError('refused')
+
+
+def open_breaker(reset_timeout=0.05):
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=reset_timeout, max_reset_timeout=1.0)
+    breaker.record_failure(FAILURE)
+    breaker.record_failure(FAILURE)
+    return breaker
+
+
+def waits_for(breaker, timeout=1.0):
+    """Run breaker.wait() on another thread; True if it returned within timeout"""
+    done = threading.Event()
+    thread = threading.Thread(target=lambda: (breaker.wait(), done.set()), daemon=True)
+    thread.start()
+    return done.wait(timeout)
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=10)
+    breaker.record_failure(FAILURE)
+    breaker.record_failure(FAILURE)
+    breaker.record_success()
+    breaker.record_failure(FAILURE)
+    breaker.record_failure(FAILURE)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.wait() is False
+
+    breaker.record_failure(FAILURE)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.opened == 1
+    assert not waits_for(breaker, timeout=0.1)
+
+
+def test_breaker_lets_one_probe_through_after_the_cooldown():
+    breaker = open_breaker()
+    start = time.monotonic()
+    assert breaker.wait() is True
+    assert time.monotonic() - start >= 0.04
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # Everyone else waits for the probe's verdict
+    assert not waits_for(breaker, timeout=0.1)
+
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.wait() is False
+
+
+def test_failed_probe_reopens_with_a_longer_cooldown():
+    breaker = open_breaker()
+    breaker.wait()
+    breaker.record_failure(FAILURE)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.reset_timeout == pytest.approx(0.1)
+    assert breaker.opened == 2
+
+    breaker.wait()
+    breaker.record_success()
+    assert breaker.reset_timeout == pytest.approx(0.05)
+
+
+def test_probe_without_a_verdict_is_handed_on():
+    breaker = open_breaker(reset_timeout=0.01)
+    with pytest.raises(KeyError):
+        with breaker.attempt() as waited:
+            assert waited
+            raise KeyError('unexpected')
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert waits_for(breaker, timeout=0.5)
+
+
+class FakeStreamResponse:
+    """Just enough of requests.Response for stream_array()"""
+
+    def __init__(self, chunks, status_code=200):
+        self.chunks = chunks
+        self.status_code = status_code
+
+    def iter_content(self, chunk_size):
+        yield from self.chunks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+def streaming_client(bodies):
+    client = StashGraphQLClient('http://stash.invalid', 'key', max_requests_per_second=0, max_retries=2,
+                                breaker=CircuitBreaker(failure_threshold=10))
+    responses = iter(bodies)
+    client._post = lambda *args, **kwargs: FakeStreamResponse(next(responses))
+    client._backoff = lambda attempt: None
+    return client
+
+
+QUERY = 'query FindDuplicateScenes { findDuplicateScenes }'
+
+
+def test_stream_cut_off_before_any_element_is_retried():
+    client = streaming_client([[b'{"data": {"findDuplicateScenes": '], [b'{"data": {"findDuplicateScenes": [1, 2]}}']])
+    assert list(client.stream_array(QUERY, key='findDuplicateScenes')) == [1, 2]
+    assert client.retries == 1
+    assert client.breaker.failures == 0
+
+
+def test_stream_cut_off_mid_array_is_a_transient_failure():
+    client = streaming_client([[b'{"data": {"findDuplicateScenes": [[1], [2', b', 3']])
+    items = []
+    with pytest.raises(TransientResponseError):
+        for item in client.stream_array(QUERY, key='findDuplicateScenes'):
+            items.append(item)
+    assert items == [[1]]
+    assert client.breaker.failures == 1
+    assert client.metrics.summary()['counters']['failures'] == 1
+
+
+def test_stream_closed_early_releases_the_probe():
+    client = streaming_client([[b'{"data": {"findDuplicateScenes": [[1], [2]]}}']])
+    client.breaker = open_breaker(reset_timeout=0.01)
+    stream = client.stream_array(QUERY, key='findDuplicateScenes')
+    assert next(stream) == [1]
+    stream.close()
+    assert waits_for(client.breaker, timeout=0.5)
+
+
+def test_async_attempt_waits_without_blocking_the_loop():
+    breaker = open_breaker()
+
+    async def run():
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.005)
+
+        ticker = asyncio.ensure_future(tick())
+        async with breaker.async_attempt() as waited:
+            assert waited and breaker.state == CircuitBreaker.HALF_OPEN
+            ticks_before = ticks
+            # Everyone else waits for the probe's verdict
+            other = asyncio.ensure_future(breaker.async_attempt().__aenter__())
+            await asyncio.sleep(0.05)
+            assert not other.done()
+            breaker.record_success()
+        await asyncio.wait_for(other, 0.5)
+        ticker.cancel()
+        return ticks_before
+
+    assert asyncio.run(run()) > 1
+
+
+class CannedServer:
+    """Answers every POST with a fixed status and body, after an optional delay"""
+
+    def __init__(self, status, body, delay=0.0):
+        self.requests = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                server.requests += 1
+                self.rfile.read(int(self.headers['Content-Length']))
+                time.sleep(delay)
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def async_query(url, query, **kwargs):
+    async def run():
+        async with AsyncStashGraphQLClient(url, 'key', max_retries=2, **kwargs) as client:
+            return client, await client.execute_query(query)
+    return asyncio.run(run())
+
+
+needs_aiohttp = pytest.mark.skipif(not aiohttp_available(), reason="aiohttp not installed")
+
+
+@needs_aiohttp
+def test_async_client_does_not_retry_a_client_error():
+    with CannedServer(400, b'<html>bad request</html>') as server:
+        client, result = async_query(server.url, 'query FindScenes { findScenes { count } }')
+    assert server.requests == 1
+    assert 'HTTP 400 from FindScenes' in result['errors'][0]['message']
+    assert client.breaker.failures == 0
+
+
+@needs_aiohttp
+def test_async_client_retries_overload_through_the_shared_breaker(monkeypatch):
+    monkeypatch.setattr('stashstuff.async_client.backoff_delay', lambda attempt: 0)
+    breaker = CircuitBreaker(failure_threshold=10)
+    with CannedServer(503, b'busy') as server:
+        client, result = async_query(server.url, 'query FindScenes { findScenes { count } }', breaker=breaker)
+    assert server.requests == 3
+    assert 'failed after 3 attempts' in result['errors'][0]['message']
+    assert client.breaker is breaker and breaker.failures == 3
+
+
+@needs_aiohttp
+def test_async_client_honours_timeout_overrides(monkeypatch):
+    monkeypatch.setattr('stashstuff.async_client.backoff_delay', lambda attempt: 0)
+    with CannedServer(200, b'{"data": {}}', delay=0.3) as server:
+        _, result = async_query(server.url, 'query SlowQuery { findScenes { count } }', timeouts={'SlowQuery': 0.05})
+    assert 'errors' in result
+    assert 'failed after 3 attempts' in result['errors'][0]['message']
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+from stashstuff.streaming import StreamingResponseError, iter_json_array
+
+BODY = json.dumps({'data': {'findDuplicateScenes': [
+    [{'id': '1', 'title': 'Café Ünïcode'}, {'id': '2', 'title': None}],
+    [{'id': '3', 'duration': 12.5}, {'id': '4', 'size': 1234567}],
+    [],
+    123456789,
+]}}, ensure_ascii=False).encode('utf-8')
+EXPECTED = json.loads(BODY)['data']['findDuplicateScenes']
+
+
+def split_at(body, *positions):
+    bounds = [0, *positions, len(body)]
+    return [body[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def test_whole_body_in_one_chunk():
+    assert list(iter_json_array([BODY], 'findDuplicateScenes')) == EXPECTED
+
+
+@pytest.mark.parametrize('position', range(1, len(BODY)))
+def test_any_split_point_gives_the_same_elements(position):
+    # Covers the key, multi-byte characters and the trailing number being cut in two
+    assert list(iter_json_array(split_at(BODY, position), 'findDuplicateScenes')) == EXPECTED
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7])
+def test_tiny_chunks(size):
+    chunks = [BODY[i:i + size] for i in range(0, len(BODY), size)]
+    assert list(iter_json_array(chunks, 'findDuplicateScenes')) == EXPECTED
+
+
+@pytest.mark.parametrize('cut', [-3, -4, -5, len(b'{"data": {"findDuplicateScenes": [[{"id": "1", "ti')])
+def test_truncated_body_yields_what_was_complete_then_raises(cut):
+    items = []
+    with pytest.raises(ValueError):
+        for item in iter_json_array([BODY[:cut]], 'findDuplicateScenes'):
+            items.append(item)
+    assert items == EXPECTED[:len(items)]
+
+
+def test_truncated_before_the_array_raises():
+    with pytest.raises(StreamingResponseError):
+        list(iter_json_array([b'{"data": {"findDupl'], 'findDuplicateScenes'))
+
+
+def test_graphql_errors_are_attached():
+    body = json.dumps({'data': None, 'errors': [{'message': 'boom'}]}).encode()
+    with pytest.raises(StreamingResponseError) as excinfo:
+        list(iter_json_array(split_at(body, 5, 20), 'findDuplicateScenes'))
+    assert excinfo.value.result == {'data': None, 'errors': [{'message': 'boom'}]}
+    assert 'boom' in str(excinfo.value)
@@ -0,0 +1,58 @@
+import contextlib
+import io
+
+import pytest
+
+from stashstuff.cli import load_script
+from stashstuff.mock_stash import MockLibrary, MockStashServer
+
+
+@pytest.fixture
+def server():
+    with MockStashServer(MockLibrary(scenes=200, seed=5)) as server:
+        yield server
+
+
+def mp4_file_ids(library):
+    """MP4s of the scenes that also have an MKV (the ones update-dupes deletes)"""
+    return [f['id'] for scene in library.scenes.values() for f in scene['files']
+            if f['path'].endswith('.mp4') and any(other['path'].endswith('.mkv') for other in scene['files'])]
+
+
+def test_failed_bulk_delete_falls_back_to_one_request_per_file(server, monkeypatch, tmp_path):
+    monkeypatch.setenv('STASH_URL', server.url)
+    monkeypatch.setenv('STASH_API_KEY', 'test')
+    monkeypatch.chdir(tmp_path)
+    script = load_script('update-dupes.py')
+    script.UNATTENDED = True
+    script.METRICS_FILE = None
+
+    library = server.library
+    mp4s = mp4_file_ids(library)
+    assert len(mp4s) > 2
+    stuck = mp4s[1]
+    original = library.delete_files
+    requests = []
+
+    def refuse_stuck_file(ids=None, **kwargs):
+        requests.append(list(ids))
+        if stuck in ids:
+            raise ValueError(f"file {stuck} is in use")
+        return original(ids=ids, **kwargs)
+
+    monkeypatch.setattr(library, 'delete_files', refuse_stuck_file)
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        script.main()
+    output = output.getvalue()
+
+    bulk = [ids for ids in requests if len(ids) > 1]
+    assert sorted(id for ids in bulk for id in ids) == sorted(mp4s)
+    # Only the chunk with the stuck file was retried, one request per file
+    retried = [ids[0] for ids in requests if len(ids) == 1]
+    assert stuck in retried and set(retried) <= set(next(ids for ids in bulk if stuck in ids))
+    assert len(retried) == len(set(retried))
+    assert mp4_file_ids(library) == [stuck]
+    assert output.count('✓ Deleted MP4 file:') == len(mp4s) - 1
+    assert output.count('✗ Error deleting MP4') == 1
+    assert f"Successfully processed {len(mp4s) - 1} scenes." in output
@@ -1,37 +1,48 @@
-import requests
 import json
 import os
-from dotenv import load_dotenv
+from itertools import islice
 
-# Load environment variables from .env file
-load_dotenv()
+from stashstuff.batching import MutationBatcher
+from stashstuff.client import StashGraphQLClient
+from stashstuff.env import load_stash_env
+from stashstuff.metrics import RunMetrics, profile_run
+from stashstuff.preflight import preflight
 
-class StashAppClient:
-    def __init__(self, base_url, api_key):
-        self.base_url = base_url
-        self.headers = {
-            'Content-Type': 'application/json',
-            'ApiKey': api_key
-        }
-        self.graphql_url = f"{base_url}/graphql"
-    
-    def execute_query(self, query, variables=None):
-        payload = {'query': query}
-        if variables:
-            payload['variables'] = variables
-        
-        response = requests.post(self.graphql_url, json=payload, headers=self.headers)
-        return response.json()
-    
-    def find_scenes_with_multiple_files(self):
+# Load environment variables from .env (or stash.env)
+load_stash_env()
+
+MUTATION_BATCH_SIZE = 50  # Primary-file updates packed into one GraphQL request
+SCENE_PAGE_SIZE = 100  # Scenes fetched per findScenes request
+SCENE_BATCH_SIZE = 100  # Scenes handled per batch (one pause per batch unless UNATTENDED)
+DELETE_FILES_PER_CALL = 500  # MP4 file ids sent in a single deleteFiles(ids: [...]) call
+UNATTENDED = False  # Run every batch without waiting for Enter in between
+PREFLIGHT_FILES = False  # Only delete an MP4 if its MKV exists on disk with the size Stash reports
+LIBRARY_PATH_MAP = {}  # Server path prefix -> local mount point for the preflight, e.g. {'/data/': '/mnt/stash/'}
+MAX_REQUESTS_PER_SECOND = 200  # Ceiling for the adaptive rate limiter, which backs off on slow responses and 429/5xx (0 = unlimited)
+MAX_RETRIES = 5  # Retries for failed queries (mutations are only resent when the server never got them)
+METRICS_FILE = 'update_dupes_metrics.json'  # Phase timings, request counters and latency histograms, written after every run (plus .prom; None = off)
+PROFILE = None  # 'cprofile' (profile saved to PROFILE_FILE, slowest functions printed) or 'tracemalloc' (biggest allocations printed)
+PROFILE_FILE = 'update_dupes_profile.prof'  # Where PROFILE = 'cprofile' saves the profile (open with snakeviz or pstats)
+
+class StashAppClient(StashGraphQLClient):
+    """Stash GraphQL client with the queries and mutations this script needs"""
+
+    def find_scenes_with_multiple_files(self, per_page, after_id=None):
+        """
+        One page of scenes with more than one file, in ascending ID order.
+        Pages are keyed on scene ID (after_id) rather than page number because
+        processed scenes drop out of the filter, which would shift offset pages.
+        """
         query = """
-        query FindScenesWithMultipleFiles {
-          findScenes(scene_filter: {
-            file_count: {
-              value: 1
-              modifier: GREATER_THAN
+        query FindScenesWithMultipleFiles($scene_filter: SceneFilterType!, $per_page: Int!) {
+          findScenes(
+            scene_filter: $scene_filter
+            filter: {
+              per_page: $per_page
+              sort: "id"
+              direction: ASC
             }
-          }) {
+          ) {
             count
             scenes {
               id
@@ -39,6 +50,7 @@ class StashAppClient:
               files {
                 id
                 path
+                size
                 video_codec
                 basename
               }
@@ -46,7 +58,22 @@ class StashAppClient:
           }
         }
         """
-        return self.execute_query(query)
+        scene_filter = {
+            'file_count': {
+                'value': 1,
+                'modifier': 'GREATER_THAN'
+            }
+        }
+        if after_id is not None:
+            scene_filter['id'] = {
+                'value': int(after_id),
+                'modifier': 'GREATER_THAN'
+            }
+        variables = {
+            'scene_filter': scene_filter,
+            'per_page': per_page
+        }
+        return self.execute_query(query, variables)
     
     def set_primary_file(self, scene_id, file_id):
         mutation = """
@@ -76,6 +103,37 @@ class StashAppClient:
             'file_id': file_id
         }
         return self.execute_query(mutation, variables)
+    
+    def delete_files(self, file_ids):
+        mutation = """
+        mutation DeleteFiles($file_ids: [ID!]!) {
+          deleteFiles(ids: $file_ids)
+        }
+        """
+        variables = {
+            'file_ids': file_ids
+        }
+        return self.execute_query(mutation, variables)
+
+def iter_scenes_with_multiple_files(client, per_page):
+    """
+    Yield scenes with more than one file as each page arrives, so only one
+    page is held in memory at a time
+    """
+    after_id = None
+    while True:
+        result = client.find_scenes_with_multiple_files(per_page=per_page, after_id=after_id)
+        
+        if 'errors' in result:
+            print(f"Error: {result['errors']}")
+            return
+        
+        scenes = result['data']['findScenes']['scenes']
+        yield from scenes
+        
+        if len(scenes) < per_page:
+            return
+        after_id = scenes[-1]['id']
 
 def main():
     # Load configuration from environment variables
@@ -83,66 +141,134 @@ def main():
     api_key = os.getenv('STASH_API_KEY')
     
     if not api_key:
-        raise ValueError("STASH_API_KEY environment variable is required. Please check your .env file.")
+        raise ValueError("STASH_API_KEY environment variable is required. Please check your .env file "
+                         "(or pass --api-key to python -m stashstuff).")
     
     # Configure your Stashapp connection
     client = StashAppClient(
         base_url=stash_url,
-        api_key=api_key
+        api_key=api_key,
+        max_requests_per_second=MAX_REQUESTS_PER_SECOND,
+        max_retries=MAX_RETRIES,
+        metrics=RunMetrics('update-dupes')
     )
     
-    # Find scenes with multiple files
-    result = client.find_scenes_with_multiple_files()
+    try:
+        with profile_run(PROFILE, client.metrics, PROFILE_FILE):
+            make_mkv_files_primary(client)
+    finally:
+        client.print_latency_report()
+        client.write_metrics(METRICS_FILE)
+
+def make_mkv_files_primary(client):
+    """Make the MKV primary and delete the MP4 for every scene that has both, batch by batch"""
+    # Count scenes with multiple files; the scenes themselves are streamed page by page below
+    result = client.find_scenes_with_multiple_files(per_page=1)
     
     if 'errors' in result:
         print(f"Error: {result['errors']}")
         return
     
-    scenes = result['data']['findScenes']['scenes']
-    total_scenes = len(scenes)
+    total_scenes = result['data']['findScenes']['count']
+    scenes = iter_scenes_with_multiple_files(client, SCENE_PAGE_SIZE)
     processed_count = 0
-    batch_size = 100
+    batcher = MutationBatcher(client, max_batch_size=MUTATION_BATCH_SIZE)
+    # (scene, mp4_file) pairs whose MKV is now primary, waiting for a bulk deleteFiles
+    pending_deletes = []
+    
+    def queue_primary_update(scene, mkv_file, mp4_file):
+        # Set MKV as primary; the MP4 is only deleted once that has succeeded
+        def on_primary_set(result):
+            if 'errors' not in result:
+                print(f"✓ Set MKV as primary for: {scene['title']}")
+                pending_deletes.append((scene, mp4_file))
+            else:
+                print(f"✗ Error setting primary file for: {scene['title']} - {result['errors']}")
+        
+        batcher.add('sceneUpdate',
+                    {'input': ('SceneUpdateInput!', {'id': scene['id'], 'primary_file_id': mkv_file['id']})},
+                    selection='id title', callback=on_primary_set)
+    
+    def on_mp4_deleted(scene, mp4_file, delete_result):
+        nonlocal processed_count
+        if 'errors' not in delete_result:
+            processed_count += 1
+            print(f"✓ Deleted MP4 file: {mp4_file['basename']}")
+        else:
+            print(f"✗ Error deleting MP4 file for: {scene['title']} - {delete_result['errors']}")
+    
+    def delete_pending_mp4s():
+        # One deleteFiles call per DELETE_FILES_PER_CALL files. If a bulk call fails we
+        # can't tell which file caused it, so retry that chunk one request per file
+        # (not one alias per file: deleteFiles is Boolean!, so one failing alias would
+        # null the whole batch response and hide which of the others went through).
+        nonlocal processed_count
+        for start in range(0, len(pending_deletes), DELETE_FILES_PER_CALL):
+            chunk = pending_deletes[start:start + DELETE_FILES_PER_CALL]
+            try:
+                delete_result = client.delete_files([mp4_file['id'] for _, mp4_file in chunk])
+            except Exception as e:
+                delete_result = {'errors': [{'message': str(e)}]}
+            
+            if 'errors' not in delete_result:
+                processed_count += len(chunk)
+                print(f"✓ Deleted {len(chunk)} MP4 files in one request")
+            else:
+                print(f"✗ Bulk delete of {len(chunk)} files failed ({delete_result['errors']}), retrying one by one")
+                for scene, mp4_file in chunk:
+                    try:
+                        result = client.delete_file(mp4_file['id'])
+                    except Exception as e:
+                        result = {'errors': [{'message': str(e)}]}
+                    on_mp4_deleted(scene, mp4_file, result)
+        pending_deletes.clear()
     
     print(f"Found {total_scenes} scenes with multiple files")
-    print(f"Processing in batches of {batch_size}...")
+    print(f"Processing in batches of {SCENE_BATCH_SIZE}{' (unattended)' if UNATTENDED else ''}...")
     
-    # Process scenes in batches of 10
-    for i in range(0, total_scenes, batch_size):
-        batch = scenes[i:i + batch_size]
-        batch_num = (i // batch_size) + 1
+    # Process scenes in batches as they are fetched
+    for i in range(0, total_scenes, SCENE_BATCH_SIZE):
+        with client.metrics.phase('fetch_scenes'):
+            batch = list(islice(scenes, SCENE_BATCH_SIZE))
+        if not batch:
+            break
+        batch_num = (i // SCENE_BATCH_SIZE) + 1
         print(f"\nProcessing batch {batch_num} ({len(batch)} scenes)...")
         
+        # Check the whole batch's MKVs on disk at once before trusting them
+        checks = None
+        if PREFLIGHT_FILES:
+            with client.metrics.phase('preflight'):
+                checks = preflight([f for scene in batch for f in scene['files'] if f['path'].lower().endswith('.mkv')],
+                                   prefix_map=LIBRARY_PATH_MAP, hash_same_size=False)
+        
         for scene in batch:
             mp4_files = [f for f in scene['files'] if f['path'].lower().endswith('.mp4')]
             mkv_files = [f for f in scene['files'] if f['path'].lower().endswith('.mkv')]
             
             if mp4_files and mkv_files:
-                mkv_file = mkv_files[0]
-                mp4_file = mp4_files[0]
-                
-                # Set MKV as primary
-                result = client.set_primary_file(scene['id'], mkv_file['id'])
-                
-                if 'errors' not in result:
-                    print(f"✓ Set MKV as primary for: {scene['title']}")
-                    
-                    # Delete the MP4 file
-                    delete_result = client.delete_file(mp4_file['id'])
-                    
-                    if 'errors' not in delete_result:
-                        processed_count += 1
-                        print(f"✓ Deleted MP4 file: {mp4_file['basename']}")
-                    else:
-                        print(f"✗ Error deleting MP4 file for: {scene['title']} - {delete_result['errors']}")
-                else:
-                    print(f"✗ Error setting primary file for: {scene['title']} - {result['errors']}")
+                if checks is not None and not checks[mkv_files[0]['id']].ok:
+                    print(f"✗ Skipping {scene['title']}: {mkv_files[0]['path']} is missing or its size doesn't match")
+                    continue
+                queue_primary_update(scene, mkv_files[0], mp4_files[0])
+        
+        # Send the batch's primary-file updates, then delete the MP4s they unlocked in bulk
+        with client.metrics.phase('primary_updates'):
+            batcher.flush()
+        with client.metrics.phase('delete_files'):
+            delete_pending_mp4s()
         
         # Add a pause between batches (optional)
-        if i + batch_size < total_scenes:
-            input(f"\nBatch {batch_num} completed. Press Enter to continue to next batch...")
+        if i + SCENE_BATCH_SIZE < total_scenes and not UNATTENDED:
+            with client.metrics.phase('waiting_for_enter'):
+                input(f"\nBatch {batch_num} completed. Press Enter to continue to next batch...")
     
     print(f"\nCompleted! Successfully processed {processed_count} scenes.")
     print(f"Set MKV as primary and deleted MP4 files for {processed_count} scenes.")
 
+    print(f"Sent {batcher.mutations_sent} batched mutations in {batcher.requests_sent} requests.")
+    client.metrics.count('scenes_processed', processed_count)
+    client.metrics.count('batched_mutations', batcher.mutations_sent)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file